@@ -1,10 +1,17 @@
 from ha_api import HomeAssistantAPI
+from control_reconciler import ControlReconciler
+from history_store import HistoryStore
+from load_profile import build_load_profile, LoadProfileIndex, IncrementalLoadProfile, SLOT_MINUTES, SLOTS_PER_DAY
+from base_load import DecayingQuantile
+from metrics import metrics
 from dataclasses import dataclass
 import datetime
 from zoneinfo import ZoneInfo
 import time
+import asyncio
+import threading
 import numpy as np
-import math
+from concurrent.futures import ThreadPoolExecutor
 
 HA_TZ = ZoneInfo("Australia/Brisbane") 
 
@@ -14,9 +21,61 @@ class StateClass:
     state: float
     time: datetime
 
+# Entities read by Plant each tick, fetched together in a single snapshot
+PLANT_ENTITIES = [
+    "sensor.sigen_plant_rated_energy_capacity",
+    "number.sigen_plant_ess_backup_state_of_charge",
+    "sensor.sigen_plant_available_max_discharging_capacity",
+    "number.sigen_plant_ess_charge_cut_off_state_of_charge",
+    "sensor.sigen_plant_available_max_charging_capacity",
+    "sensor.reversed_battery_power",
+    "sensor.sigen_plant_pv_power",
+    "sensor.sigen_inverter_daily_pv_energy",
+    "sensor.solcast_pv_forecast_forecast_remaining_today",
+    "sensor.solcast_pv_forecast_forecast_this_hour",
+    "sensor.sigen_plant_plant_active_power",
+    "sensor.sigen_plant_grid_active_power",
+    "sensor.sigen_plant_consumed_power",
+    "select.sigen_plant_remote_ems_control_mode",
+    "number.sigen_plant_ess_max_discharging_limit",
+    "number.sigen_plant_ess_max_charging_limit",
+    "number.sigen_plant_pv_max_power_limit",
+    "number.sigen_plant_grid_export_limitation",
+    "number.sigen_plant_grid_import_limitation",
+]
+
+def kwh_required_with_buffer(forecast_kwh, buffer_percentage=20): # kWh to keep for the forecast load plus a safety margin
+    return max(forecast_kwh, 0) * (1 + (buffer_percentage/100)) + 2
+
+@dataclass
+class LoadModels:
+    """Models built from history. Replaced as a whole when rebuilt so a reader never sees half of a rebuild"""
+    avg_load_day: list[StateClass]
+    load_index: LoadProfileIndex # Of avg_load_day
+    base_load_estimate: float # kW, from history or the online estimate if it was warm
+    built: float # time.time() they were built (or restored)
+
+def make_load_models(avg_load_day, base_load_estimate, built=None):
+    return LoadModels(
+        avg_load_day=avg_load_day,
+        load_index=LoadProfileIndex([interval.state for interval in avg_load_day]),
+        base_load_estimate=base_load_estimate,
+        built=built if built != None else time.time())
+
+def load_avg_day_from_profile(profile, days=None): # profile: cumulative kWh at each slot, days: days x slots it was averaged from if known
+    avg_day = []
+    dt = datetime.datetime.combine(
+        datetime.date.today(),
+        datetime.time.min
+    )
+    for i in range(SLOTS_PER_DAY):
+        avg_day.append(StateClass(state=round(float(profile[i]), 2), states=days[:, i].tolist() if days is not None else [], time=dt.time()))
+        dt = dt + datetime.timedelta(minutes=SLOT_MINUTES)
+    return avg_day
+
 class Plant:
-    def __init__(self, HA_URL, TOKEN, errors=True):
-        self.ha = HomeAssistantAPI(
+    def __init__(self, HA_URL, TOKEN, errors=True, ha=None, checkpoint=None): # checkpoint: checkpoint.Checkpoint to start from instead of building the models from history
+        self.ha = ha or HomeAssistantAPI(
             base_url=HA_URL,
             token=TOKEN,
             errors=errors
@@ -28,39 +87,60 @@ class Plant:
             "Command Charging (Grid First)",
             "Command Discharging (PV First)",
             "Command Discharging (ESS First)"]
-        self.rated_capacity = self.ha.get_numeric_state("sensor.sigen_plant_rated_energy_capacity")
+        self.snapshot = self.ha.get_snapshot(PLANT_ENTITIES)
+        self.rated_capacity = self.snapshot.get_numeric_state("sensor.sigen_plant_rated_energy_capacity")
         self.max_discharge_power = 24
         self.max_charge_power = 21
         self.max_pv_power = 24
         self.max_export_power = 15
         self.max_import_power = 45
         self.load_avg_days = 3
-
-        self.last_load_data_retrival_timestamp = 0
-        self.avg_load_day = None
-
-        self.last_base_load_estimate_timestamp = 0
-        self.base_load_estimate = None
-
-        self.update_data()
+        self.base_load_days = 7
+        self.base_load = DecayingQuantile(quantile=0.2) # 20th percentile of the live load power, kW
+        self.load_profile = IncrementalLoadProfile(alpha=2/(self.load_avg_days+1)) # Seeded from history once, then kept up to date from the live load power
+        self.reconciler = ControlReconciler() # Shadow of the commanded control mode and limits
+        self.history = HistoryStore(self.ha) # Local copy of sensor history, only new samples are downloaded
+
+        self.models = None # LoadModels, see avg_load_day, load_index and base_load_estimate
+        # Rebuilds after the first happen on this thread while the controller carries on with the old models.
+        # The history downloads and numpy release the GIL so a thread is enough, no need for a process.
+        self.rebuild_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-rebuild")
+        self.rebuild_lock = threading.Lock()
+        self.models_lock = threading.Lock() # Swaps from the rebuild thread and from update_data
+        self.rebuild_future = None
+        self.rebuild_retry_timestamp = 0 # A failed rebuild isn't retried before this
+        self.rebuild_retry_delay = 10*60
+        self.on_models_rebuilt = None # callback(models), called on the rebuild thread
+        if(checkpoint != None):
+            self.restore_models(checkpoint)
+
+        self.update_data(self.snapshot)
     def get_plant_mode(self):
-        return self.ha.get_state("select.sigen_plant_remote_ems_control_mode")["state"]
+        return self.snapshot.get_state("select.sigen_plant_remote_ems_control_mode")["state"]
+
+    def update_data(self, snapshot=None): # snapshot: StateSnapshot containing PLANT_ENTITIES, fetched if not provided
+        if(snapshot == None):
+            snapshot = self.ha.get_snapshot(PLANT_ENTITIES)
+        self.snapshot = snapshot
 
-    def update_data(self):
-        self.kwh_backup_buffer = (self.ha.get_numeric_state("number.sigen_plant_ess_backup_state_of_charge")/100.0) * self.rated_capacity
-        self.kwh_stored_energy = self.ha.get_numeric_state("sensor.sigen_plant_available_max_discharging_capacity")
+        self.kwh_backup_buffer = (snapshot.get_numeric_state("number.sigen_plant_ess_backup_state_of_charge")/100.0) * self.rated_capacity
+        self.kwh_stored_energy = snapshot.get_numeric_state("sensor.sigen_plant_available_max_discharging_capacity")
         self.kwh_stored_available = self.kwh_stored_energy - self.kwh_backup_buffer
-        self.kwh_charge_unusable = (1-(self.ha.get_numeric_state("number.sigen_plant_ess_charge_cut_off_state_of_charge")/100.0)) * self.rated_capacity # kWh of buffer to 100% IE the charge limit 
-        self.kwh_till_full = self.ha.get_numeric_state("sensor.sigen_plant_available_max_charging_capacity") - self.kwh_charge_unusable
-        self.battery_kw = self.ha.get_numeric_state("sensor.reversed_battery_power")
-
-        self.solar_kw = self.ha.get_numeric_state("sensor.sigen_plant_pv_power")
-        self.solar_kwh_today = self.ha.get_numeric_state("sensor.sigen_inverter_daily_pv_energy")
-        self.solar_kw_remaining_today = self.ha.get_numeric_state("sensor.solcast_pv_forecast_forecast_remaining_today")
-        self.solar_daytime = self.ha.get_numeric_state('sensor.solcast_pv_forecast_forecast_this_hour') > self.get_base_load_estimate() # If producing more power than base load consider it during the solar day
-        self.inverter_power = self.ha.get_numeric_state("sensor.sigen_plant_plant_active_power")
-        self.grid_power = self.ha.get_numeric_state("sensor.sigen_plant_grid_active_power")
-        self.load_power = self.ha.get_numeric_state("sensor.sigen_plant_consumed_power")
+        self.kwh_charge_unusable = (1-(snapshot.get_numeric_state("number.sigen_plant_ess_charge_cut_off_state_of_charge")/100.0)) * self.rated_capacity # kWh of buffer to 100% IE the charge limit 
+        self.kwh_till_full = snapshot.get_numeric_state("sensor.sigen_plant_available_max_charging_capacity") - self.kwh_charge_unusable
+        self.battery_kw = snapshot.get_numeric_state("sensor.reversed_battery_power")
+
+        self.solar_kw = snapshot.get_numeric_state("sensor.sigen_plant_pv_power")
+        self.solar_kwh_today = snapshot.get_numeric_state("sensor.sigen_inverter_daily_pv_energy")
+        self.solar_kw_remaining_today = snapshot.get_numeric_state("sensor.solcast_pv_forecast_forecast_remaining_today")
+        self.inverter_power = snapshot.get_numeric_state("sensor.sigen_plant_plant_active_power")
+        self.grid_power = snapshot.get_numeric_state("sensor.sigen_plant_grid_active_power")
+        self.load_power = snapshot.get_numeric_state("sensor.sigen_plant_consumed_power")
+        now = time.time()
+        self.base_load.add(self.load_power, now)
+        if(self.load_profile.add(self.load_power, now)):
+            self.refresh_models()
+        self.solar_daytime = snapshot.get_numeric_state('sensor.solcast_pv_forecast_forecast_this_hour') > self.get_base_load_estimate() # If producing more power than base load consider it during the solar day
         self.avg_daily_load = self.get_load_avg(days_ago=self.load_avg_days)[-1].state
         
 
@@ -71,6 +151,17 @@ class Plant:
         elif(self.battery_kw > 0):
             self.hours_till_empty = round(self.kwh_stored_available / abs(self.battery_kw), 2)
 
+    async def async_update_data(self, aha, snapshot=None): # aha: AsyncHomeAssistantAPI
+        # The models are only built here the first time (after that they're rebuilt in the background), then the history downloads run alongside the snapshot request
+        from async_api import run_blocking # Only needed in async mode, so it isn't imported otherwise
+        requests = [run_blocking(self.ensure_models)]
+        if(snapshot == None):
+            requests.append(aha.get_snapshot(PLANT_ENTITIES))
+        results = await asyncio.gather(*requests)
+        if(snapshot == None):
+            snapshot = results[-1]
+        self.update_data(snapshot)
+
     def display_data(self):
         self.update_data()
         print("Stored Energy: "+str(round(self.kwh_stored_energy,2))+" kWh")
@@ -92,36 +183,58 @@ class Plant:
         raise("SET THIS UP")
         #time till full/empty
     
+    def control_targets(self, control_mode, discharge, charge, pv, grid_export, grid_import): # entity -> value, limits before the mode so they're in place when it changes
+        if(control_mode not in self.control_mode_options):
+            raise Exception(f"Requested control mode '{control_mode}' is not a valid control mode!")
+        return {
+            "number.sigen_plant_ess_max_discharging_limit": discharge,
+            "number.sigen_plant_ess_max_charging_limit": charge,
+            "number.sigen_plant_pv_max_power_limit": pv,
+            "number.sigen_plant_grid_export_limitation": grid_export,
+            "number.sigen_plant_grid_import_limitation": grid_import,
+            "select.sigen_plant_remote_ems_control_mode": control_mode,
+        }
+
+    @metrics.timed("control_limits")
     def check_control_limits(self, working_mode, control_mode, discharge, charge, pv, grid_export, grid_import):
-        current_control_mode = self.get_plant_mode()
-        curent_discharge_limit = self.ha.get_numeric_state("number.sigen_plant_ess_max_discharging_limit")
-        curent_charge_limit = self.ha.get_numeric_state("number.sigen_plant_ess_max_charging_limit")
-        curent_pv_limit = self.ha.get_numeric_state("number.sigen_plant_pv_max_power_limit")
-        curent_export_limit = self.ha.get_numeric_state("number.sigen_plant_grid_export_limitation")
-        curent_import_limit = self.ha.get_numeric_state("number.sigen_plant_grid_import_limitation")
-
-        a = current_control_mode != control_mode or curent_discharge_limit != discharge or curent_charge_limit != charge
-        b = curent_pv_limit != pv or curent_export_limit != grid_export or curent_import_limit != grid_import
-
-        if(a or b):
-            self.set_control_limits(control_mode, discharge, charge, pv, grid_export, grid_import)
+        self.reconciler.set_desired(self.control_targets(control_mode, discharge, charge, pv, grid_export, grid_import))
+        writes = self.reconciler.reconcile(self.snapshot)
+        if(len(writes) > 0):
+            self.write_setpoints(writes)
             print(f"{working_mode} !!!")
-            time.sleep(5) # Allow time for HA to update
-
 
+    @metrics.timed("control_limits")
+    async def async_check_control_limits(self, aha, working_mode, control_mode, discharge, charge, pv, grid_export, grid_import):
+        self.reconciler.set_desired(self.control_targets(control_mode, discharge, charge, pv, grid_export, grid_import))
+        writes = self.reconciler.reconcile(self.snapshot)
+        if(len(writes) > 0):
+            await self.async_write_setpoints(aha, writes)
+            print(f"{working_mode} !!!")
 
-    def set_control_limits(self, control_mode, discharge, charge, pv, grid_export, grid_import):
-        #if(self.get_plant_mode() != control_mode):
-        self.ha.set_number("number.sigen_plant_ess_max_discharging_limit", discharge)
-        self.ha.set_number("number.sigen_plant_ess_max_charging_limit", charge)
-        self.ha.set_number("number.sigen_plant_pv_max_power_limit", pv)
-        self.ha.set_number("number.sigen_plant_grid_export_limitation", grid_export)
-        self.ha.set_number("number.sigen_plant_grid_import_limitation", grid_import)
-        
-        if(control_mode in self.control_mode_options):
-            self.ha.set_select("select.sigen_plant_remote_ems_control_mode", control_mode)
-        else:
-            raise(f"Requested control mode '{control_mode}' is not a valid control mode!")
+    def set_control_limits(self, control_mode, discharge, charge, pv, grid_export, grid_import): # Write every limit whether it differs or not
+        self.write_setpoints(list(self.control_targets(control_mode, discharge, charge, pv, grid_export, grid_import).items()))
+
+    async def async_set_control_limits(self, aha, control_mode, discharge, charge, pv, grid_export, grid_import):
+        await self.async_write_setpoints(aha, list(self.control_targets(control_mode, discharge, charge, pv, grid_export, grid_import).items()))
+
+    def write_setpoints(self, writes):
+        for entity_id, value in writes:
+            if(entity_id.startswith("select.")):
+                self.ha.set_select(entity_id, value)
+            else:
+                self.ha.set_number(entity_id, value)
+            self.reconciler.mark_commanded(entity_id, value)
+            self.snapshot.invalidate(entity_id) # The snapshot value is out of date, re-read it from HA when next needed
+
+    async def async_write_setpoints(self, aha, writes):
+        numbers = [(entity_id, value) for entity_id, value in writes if not entity_id.startswith("select.")]
+        selects = [(entity_id, value) for entity_id, value in writes if entity_id.startswith("select.")]
+        await asyncio.gather(*[aha.set_number(entity_id, value) for entity_id, value in numbers])
+        for entity_id, value in selects: # Mode last, once the limits for it are in place
+            await aha.set_select(entity_id, value)
+        for entity_id, value in writes:
+            self.reconciler.mark_commanded(entity_id, value)
+            self.snapshot.invalidate(entity_id)
     
     def calculate_base_load(self, days_ago = 7): # Calculate base load in kW
         today = datetime.datetime.now(HA_TZ).date()
@@ -131,27 +244,93 @@ class Plant:
         start = datetime.datetime.combine(start_date, datetime.time.min, tzinfo=HA_TZ)
         end = datetime.datetime.combine(end_date, datetime.time.min, tzinfo=HA_TZ)
 
-        load_state_history = self.ha.get_history("sensor.sigen_plant_consumed_power", start_time=start, end_time=end)
-
-        load_history = [h.state for h in load_state_history]
-        
-        load_history_clean = [
-            v for v in load_history
-            if v is not None and not math.isnan(v)
-        ]
-        self.base_load_estimate = np.percentile(load_history_clean, 20)
-
-        return self.base_load_estimate
-    
-    def get_base_load_estimate(self, days_ago = 7, hours_update_interval=24): # Returns approximate base load in kW
-        if(time.time() - self.last_base_load_estimate_timestamp > hours_update_interval*60*60 or self.base_load_estimate == None):
-            self.base_load_estimate = self.calculate_base_load(days_ago)
-            self.last_base_load_estimate_timestamp = time.time()
-        return self.base_load_estimate
-
-        
-
-    def update_load_avg(self, days_ago=7):
+        timestamps, load_history = self.history.get_arrays("sensor.sigen_plant_consumed_power", start, end)
+        return float(np.nanpercentile(load_history, 20))
+
+    @property
+    def avg_load_day(self):
+        return None if self.models == None else self.models.avg_load_day
+
+    @property
+    def load_index(self):
+        return None if self.models == None else self.models.load_index
+
+    @property
+    def base_load_estimate(self): # The online estimate once it has seen a day of samples, until then the one from history
+        if(self.base_load.warm):
+            return self.base_load.value()
+        return None if self.models == None else self.models.base_load_estimate
+
+    def build_models(self): # Downloads the history the online models can't cover yet, leaves the models in use alone
+        if(not self.load_profile.ready):
+            self.load_profile.seed(self.load_history_days(self.load_avg_days))
+        return make_load_models(
+            avg_load_day=load_avg_day_from_profile(self.load_profile.profile()),
+            base_load_estimate=self.base_load.value() if self.base_load.warm else self.calculate_base_load(self.base_load_days))
+
+    def rebuild_models(self): # Build the models now on this thread, then swap them in
+        models = self.build_models()
+        with self.models_lock:
+            self.models = models
+        return models
+
+    def refresh_models(self): # A slot was folded into the load profile, swap in models with it
+        with self.models_lock:
+            if(self.models != None and self.load_profile.ready):
+                self.models = make_load_models(
+                    avg_load_day=load_avg_day_from_profile(self.load_profile.profile()),
+                    base_load_estimate=self.models.base_load_estimate,
+                    built=self.models.built) # Only a rebuild resets the age, so the history base load still gets refreshed
+
+    def request_rebuild(self):
+        """Rebuild the models on the rebuild thread, the current ones stay in use until the new ones are swapped in.
+        Returns the Future of the rebuild, or of the one already running.
+        """
+        with self.rebuild_lock:
+            if(self.rebuild_future == None or self.rebuild_future.done()):
+                self.rebuild_future = self.rebuild_executor.submit(self.rebuild_in_background)
+            return self.rebuild_future
+
+    def rebuild_in_background(self):
+        started = time.time()
+        try:
+            with metrics.timer("model_rebuild"):
+                models = self.rebuild_models()
+        except Exception as e:
+            self.rebuild_retry_timestamp = time.time() + self.rebuild_retry_delay
+            print(f"Model rebuild failed, keeping the models from {round((time.time() - self.models.built)/3600, 1)} hours ago: {e}" if self.models != None else f"Model rebuild failed: {e}")
+            return None
+        print(f"Models rebuilt from history in {round(time.time() - started, 1)} seconds")
+        if(self.on_models_rebuilt != None):
+            self.on_models_rebuilt(models)
+        return models
+
+    def ensure_models(self, hours_update_interval=24):
+        if(self.models == None):
+            self.rebuild_models() # Nothing to carry on with, the first build has to finish before the first decision
+        elif(time.time() - self.models.built > hours_update_interval*60*60 and time.time() >= self.rebuild_retry_timestamp):
+            self.request_rebuild() # Normally the daily scheduled rebuild gets there first
+        return self.models
+
+    def get_base_load_estimate(self, days_ago = None, hours_update_interval=24): # Returns approximate base load in kW
+        if(days_ago != None):
+            self.base_load_days = days_ago
+        if(self.base_load.warm):
+            return self.base_load.value()
+        return self.ensure_models(hours_update_interval).base_load_estimate
+
+    def restore_models(self, checkpoint):
+        """Use the models saved in a checkpoint. They count as fresh so nothing is rebuilt until a rebuild is requested"""
+        if(checkpoint.base_load_weights is not None):
+            self.base_load.restore(checkpoint.base_load_weights, checkpoint.base_load_sample_timestamp)
+        if(checkpoint.load_profile_mean is not None):
+            self.load_profile.restore(checkpoint.load_profile_mean, checkpoint.load_profile_variance, checkpoint.load_profile_counts)
+        if(self.load_profile.ready and checkpoint.base_load_estimate != None):
+            self.models = make_load_models(
+                avg_load_day=load_avg_day_from_profile(self.load_profile.profile()),
+                base_load_estimate=checkpoint.base_load_estimate)
+
+    def load_history_days(self, days_ago=3): # days x slots grid of the daily load consumption over the last days_ago whole days
         today = datetime.datetime.now(HA_TZ).date()
         end_date = today - datetime.timedelta(days=1)
         start_date = end_date - datetime.timedelta(days=days_ago)
@@ -159,108 +338,29 @@ class Plant:
         start = datetime.datetime.combine(start_date, datetime.time.min, tzinfo=HA_TZ)
         end = datetime.datetime.combine(end_date, datetime.time.min, tzinfo=HA_TZ)
 
-
-        history = self.ha.get_history("sensor.sigen_plant_daily_load_consumption", start_time=start, end_time=end)
-        #print(f"start: {start}  \n end: {end}\nhistory: {history[2].time.date()}")
-
-        day = 0
-        history_days = [[]]
-        for hist in history: 
-            if(hist.time.date() == start_date + datetime.timedelta(days=day)):
-                history_days[day].append(hist)
-            elif(hist.time.date() == start_date + datetime.timedelta(days=day+1)):
-                day = day + 1
-                history_days.append([])
-                history_days[day].append(hist)
-
-        for day in history_days:
-            while(day[0].state > 0.05): # remove any states that were from the previous day, ie ensure we start with 0 for the day
-                day.pop(0)
-
-        avg_day = []
-        dt = datetime.datetime.combine(
-            datetime.date.today(),
-            datetime.time.min
-        )
-        time_bucket_size = 5 # Size of time bucket in Minutes 
-        for i in range(int((24*60)/time_bucket_size)):
-            avg_day.append(StateClass(state=None, states=[], time=dt.time()))
-            dt = dt + datetime.timedelta(minutes=time_bucket_size)
-        
-        
-        for day in history_days:
-            i = 0
-            bin_avg = []
-            for state in day: 
-                state.time = state.time.replace(
-                    minute=(state.time.minute // time_bucket_size) * time_bucket_size,
-                    second=0,
-                    microsecond=0,
-                    tzinfo=HA_TZ
-                    )
-                
-                if(state.time.time() != avg_day[i].time):
-                    if(i < len(avg_day)-1):
-                        if(state.time.time() == avg_day[i+1].time):
-                            avg_day[i].states.append(sum(bin_avg) / len(bin_avg))
-                            bin_avg = []
-                            i = i + 1
-
-                if(state.time.time() == avg_day[i].time):
-                    if(state.state != None):
-                        bin_avg.append(state.state)
-            if(len(bin_avg) > 0):                    
-                avg_day[i].states.append(sum(bin_avg) / len(bin_avg))   # calc avg for last period of day 
-
-        for interval in avg_day:
-            if(len(interval.states) == 0):
-                raise Exception(f"Failed to get state data for {state.time} time period")
-            interval.state = round(sum(interval.states) / len(interval.states), 2)
-
-        #for i in range(len(avg_day)): # Print average for each day and each time
-        #    print(avg_day[i].state)
-        #    print(avg_day[i].states)       
-
-        return avg_day
+        timestamps, values = self.history.get_arrays("sensor.sigen_plant_daily_load_consumption", start, end)
+        profile, days = build_load_profile(timestamps, values, slot_minutes=SLOT_MINUTES)
+        return days
     
-    def get_load_avg(self, days_ago, hours_update_interval=24): # hours_update_interval: frequency to update the load date
-        if(time.time() - self.last_load_data_retrival_timestamp > hours_update_interval*60*60 or self.avg_load_day == None):
-            self.avg_load_day = self.update_load_avg(days_ago)
-            self.last_load_data_retrival_timestamp = time.time()
-        return self.avg_load_day
+    def get_load_avg(self, days_ago=None, hours_update_interval=24): # hours_update_interval: how old the models can get before a rebuild is requested
+        if(days_ago != None and days_ago != self.load_avg_days):
+            self.load_avg_days = days_ago
+            self.load_profile.alpha = 2/(days_ago+1)
+        return self.ensure_models(hours_update_interval).avg_load_day
         
     def forecast_consumption_amount(self, forecast_hours_from_now=None, forecast_till_time=None):
-        avg_day = self.get_load_avg(days_ago=self.load_avg_days)
-        rounded_current_time = self.round_minutes(datetime.datetime.now(), nearest_minute=5)
+        self.get_load_avg(days_ago=self.load_avg_days)
+        now = datetime.datetime.now(HA_TZ)
         if(forecast_hours_from_now):
-            rounded_forecast_time = self.round_minutes(rounded_current_time + datetime.timedelta(hours=forecast_hours_from_now), nearest_minute=5).time()
+            return self.load_index.kwh_for_hours(now, forecast_hours_from_now)
         elif(forecast_till_time):
-            rounded_forecast_time = self.round_minutes(forecast_till_time, nearest_minute=5)
+            return self.load_index.kwh_between(now, forecast_till_time)
         else:
             raise Exception("Must provide forecast hours or time to determine forecast!")
-        
-        rounded_current_time = rounded_current_time.time()
-
-        starting_kwh = None
-        ending_kwh = None
-        for bin in avg_day:
-            #print(f"time: {bin.time} state: {bin.state}")
-            if(bin.time == rounded_current_time):
-                
-                starting_kwh = bin.state
-            elif(starting_kwh != None and bin.time == rounded_forecast_time):
-                ending_kwh = bin.state
-        
-        if(ending_kwh == None):
-            for bin in avg_day:
-                if(bin.time == rounded_forecast_time):
-                    ending_kwh = bin.state + avg_day[-1].state # If the number of hours wraps past midnight, add the last state from the previous day to the total kwh
-        
-        return ending_kwh-starting_kwh
     
     def kwh_required_remaining(self, buffer_percentage=20):
         forecast_kwh = self.forecast_consumption_amount(forecast_till_time=datetime.time(6, 0, 0))
-        return max(forecast_kwh, 0) * (1 + (buffer_percentage/100)) + 2
+        return kwh_required_with_buffer(forecast_kwh, buffer_percentage)
         
     def round_minutes(self, time, nearest_minute):
         return time.replace(
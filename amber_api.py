@@ -1,13 +1,40 @@
-import requests
 import time
-from datetime import datetime, timedelta
+import os
+import json
+import threading
+import numpy as np
+from requests import RequestException
+from http_session import get_shared_client
+from ha_api import parse_timestamps
+from history_store import DATA_DIR
+from datetime import timedelta
 from dataclasses import dataclass
 
 @dataclass
-class PriceForecast:
-    price: float
-    start_time: datetime
-    end_time: datetime
+class ForecastArrays:
+    """One channel of the price forecast. start and end are epoch seconds, price is c/kWh (feed in is positive when exporting earns)"""
+    start: np.ndarray
+    end: np.ndarray
+    price: np.ndarray
+
+    def __len__(self):
+        return len(self.price)
+
+    def max_price(self):
+        return float(self.price.max())
+
+    def kth_highest_price(self, k):
+        """Price of the k-th highest priced interval (0 is the max), clamped to the cheapest. Uses a partial sort rather than sorting the whole forecast."""
+        k = min(max(k, 0), len(self.price)-1)
+        position = len(self.price)-1-k
+        return float(np.partition(self.price, position)[position])
+
+    def interval_hours(self):
+        return round(float(np.median(self.end - self.start)) / 60) / 60 # Amber intervals start a second after the last one ends
+
+    def price_for_hours(self, hours):
+        """Price to trade at to spend the given hours on the highest priced intervals of the forecast"""
+        return self.kth_highest_price(round(hours / self.interval_hours()))
 
 @dataclass
 class amber_data:
@@ -16,10 +43,19 @@ class amber_data:
     prices_estimated: bool
     general_max_forecast_price: float
     feedIn_max_forecast_price: float
-    general_12hr_forecast: list[PriceForecast]
-    feedIn_12hr_forecast: list[PriceForecast]
-    general_12hr_forecast_sorted: list[PriceForecast]
-    feedIn_12hr_forecast_sorted: list[PriceForecast]
+    general_forecast: ForecastArrays
+    feedIn_forecast: ForecastArrays
+    fetched_timestamp: float = 0
+    stale: bool = False # True when Amber couldn't be reached and these are the last good prices
+
+    @property
+    def age(self): # Seconds since these prices were fetched
+        return time.time() - self.fetched_timestamp
+
+class AmberRateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Exceeded Amber API request rate limit, retry in {retry_after} seconds")
+        self.retry_after = retry_after
     
 
 
@@ -33,11 +69,42 @@ kwh_of_discharge_available = 15
 max_discharge_rate = 15
 hrs_of_discharge_available = kwh_of_discharge_available/max_discharge_rate
 
+DEFAULT_CACHE_PATH = os.path.join(DATA_DIR, "amber_cache.json")
+AMBER_API_URL = os.environ.get("AMBER_API_URL", "https://api.amber.com.au/v1") # Overridden to point at fake_servers.FakeAmber for load tests
+
+class AmberRequestBudget:
+    """Plans Amber requests against the rate limit reported in the RateLimit-Remaining/RateLimit-Reset headers.
+    Current price requests may use all of the remaining quota, forecast requests leave current_price_reserve
+    requests for current prices until the window resets.
+    """
+    def __init__(self, current_price_reserve=10):
+        self.current_price_reserve = current_price_reserve
+        self.remaining = None
+        self.reset_timestamp = 0
+
+    def update(self, remaining, seconds_till_reset):
+        self.remaining = remaining
+        self.reset_timestamp = time.time() + seconds_till_reset
+
+    def allow(self, priority="current"): # priority: "current" or "forecast"
+        if self.remaining == None or time.time() >= self.reset_timestamp: # Unknown or a new window
+            return True
+        if priority == "current":
+            return self.remaining > 0
+        return self.remaining > self.current_price_reserve
+
+    def min_spacing(self):
+        """Seconds between requests that makes the remaining quota last until the window resets"""
+        if self.remaining == None or time.time() >= self.reset_timestamp:
+            return 0
+        return (self.reset_timestamp - time.time()) / max(self.remaining, 1)
+
 class AmberAPI:
-    def __init__(self, api_key, site_id, errors):
+    def __init__(self, api_key, site_id, errors, http=None, cache_path=DEFAULT_CACHE_PATH, forecast_refresh_interval=15*60): # http: HTTPClient, defaults to the shared pooled client
+        self.http = http or get_shared_client()
         self.api_key = api_key
         self.site_id = site_id
-        self.base = "https://api.amber.com.au/v1"
+        self.base = AMBER_API_URL
 
         self.headers = {
             "Authorization": f"Bearer {self.api_key}",
@@ -47,9 +114,29 @@ class AmberAPI:
         self.rate_limit_remaining = None
         self.seconds_till_rate_limit_reset = None
         self.data = None
+
+        self.budget = AmberRequestBudget()
+        self.forecast_intervals = 24
+        self.forecast_resolution = 30
+        # The last forecast response is kept on disk so restarts don't have to refetch it while it's still fresh
+        self.cache_path = cache_path
+        # The 30 minute forecast moves on at interval boundaries, so it's refetched when its first interval ends.
+        # forecast_refresh_interval (seconds) only caps how old it gets mid interval, it has to be longer than the 5 minute poll to save any requests
+        self.forecast_refresh_interval = forecast_refresh_interval
+        self.forecast_cache = self.load_cache()
+        self.forecast_requests_skipped = 0
+
+        # When a request fails the last good data is served (flagged stale) and the request is retried on a background timer
+        self.lock = threading.Lock()
+        self.retry_timer = None
+        self.retry_timestamp = 0
+        self.min_retry_delay = 10
+        self.max_retry_delay = 300
+        self.retry_delay = self.min_retry_delay
+        self.refreshed_in_background = False
     
     def send_request(self, url):
-        r = requests.get(url, headers=self.headers)
+        r = self.http.get(url, endpoint="amber", headers=self.headers)
         self.rate_limit_remaining = r.headers.get("RateLimit-Remaining")
         self.seconds_till_rate_limit_reset = r.headers.get("RateLimit-Reset")
         if(self.rate_limit_remaining != None):
@@ -60,22 +147,16 @@ class AmberAPI:
             self.seconds_till_rate_limit_reset = int(self.seconds_till_rate_limit_reset)
         else: 
             self.seconds_till_rate_limit_reset = 0
+        self.budget.update(self.rate_limit_remaining, self.seconds_till_rate_limit_reset)
 
         #print(f"Seconds till reset: {self.seconds_till_rate_limit_reset}")
 
         # Check for rate limiting
         if r.status_code == 429:
-
             if self.seconds_till_rate_limit_reset:
-                print(f"Exceeded Amber API request rate limit.")
-                print(f"Waiting {self.seconds_till_rate_limit_reset+5} seconds before retrying")
-                time.sleep(int(self.seconds_till_rate_limit_reset+5))
-            else:
-                print(r.headers)
-                print(f"Exceeded Amber API request rate limit.")
-                print(f"Waiting 30 seconds before retrying")
-                time.sleep(30)
-            return self.send_request(url)
+                raise AmberRateLimited(self.seconds_till_rate_limit_reset+5)
+            raise AmberRateLimited(30)
+        r.raise_for_status()
         
         return r.json()
 
@@ -93,33 +174,66 @@ class AmberAPI:
                 raise("Resolution must be 5 or 30 minutes not: "+str(resolution))
 
         url = (f"{self.base}/sites/{self.site_id}/prices/current?next={next_intervals}&previous=0&resolution={resolution}")
-
-        general_price_forecast = []
-        feed_in_price_forecast = []
-        date_format = "%Y-%m-%dT%H:%M:%SZ"
-
+        return self.parse_forecast(self.send_request(url))
+
+    def parse_forecast(self, response):
+        """[general, feed in] ForecastArrays from a prices response"""
+        forecasts = []
+        for channel, sign in [("general", 1), ("feedIn", -1)]:
+            intervals = [i for i in response if i["channelType"] == channel]
+            forecasts.append(ForecastArrays(
+                start=parse_timestamps([i["startTime"] for i in intervals]),
+                end=parse_timestamps([i["endTime"] for i in intervals]),
+                price=sign*np.array([i["perKwh"] for i in intervals], dtype=float)))
+        return forecasts
+
+    def load_cache(self):
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_cache(self):
+        temp_path = self.cache_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.forecast_cache, f)
+        os.replace(temp_path, self.cache_path) # Never leave a half written cache behind
+
+    def forecast_is_fresh(self):
+        """The cached forecast is still used if it's newer than forecast_refresh_interval and its first interval hasn't ended"""
+        if self.forecast_cache == None:
+            return False
+        now = time.time()
+        return now - self.forecast_cache["fetched"] < self.forecast_refresh_interval and now < self.forecast_cache["valid_until"]
+
+    def get_cached_forecast(self):
+        """Forecast from the cache while it's fresh, otherwise refetched if the rate limit budget allows it"""
+        if self.forecast_cache != None:
+            if self.forecast_is_fresh():
+                return self.parse_forecast(self.forecast_cache["response"])
+            if not self.budget.allow("forecast"): # Keep the remaining requests for current prices
+                self.forecast_requests_skipped += 1
+                return self.parse_forecast(self.forecast_cache["response"])
+
+        url = (f"{self.base}/sites/{self.site_id}/prices/current?next={self.forecast_intervals}&previous=0&resolution={self.forecast_resolution}")
         response = self.send_request(url)
-        if(len(response) >= 2):
-            for i in response:
-                start = datetime.strptime(i["startTime"], date_format) + UTC_OFFSET
-                end   = datetime.strptime(i["endTime"], date_format) + UTC_OFFSET
-
-                if i["channelType"] == "general":
-                    price = i["perKwh"]   
-                    interval = PriceForecast(price=price, start_time=start, end_time=end)
-                    general_price_forecast.append(interval)
-
-                elif i["channelType"] == "feedIn":
-                    price = -i["perKwh"]   
-                    interval = PriceForecast(price=price, start_time=start, end_time=end)
-                    feed_in_price_forecast.append(interval)
-
-        return [general_price_forecast, feed_in_price_forecast]
+        valid_until = time.time() + self.forecast_resolution*60
+        if(len(response) > 0):
+            valid_until = float(parse_timestamps([response[0]["endTime"]])[0])
+        self.forecast_cache = {"fetched": time.time(), "valid_until": valid_until, "response": response}
+        try:
+            self.save_cache()
+        except OSError as e:
+            print(f"Failed to save Amber forecast cache: {e}")
+        return self.parse_forecast(response)
     
     def get_current_prices(self):
         url = (f"{self.base}/sites/{self.site_id}/prices/current")
 
         response = self.send_request(url)
+        if(not {"general", "feedIn"} <= {i.get("channelType") for i in response}):
+            raise ValueError(f"Amber current prices response missing a channel: {response}")
         if(len(response) >= 2):
             for i in response:
                 if(i["channelType"] == "general"):
@@ -132,21 +246,82 @@ class AmberAPI:
         return [general_price, feed_in_price, estimate]
     
     def get_data(self, partial_update=False):
-        [general_price, feed_in_price, estimate] = self.get_current_prices()
-        
+        """Latest prices, or the last good prices flagged stale while Amber can't be reached"""
+        if not self.lock.acquire(blocking=False): # A background retry is running
+            return self.stale_data()
+        try:
+            data = self.pending_result()
+            if data != None:
+                return data
+            return self.fetch_data(partial_update)
+        except (AmberRateLimited, RequestException, ValueError) as e:
+            return self.handle_request_failure(e)
+        finally:
+            self.lock.release()
+
+    def fetch_data(self, partial_update=False):
+        current_prices = self.get_current_prices()
+        forecast = None
         if(self.data == None or partial_update == False):
-            [general_price_forecast, feed_in_price_forecast] = self.get_forecast(next_intervals=24, resolution=30)
+            forecast = self.get_cached_forecast()
+        return self.build_data(current_prices, forecast)
+
+    def pending_result(self): # Data to return without making a request: stale while a retry is scheduled, or fresh from a background retry
+        if self.retry_timer != None:
+            return self.stale_data()
+        if self.refreshed_in_background:
+            self.refreshed_in_background = False
+            return self.data
+        return None
+
+    def stale_data(self):
+        self.data.stale = True
+        return self.data
 
-            storted_general_forecast = feed_in_price_forecast.copy()
-            storted_general_forecast.sort(key=lambda x: x.price, reverse=True)
+    def handle_request_failure(self, error):
+        if self.data == None: # Nothing to fall back on yet
+            raise error
+        retry_after = self.schedule_retry(error)
+        print(f"Amber request failed ({error}), using prices from {round(self.data.age)} seconds ago. Retrying in {round(retry_after)} seconds")
+        return self.stale_data()
 
-            storted_feed_in_forecast = feed_in_price_forecast.copy()
-            storted_feed_in_forecast.sort(key=lambda x: x.price, reverse=True)
+    def schedule_retry(self, error):
+        if isinstance(error, AmberRateLimited):
+            retry_after = error.retry_after
+        else:
+            retry_after = self.retry_delay
+            self.retry_delay = min(self.retry_delay*2, self.max_retry_delay)
+        self.retry_timestamp = time.time() + retry_after
+        self.retry_timer = threading.Timer(retry_after, self.retry_in_background)
+        self.retry_timer.daemon = True
+        self.retry_timer.start()
+        return retry_after
+
+    def retry_in_background(self):
+        with self.lock:
+            try:
+                self.fetch_data()
+                self.retry_timer = None
+                self.retry_delay = self.min_retry_delay
+                self.refreshed_in_background = True
+                print("Amber prices updated after retrying")
+            except Exception as e: # Anything escaping would end the retries with retry_timer still set, leaving the prices stale for good
+                retry_after = self.schedule_retry(e)
+                print(f"Amber retry failed ({e}), retrying in {round(retry_after)} seconds")
+
+    def seconds_until_retry(self):
+        if self.retry_timer == None:
+            return 0
+        return max(self.retry_timestamp - time.time(), 0)
+
+    def build_data(self, current_prices, forecast=None): # forecast: get_forecast result, None to keep the last one
+        [general_price, feed_in_price, estimate] = current_prices
+        
+        if(forecast != None):
+            [general_forecast, feed_in_forecast] = forecast
         else:
-            general_price_forecast = self.data.general_12hr_forecast
-            feed_in_price_forecast = self.data.feedIn_12hr_forecast
-            storted_general_forecast = self.data.general_12hr_forecast_sorted
-            storted_feed_in_forecast = self.data.feedIn_12hr_forecast_sorted
+            general_forecast = self.data.general_forecast
+            feed_in_forecast = self.data.feedIn_forecast
             
         if(estimate and self.data != None): # if prices are an estimate, just pass the old not estimated prices through
             general_price = self.data.general_price
@@ -156,12 +331,11 @@ class AmberAPI:
             general_price=round(general_price),
             feedIn_price=round(feed_in_price),
             prices_estimated=estimate,
-            general_max_forecast_price=round(storted_general_forecast[0].price),
-            feedIn_max_forecast_price=round(storted_feed_in_forecast[0].price),
-            general_12hr_forecast=general_price_forecast,
-            feedIn_12hr_forecast=feed_in_price_forecast,
-            general_12hr_forecast_sorted=storted_general_forecast,
-            feedIn_12hr_forecast_sorted=storted_feed_in_forecast
+            general_max_forecast_price=round(general_forecast.max_price()),
+            feedIn_max_forecast_price=round(feed_in_forecast.max_price()),
+            general_forecast=general_forecast,
+            feedIn_forecast=feed_in_forecast,
+            fetched_timestamp=time.time()
             )
         return self.data
 
@@ -0,0 +1,66 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from requests import RequestException
+from amber_api import AmberRateLimited
+
+# One pool for all blocking API calls made from the event loop. The calls share the pooled
+# keep-alive session from http_session, so independent requests overlap instead of queueing.
+executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="api")
+
+async def run_blocking(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, lambda: func(*args, **kwargs))
+
+class AsyncHomeAssistantAPI:
+    """asyncio front end for HomeAssistantAPI, shares its cache, mirror and HTTP session."""
+    def __init__(self, ha):
+        self.ha = ha
+
+    async def get_state(self, entity_id):
+        return await run_blocking(self.ha.get_state, entity_id)
+
+    async def get_numeric_state(self, entity_id):
+        return await run_blocking(self.ha.get_numeric_state, entity_id)
+
+    async def get_states(self, entity_ids): # Fetch several entities concurrently, returns {entity_id: state}
+        states = await asyncio.gather(*[self.get_state(entity_id) for entity_id in entity_ids])
+        return dict(zip(entity_ids, states))
+
+    async def get_snapshot(self, entity_ids=None):
+        return await run_blocking(self.ha.get_snapshot, entity_ids)
+
+    async def call_service(self, domain, service, data):
+        return await run_blocking(self.ha.call_service, domain, service, data)
+
+    async def send_notification(self, title, msg, target):
+        return await run_blocking(self.ha.send_notification, title, msg, target)
+
+    async def get_history(self, entity_id, start_time=None, end_time=None):
+        return await run_blocking(self.ha.get_history, entity_id, start_time=start_time, end_time=end_time)
+
+    async def set_number(self, entity_id, value):
+        return await run_blocking(self.ha.set_number, entity_id, value)
+
+    async def set_select(self, entity_id, option):
+        return await run_blocking(self.ha.set_select, entity_id, option)
+
+class AsyncAmberAPI:
+    """asyncio front end for AmberAPI, the current prices and the forecast are fetched concurrently."""
+    def __init__(self, amber):
+        self.amber = amber
+
+    async def get_data(self, partial_update=False):
+        data = self.amber.pending_result()
+        if data != None:
+            return data
+        try:
+            if(self.amber.data == None or partial_update == False):
+                current_prices, forecast = await asyncio.gather(
+                    run_blocking(self.amber.get_current_prices),
+                    run_blocking(self.amber.get_cached_forecast))
+            else:
+                current_prices = await run_blocking(self.amber.get_current_prices)
+                forecast = None
+            return self.amber.build_data(current_prices, forecast)
+        except (AmberRateLimited, RequestException, ValueError) as e:
+            return self.amber.handle_request_failure(e)
@@ -0,0 +1,285 @@
+import sys
+import time
+import argparse
+import itertools
+import datetime
+import numpy as np
+from dataclasses import dataclass
+from ha_api import UTC_OFFSET
+from amber_api import ForecastArrays
+from load_profile import LoadProfileIndex, SLOT_MINUTES, SLOTS_PER_DAY
+from dispatch_planner import DispatchPlanner, MODES
+from energy_controller import hours_of_discharge_available, target_dispatch_price, threshold_working_mode, effective_price, planned_working_mode
+from PlantControl import kwh_required_with_buffer
+
+# Replays recorded load, solar and price series through the EnergyController decisions against a simulated battery
+# python backtest.py --synthetic 365 --buffer 10,20,30 --min-dispatch 5,10,15
+# python backtest.py --csv history.csv   (columns: timestamp,load_kw,pv_kw,feedIn_price,general_price at 5 minute steps)
+
+STEP_SECONDS = SLOT_MINUTES*60
+FORECAST_INTERVALS = 24 # Amber forecast the controller sees, 30 minute intervals
+FORECAST_INTERVAL_SECONDS = 30*60
+
+@dataclass
+class Series:
+    timestamps: np.ndarray # epoch seconds at the start of each step, STEP_SECONDS apart
+    load: np.ndarray # kWh used in each step
+    solar: np.ndarray # kWh generated in each step
+    feedIn_price: np.ndarray # c/kWh earned exporting (negative costs)
+    general_price: np.ndarray # c/kWh importing
+
+def resample(timestamps, values, grid, hold=False):
+    """Values on grid from irregular samples, linearly interpolated or held from the last sample (prices)"""
+    valid = ~np.isnan(values)
+    timestamps = timestamps[valid]
+    values = values[valid]
+    if(hold):
+        return values[np.clip(np.searchsorted(timestamps, grid, side="right")-1, 0, len(values)-1)]
+    return np.interp(grid, timestamps, values)
+
+def series_from_history(store, start_time, end_time, feedIn_entity, general_entity, load_entity="sensor.sigen_plant_consumed_power", pv_entity="sensor.sigen_plant_pv_power"):
+    """Series from a HistoryStore, load and pv entities in kW, price entities in c/kWh"""
+    grid = np.arange(start_time.timestamp(), end_time.timestamp(), STEP_SECONDS, dtype=float)
+    arrays = {entity: store.get_arrays(entity, start_time, end_time) for entity in [load_entity, pv_entity, feedIn_entity, general_entity]}
+    return Series(
+        timestamps=grid,
+        load=resample(*arrays[load_entity], grid) * STEP_SECONDS/3600,
+        solar=np.maximum(resample(*arrays[pv_entity], grid), 0) * STEP_SECONDS/3600,
+        feedIn_price=resample(*arrays[feedIn_entity], grid, hold=True),
+        general_price=resample(*arrays[general_entity], grid, hold=True))
+
+def series_from_csv(path):
+    data = np.genfromtxt(path, delimiter=",", names=True, dtype=float)
+    return Series(
+        timestamps=data["timestamp"],
+        load=data["load_kw"] * STEP_SECONDS/3600,
+        solar=np.maximum(data["pv_kw"], 0) * STEP_SECONDS/3600,
+        feedIn_price=data["feedIn_price"],
+        general_price=data["general_price"])
+
+def synthetic_series(days, seed=0):
+    """Plausible days of load, solar and prices for benchmarking the engine"""
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc) - UTC_OFFSET # local midnight
+    timestamps = start.timestamp() + np.arange(days*SLOTS_PER_DAY, dtype=float)*STEP_SECONDS
+    hour = ((timestamps + UTC_OFFSET.total_seconds()) % 86400) / 3600
+    day = np.arange(len(timestamps)) // SLOTS_PER_DAY
+    cloud = rng.uniform(0.3, 1, days)[day]
+    solar_kw = np.clip(np.sin(np.pi*(hour - 6)/12), 0, None) * 13 * cloud
+    load_kw = 0.5 + 1.8*np.exp(-((hour - 18.5)**2)/3) + 0.8*np.exp(-((hour - 7.5)**2)/1) + 0.3*rng.random(len(timestamps))
+    spike = rng.random(days) < 0.15 # Evening price spikes on some days
+    feedIn = 4 + 25*np.exp(-((hour - 18.5)**2)/1.5) - 10*np.clip(np.sin(np.pi*(hour - 8)/8), 0, None) + spike[day]*250*np.exp(-((hour - 18)**2)/0.3)
+    general = 22 + 30*np.exp(-((hour - 18.5)**2)/2) - 12*np.clip(np.sin(np.pi*(hour - 8)/8), 0, None) + spike[day]*260*np.exp(-((hour - 18)**2)/0.3)
+    return Series(timestamps, load_kw*STEP_SECONDS/3600, solar_kw*STEP_SECONDS/3600, feedIn + rng.normal(0, 1, len(timestamps)), general + rng.normal(0, 1, len(timestamps)))
+
+class SimulatedPlant:
+    """Battery model with the same limits as Plant. soc is kWh above the backup buffer, capacity the kWh from there to the charge cut off.
+    The energy flows of each working mode match DispatchPlanner.interval_flows.
+    """
+    def __init__(self, capacity=28, initial_soc=14, max_charge_power=21, max_discharge_power=24, max_export_power=15, efficiency=0.95):
+        self.capacity = capacity
+        self.initial_soc = initial_soc
+        self.max_charge_power = max_charge_power
+        self.max_discharge_power = max_discharge_power
+        self.max_export_power = max_export_power
+        self.efficiency = efficiency
+
+    def step(self, mode, soc, load, solar, hours):
+        """(next soc, kWh exported, kWh imported) after running mode for hours"""
+        eff = self.efficiency
+        room = (self.capacity - soc) / eff
+        deliverable = soc * eff
+        export_limit = self.max_export_power*hours
+        if(mode == "Dispatching"):
+            discharge = max(min(self.max_discharge_power*hours, deliverable, export_limit + load - solar), 0)
+            supply = solar + discharge
+            return soc - discharge/eff, min(max(supply - load, 0), export_limit), max(load - supply, 0)
+        exported = 0
+        if(mode == "Exporting All Solar"):
+            exported = min(solar, export_limit)
+        net = solar - exported - load
+        if(net >= 0):
+            charge = min(net, self.max_charge_power*hours, room)
+            if(mode == "Exporting Excess Solar"):
+                exported = min(net - charge, export_limit)
+            return soc + charge*eff, exported, 0
+        discharge = min(-net, self.max_discharge_power*hours, deliverable)
+        return soc - discharge/eff, exported, -net - discharge
+
+def average_load_index(series):
+    """LoadProfileIndex of the series' average day, standing in for Plant.get_load_avg"""
+    slot = (((series.timestamps + UTC_OFFSET.total_seconds()) % 86400) // STEP_SECONDS).astype(np.int64)
+    per_slot = np.bincount(slot, weights=series.load, minlength=SLOTS_PER_DAY) / np.maximum(np.bincount(slot, minlength=SLOTS_PER_DAY), 1)
+    return LoadProfileIndex(np.cumsum(per_slot))
+
+def half_hour_prices(series):
+    """Mean feed in and general price of each 30 minute interval, and the interval of every step"""
+    first_start = series.timestamps[0] - (series.timestamps[0] % FORECAST_INTERVAL_SECONDS)
+    interval = ((series.timestamps - first_start) // FORECAST_INTERVAL_SECONDS).astype(np.int64)
+    counts = np.bincount(interval)
+    feed_in = np.bincount(interval, weights=series.feedIn_price) / np.maximum(counts, 1)
+    general = np.bincount(interval, weights=series.general_price) / np.maximum(counts, 1)
+    return feed_in, general, interval, first_start
+
+class Backtest:
+    """Everything about the series that doesn't depend on the battery is worked out once with NumPy,
+    leaving a plain Python loop over the steps for the decisions and the battery model.
+    Forecasts are perfect: the Amber forecast is the recorded price and Solcast the recorded solar.
+    """
+    def __init__(self, series, plant=None):
+        self.series = series
+        self.plant = plant or SimulatedPlant()
+        local_seconds = (series.timestamps + UTC_OFFSET.total_seconds()) % 86400
+        index = average_load_index(series)
+        self.load_index = index
+        self.load_till_morning = index.kwh_between_arrays(local_seconds, np.full(len(local_seconds), 6*3600.0))
+        self.load_till_evening = index.kwh_between_arrays(local_seconds, np.full(len(local_seconds), 18*3600.0))
+
+        # Solcast remaining today: solar from this step to the end of the local day
+        day = ((series.timestamps + UTC_OFFSET.total_seconds()) // 86400).astype(np.int64)
+        day_start = np.flatnonzero(np.diff(day, prepend=day[0]-1))
+        day_total = np.add.reduceat(series.solar, day_start)
+        cumulative = np.cumsum(series.solar)
+        day_index = np.cumsum(np.diff(day, prepend=day[0]) != 0)
+        self.solar_remaining_today = (cumulative[day_start] - series.solar[day_start] + day_total)[day_index] - cumulative + series.solar
+
+        # Solar daytime: the hour's solar beats the base load (20th percentile of load)
+        base_load = np.percentile(series.load, 20)
+        hour_solar = np.convolve(series.solar, np.ones(12), mode="full")[11:] # this step and the next 55 minutes
+        self.solar_daytime = hour_solar/12 > base_load
+
+        # Sorted 12 hour feed in forecast seen at every step, for the k-th highest price lookup
+        feed_in, general, interval, first_start = half_hour_prices(series)
+        self.half_hour_feedIn = feed_in
+        self.half_hour_general = general
+        self.first_interval_start = first_start
+        padded = np.concatenate([feed_in, np.full(FORECAST_INTERVALS-1, -np.inf)])
+        windows = np.lib.stride_tricks.sliding_window_view(padded, FORECAST_INTERVALS)
+        self.sorted_forecast = -np.sort(-windows, axis=1)
+        self.interval = interval
+
+    def run(self, buffer_percentage=20, minimum_dispatch_price=10, target_price_reduction_percentage=100, policy="thresholds", planner=None):
+        """policy: "thresholds" for EnergyController's price thresholds, "planner" to follow a DispatchPlanner replanned every step with the current price, like EnergyController's replan_interval"""
+        started = time.perf_counter()
+        plant = self.plant
+        hours = STEP_SECONDS/3600
+        load = self.series.load.tolist()
+        solar = self.series.solar.tolist()
+        feed_in = self.series.feedIn_price.tolist()
+        general = self.series.general_price.tolist()
+        timestamps = self.series.timestamps.tolist()
+        required = [kwh_required_with_buffer(kwh, buffer_percentage) for kwh in self.load_till_morning.tolist()]
+        solar_remaining = self.solar_remaining_today.tolist()
+        daytime = self.solar_daytime.tolist()
+        load_till_evening = self.load_till_evening.tolist()
+        interval = self.interval.tolist()
+        sorted_forecast = self.sorted_forecast.tolist()
+        if(policy == "planner"):
+            planner = planner or DispatchPlanner(plant.max_charge_power, plant.max_discharge_power, plant.max_export_power, efficiency=plant.efficiency, time_budget=1)
+
+        soc = plant.initial_soc
+        revenue = exported_kwh = imported_kwh = discharged_kwh = 0
+        effective_total = effective_load_weighted = 0
+        mode_changes = 0
+        mode_steps = dict.fromkeys(MODES, 0)
+        mode = "Self Consumption"
+        for t in range(len(load)):
+            hours_available = hours_of_discharge_available(soc, required[t], plant.max_export_power)
+            forecast = sorted_forecast[interval[t]]
+            target = target_dispatch_price(forecast[min(round(hours_available*2), FORECAST_INTERVALS-1)], target_price_reduction_percentage, minimum_dispatch_price)
+
+            if(policy == "planner"):
+                plan = self.plan(planner, t, soc, minimum_dispatch_price, required[t])
+                planned_mode = plan.modes[0] if plan != None else "Self Consumption"
+                new_mode = planned_working_mode(planned_mode, soc, required[t])
+            else:
+                new_mode = threshold_working_mode(feed_in[t], target, soc, required[t], solar_remaining[t], plant.capacity - soc, daytime[t])
+            if(new_mode != mode):
+                mode_changes += 1
+                mode = new_mode
+            mode_steps[mode] += 1
+
+            price = effective_price(general[t], feed_in[t], target, solar_remaining[t], required[t], daytime[t], soc, plant.capacity - soc, load_till_evening[t])
+            effective_total += price
+            effective_load_weighted += price*load[t]
+
+            next_soc, exported, imported = plant.step(mode, soc, load[t], solar[t], hours)
+            discharged_kwh += max(soc - next_soc, 0)
+            soc = next_soc
+            revenue += exported*feed_in[t] - imported*general[t]
+            exported_kwh += exported
+            imported_kwh += imported
+
+        steps = max(len(load), 1)
+        return {
+            "policy": policy,
+            "buffer_percentage": buffer_percentage,
+            "minimum_dispatch_price": minimum_dispatch_price,
+            "target_price_reduction_percentage": target_price_reduction_percentage,
+            "revenue": revenue/100, # $
+            "exported_kwh": exported_kwh,
+            "imported_kwh": imported_kwh,
+            "cycles": discharged_kwh/plant.capacity,
+            "mode_changes": mode_changes,
+            "mode_share": {m: n/steps for m, n in mode_steps.items()},
+            "mean_effective_price": effective_total/steps,
+            "load_weighted_effective_price": effective_load_weighted/max(sum(load), 1e-9),
+            "days": steps*hours/24,
+            "seconds": time.perf_counter() - started,
+        }
+
+    def plan(self, planner, t, soc, minimum_dispatch_price, reserve_kwh):
+        first = self.interval[t]
+        count = min(FORECAST_INTERVALS, len(self.half_hour_feedIn) - first)
+        start = self.first_interval_start + (first + np.arange(count))*FORECAST_INTERVAL_SECONDS
+        end = start + FORECAST_INTERVAL_SECONDS
+        feed_in = ForecastArrays(start, end, self.half_hour_feedIn[first:first+count])
+        general = ForecastArrays(start, end, self.half_hour_general[first:first+count])
+        now = self.series.timestamps[t]
+        return planner.plan(feed_in, general, self.load_index, self.solar_remaining_today[t], soc, self.plant.capacity, now=now,
+                            feedIn_price=self.series.feedIn_price[t], general_price=self.series.general_price[t], min_dispatch_price=minimum_dispatch_price, reserve_kwh=reserve_kwh)
+
+def print_result(result):
+    modes = ", ".join(f"{mode} {share*100:.0f}%" for mode, share in result["mode_share"].items())
+    print(f"{result['policy']:>10} buffer {result['buffer_percentage']:>3g}% min dispatch {result['minimum_dispatch_price']:>3g} c reduction {result['target_price_reduction_percentage']:>3g}%  "
+          f"revenue ${result['revenue']:9.2f}  export {result['exported_kwh']:8.0f} kWh  import {result['imported_kwh']:7.0f} kWh  "
+          f"cycles {result['cycles']:6.1f}  mode changes {result['mode_changes']:5d}  effective price {result['load_weighted_effective_price']:5.1f} c/kWh  "
+          f"({result['days']:.0f} days in {result['seconds']:.2f} s)")
+    print(f"{'':>10} {modes}")
+
+def planner_beats_thresholds(thresholds, planner):
+    """The planner is only worth enabling if it earns more than the thresholds without buying more from the grid"""
+    return planner["revenue"] > thresholds["revenue"] and planner["imported_kwh"] <= thresholds["imported_kwh"] + 1e-6
+
+def parse_list(text):
+    return [float(v) for v in text.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backtest the energy controller on recorded or synthetic data")
+    parser.add_argument("--csv", help="5 minute series with columns timestamp,load_kw,pv_kw,feedIn_price,general_price")
+    parser.add_argument("--synthetic", type=int, default=365, help="days of synthetic data when no csv is given")
+    parser.add_argument("--buffer", type=parse_list, default=[20], help="buffer_percentage_remaining values, comma separated")
+    parser.add_argument("--min-dispatch", type=parse_list, default=[10], help="MINIMUM_BATTERY_DISPATCH_PRICE values")
+    parser.add_argument("--reduction", type=parse_list, default=[100], help="target_price_reduction_percentage values")
+    parser.add_argument("--planner", action="store_true", help="also backtest the dispatch planner (much slower)")
+    parser.add_argument("--check-planner", action="store_true", help="exit with an error unless the planner beats the thresholds (run before enabling use_planner)")
+    parser.add_argument("--capacity", type=float, default=28, help="usable battery kWh above the backup buffer")
+    args = parser.parse_args()
+
+    series = series_from_csv(args.csv) if args.csv else synthetic_series(args.synthetic)
+    t = time.perf_counter()
+    backtest = Backtest(series, SimulatedPlant(capacity=args.capacity, initial_soc=args.capacity/2))
+    print(f"Precomputed {len(series.timestamps)} steps in {time.perf_counter() - t:.2f} s")
+    for buffer, min_dispatch, reduction in itertools.product(args.buffer, args.min_dispatch, args.reduction):
+        result = backtest.run(buffer, min_dispatch, reduction)
+        print_result(result)
+        if((buffer, min_dispatch, reduction) == (args.buffer[0], args.min_dispatch[0], args.reduction[0])):
+            thresholds = result
+    if(args.planner or args.check_planner):
+        planner = backtest.run(args.buffer[0], args.min_dispatch[0], args.reduction[0], policy="planner")
+        print_result(planner)
+        if(args.check_planner):
+            if(not planner_beats_thresholds(thresholds, planner)):
+                print(f"Planner earned ${planner['revenue']:.2f} importing {planner['imported_kwh']:.0f} kWh, thresholds earned ${thresholds['revenue']:.2f} importing {thresholds['imported_kwh']:.0f} kWh")
+                sys.exit(1)
+            print(f"Planner beats the thresholds by ${planner['revenue'] - thresholds['revenue']:.2f}")
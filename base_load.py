@@ -0,0 +1,66 @@
+import math
+import threading
+import numpy as np
+
+# Base load estimated from the live load power samples, so it follows seasonal changes without downloading days of history
+
+class DecayingQuantile:
+    """Quantile of a stream of samples where a sample's weight halves every half_life seconds.
+    Samples go into fixed bins of bin_width between 0 and max_value, so memory doesn't grow with the window.
+    Each sample is weighted by the seconds since the previous one so bursts of event triggered ticks don't skew it,
+    gaps longer than max_sample_gap (eg. the process was stopped) only count as max_sample_gap.
+    """
+    def __init__(self, quantile=0.2, half_life=24*60*60, bin_width=0.02, max_value=20, max_sample_gap=5*60, warm_seconds=24*60*60):
+        self.quantile = quantile
+        self.half_life = half_life
+        self.bin_width = bin_width # Units of the samples, kW for load power
+        self.max_sample_gap = max_sample_gap
+        self.warm_seconds = warm_seconds # Seconds of samples needed before value() is trusted, a full day covers the daily cycle
+        # The decayed weight warm_seconds of back to back samples add up to, the sum levels off at half_life/ln 2 so it can't just be warm_seconds
+        self.warm_weight = half_life/math.log(2) * (1 - 0.5 ** (warm_seconds/half_life))
+        self.weights = np.zeros(int(math.ceil(max_value/bin_width)))
+        self.last_sample_timestamp = None
+        self.lock = threading.Lock()
+
+    def add(self, value, timestamp): # timestamp: epoch seconds
+        if(value == None or not math.isfinite(value)):
+            return
+        with self.lock:
+            if(self.last_sample_timestamp == None):
+                self.last_sample_timestamp = timestamp # Nothing to weight the first sample by
+                return
+            elapsed = max(timestamp - self.last_sample_timestamp, 0)
+            self.last_sample_timestamp = max(timestamp, self.last_sample_timestamp)
+            if(elapsed == 0):
+                return
+            self.weights *= 0.5 ** (elapsed/self.half_life)
+            index = min(max(int(value/self.bin_width), 0), len(self.weights)-1)
+            self.weights[index] += min(elapsed, self.max_sample_gap)
+
+    @property
+    def warm(self):
+        return self.weights.sum() >= self.warm_weight - 1e-6
+
+    def value(self):
+        """The decayed quantile, interpolated within its bin. None before the first weighted sample"""
+        with self.lock:
+            cumulative = np.cumsum(self.weights)
+        if(cumulative[-1] <= 0):
+            return None
+        target = self.quantile * cumulative[-1]
+        index = int(np.searchsorted(cumulative, target))
+        below = cumulative[index-1] if index > 0 else 0
+        fraction = (target - below) / (cumulative[index] - below)
+        return float((index + fraction) * self.bin_width)
+
+    def state(self): # (weights, last_sample_timestamp) for saving
+        with self.lock:
+            return self.weights.copy(), self.last_sample_timestamp
+
+    def restore(self, weights, last_sample_timestamp):
+        if(len(weights) != len(self.weights)):
+            print(f"Ignoring saved base load estimator with {len(weights)} bins, expected {len(self.weights)}")
+            return
+        with self.lock:
+            self.weights = np.array(weights, dtype=float)
+            self.last_sample_timestamp = last_sample_timestamp
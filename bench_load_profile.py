@@ -0,0 +1,97 @@
+import time
+import datetime
+import numpy as np
+from ha_api import History, UTC_OFFSET
+from PlantControl import StateClass, HA_TZ
+from load_profile import build_load_profile
+
+# Compares the NumPy load profile builder against the loop based Plant.update_load_avg it replaced
+# python bench_load_profile.py
+
+SAMPLE_SECONDS = 30 # How often the synthetic daily consumption sensor updates
+
+def synthetic_history(days):
+    """Daily cumulative kWh that resets at local midnight, sampled every SAMPLE_SECONDS, starting at a local midnight"""
+    start = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc) - UTC_OFFSET
+    timestamps = start.timestamp() + np.arange(0, days*86400, SAMPLE_SECONDS, dtype=float)
+    seconds_of_day = (timestamps + UTC_OFFSET.total_seconds()) % 86400
+    rng = np.random.default_rng(0)
+    kw = 0.6 + 1.5*np.exp(-((seconds_of_day/3600 - 18)**2) / 4) + 0.2*rng.random(len(timestamps))
+    kwh = kw * SAMPLE_SECONDS / 3600
+    day = ((timestamps + UTC_OFFSET.total_seconds()) // 86400).astype(np.int64)
+    cumulative = np.cumsum(kwh)
+    day_start = np.searchsorted(day, day) # first sample of each sample's day
+    values = cumulative - cumulative[day_start] + kwh[day_start]
+    return timestamps, values
+
+def legacy_load_avg(history, start_date): # Body of the old Plant.update_load_avg after the history download
+    day = 0
+    history_days = [[]]
+    for hist in history:
+        if(hist.time.date() == start_date + datetime.timedelta(days=day)):
+            history_days[day].append(hist)
+        elif(hist.time.date() == start_date + datetime.timedelta(days=day+1)):
+            day = day + 1
+            history_days.append([])
+            history_days[day].append(hist)
+
+    for day in history_days:
+        while(day[0].state > 0.05):
+            day.pop(0)
+
+    avg_day = []
+    dt = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
+    time_bucket_size = 5
+    for i in range(int((24*60)/time_bucket_size)):
+        avg_day.append(StateClass(state=None, states=[], time=dt.time()))
+        dt = dt + datetime.timedelta(minutes=time_bucket_size)
+
+    for day in history_days:
+        i = 0
+        bin_avg = []
+        for state in day:
+            state.time = state.time.replace(
+                minute=(state.time.minute // time_bucket_size) * time_bucket_size,
+                second=0,
+                microsecond=0,
+                tzinfo=HA_TZ
+                )
+            if(state.time.time() != avg_day[i].time):
+                if(i < len(avg_day)-1):
+                    if(state.time.time() == avg_day[i+1].time):
+                        avg_day[i].states.append(sum(bin_avg) / len(bin_avg))
+                        bin_avg = []
+                        i = i + 1
+            if(state.time.time() == avg_day[i].time):
+                if(state.state != None):
+                    bin_avg.append(state.state)
+        if(len(bin_avg) > 0):
+            avg_day[i].states.append(sum(bin_avg) / len(bin_avg))
+
+    for interval in avg_day:
+        interval.state = round(sum(interval.states) / len(interval.states), 2)
+    return avg_day
+
+def bench(days):
+    timestamps, values = synthetic_history(days)
+    history = [
+        History(state=float(v), time=datetime.datetime.fromtimestamp(t, datetime.timezone.utc) + UTC_OFFSET)
+        for t, v in zip(timestamps, values)
+    ]
+    start_date = history[0].time.date()
+
+    t = time.perf_counter()
+    legacy = legacy_load_avg(history, start_date)
+    legacy_time = time.perf_counter() - t
+
+    t = time.perf_counter()
+    profile, _ = build_load_profile(timestamps, values)
+    numpy_time = time.perf_counter() - t
+
+    difference = np.max(np.abs(np.array([s.state for s in legacy]) - np.round(profile, 2)))
+    print(f"{days:>4} days {len(timestamps):>8} samples  loops: {legacy_time*1000:9.1f} ms  numpy: {numpy_time*1000:7.1f} ms  "
+          f"speedup: {legacy_time/numpy_time:6.1f}x  max difference: {difference:.2f} kWh")
+
+if __name__ == "__main__":
+    for days in [3, 30, 365]:
+        bench(days)
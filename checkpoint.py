@@ -0,0 +1,103 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+from dataclasses import dataclass
+from history_store import DATA_DIR
+from amber_api import amber_data, ForecastArrays
+
+# The derived models and last decision, saved so a restart can make its first decision straight away
+# and rebuild the models from history in the background instead of before it.
+
+CHECKPOINT_VERSION = 2
+DEFAULT_CHECKPOINT_PATH = os.path.join(DATA_DIR, "checkpoint.npz")
+save_lock = threading.Lock() # Saved from the scheduler and the model rebuild thread
+
+@dataclass
+class Checkpoint:
+    saved: float
+    load_profile_mean: np.ndarray # Plant.load_profile's kWh per slot, None if there wasn't one
+    load_profile_variance: np.ndarray
+    load_profile_counts: np.ndarray
+    load_profile_timestamp: float
+    base_load_estimate: float # kW
+    base_load_timestamp: float
+    base_load_weights: np.ndarray # Plant.base_load's bins, None if there weren't any
+    base_load_sample_timestamp: float
+    amber_data: amber_data # Marked stale, it's only used if Amber can't be reached
+    working_mode: str
+
+    @property
+    def age(self):
+        return time.time() - self.saved
+
+def forecast_arrays(arrays, prefix):
+    return {f"{prefix}_start": arrays.start, f"{prefix}_end": arrays.end, f"{prefix}_price": arrays.price}
+
+def save_checkpoint(plant, amber_data, working_mode, path=DEFAULT_CHECKPOINT_PATH):
+    models = plant.models # Read once, a rebuild may swap them
+    meta = {
+        "version": CHECKPOINT_VERSION,
+        "saved": time.time(),
+        "load_profile_timestamp": models.built if models != None else 0,
+        "base_load_estimate": models.base_load_estimate if models != None else None,
+        "base_load_timestamp": models.built if models != None else 0,
+        "base_load_sample_timestamp": None,
+        "working_mode": working_mode,
+        "amber": None,
+    }
+    arrays = {}
+    arrays["base_load_weights"], meta["base_load_sample_timestamp"] = plant.base_load.state()
+    if(plant.load_profile.ready):
+        arrays["load_profile_mean"], arrays["load_profile_variance"], arrays["load_profile_counts"] = plant.load_profile.state()
+    if(amber_data != None):
+        meta["amber"] = {
+            "general_price": amber_data.general_price,
+            "feedIn_price": amber_data.feedIn_price,
+            "prices_estimated": amber_data.prices_estimated,
+            "general_max_forecast_price": amber_data.general_max_forecast_price,
+            "feedIn_max_forecast_price": amber_data.feedIn_max_forecast_price,
+            "fetched_timestamp": amber_data.fetched_timestamp,
+        }
+        arrays.update(forecast_arrays(amber_data.general_forecast, "general"))
+        arrays.update(forecast_arrays(amber_data.feedIn_forecast, "feedIn"))
+
+    temp_path = path + ".tmp.npz" # np.savez adds .npz to names without it
+    with save_lock:
+        with open(temp_path, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(temp_path, path) # Never leave a half written checkpoint behind
+
+def load_checkpoint(path=DEFAULT_CHECKPOINT_PATH):
+    """The saved Checkpoint, or None if there isn't a usable one"""
+    try:
+        with np.load(path, allow_pickle=False) as f:
+            meta = json.loads(str(f["meta"]))
+            if(meta.get("version") != CHECKPOINT_VERSION):
+                print(f"Ignoring checkpoint version {meta.get('version')}, expected {CHECKPOINT_VERSION}")
+                return None
+            saved_amber = None
+            if(meta["amber"] != None):
+                saved_amber = amber_data(
+                    general_forecast=ForecastArrays(f["general_start"], f["general_end"], f["general_price"]),
+                    feedIn_forecast=ForecastArrays(f["feedIn_start"], f["feedIn_end"], f["feedIn_price"]),
+                    stale=True,
+                    **meta["amber"])
+            return Checkpoint(
+                saved=meta["saved"],
+                load_profile_mean=f["load_profile_mean"] if "load_profile_mean" in f else None,
+                load_profile_variance=f["load_profile_variance"] if "load_profile_variance" in f else None,
+                load_profile_counts=f["load_profile_counts"] if "load_profile_counts" in f else None,
+                load_profile_timestamp=meta["load_profile_timestamp"],
+                base_load_estimate=meta["base_load_estimate"],
+                base_load_timestamp=meta["base_load_timestamp"],
+                base_load_weights=f["base_load_weights"] if "base_load_weights" in f else None,
+                base_load_sample_timestamp=meta.get("base_load_sample_timestamp"),
+                amber_data=saved_amber,
+                working_mode=meta["working_mode"])
+    except FileNotFoundError:
+        return None
+    except Exception as e: # Corrupt or from an incompatible version, start cold
+        print(f"Couldn't load checkpoint {path}: {e}")
+        return None
@@ -0,0 +1,78 @@
+import time
+
+class ControlReconciler:
+    """Keeps the plant's control mode and limits at their desired values without blocking the control loop.
+    A shadow of the last commanded value for each entity means only setpoints that differ are written.
+    A write is confirmed when a later state read (snapshot or websocket mirror) shows the new value,
+    anything that hasn't taken effect after confirm_timeout seconds is sent again, up to max_retries times.
+    After that the write is given up on (and on_give_up called) until the desired value changes or the plant reports it.
+    """
+    def __init__(self, confirm_timeout=10, max_retries=3, on_give_up=None):
+        self.confirm_timeout = confirm_timeout
+        self.max_retries = max_retries
+        self.on_give_up = on_give_up # on_give_up(entity_id, value, current)
+        self.given_up = {} # entity_id -> value it couldn't be set to
+        self.desired = {} # entity_id -> value
+        self.commanded = {} # entity_id -> {"value", "timestamp", "attempts"} for writes not yet confirmed
+        self.confirmed = {} # entity_id -> value last seen matching what was desired
+
+    def set_desired(self, targets):
+        self.desired = dict(targets)
+        for entity_id, value in list(self.given_up.items()):
+            if self.desired.get(entity_id) != value: # Target moved on, try again if it comes back
+                self.given_up.pop(entity_id)
+
+    def matches(self, current, value):
+        if isinstance(value, str):
+            return current == value
+        try:
+            return float(current) == float(value)
+        except (TypeError, ValueError): # unavailable/unknown
+            return False
+
+    def reconcile(self, snapshot):
+        """Returns the [(entity_id, value)] writes needed to bring the plant to the desired state, in the order given to set_desired."""
+        now = time.time()
+        writes = []
+        for entity_id, value in self.desired.items():
+            try:
+                current = snapshot.get_state(entity_id)["state"]
+            except Exception:
+                current = None
+
+            if self.matches(current, value):
+                self.confirmed[entity_id] = value
+                self.commanded.pop(entity_id, None)
+                self.given_up.pop(entity_id, None)
+                continue
+            if self.given_up.get(entity_id) == value:
+                continue
+
+            pending = self.commanded.get(entity_id)
+            if pending != None and pending["value"] == value:
+                if now - pending["timestamp"] < self.confirm_timeout: # Sent, waiting for HA to report the new value
+                    continue
+                if pending["attempts"] >= self.max_retries:
+                    self.give_up(entity_id, value, current, pending["attempts"])
+                    continue
+            writes.append((entity_id, value))
+        return writes
+
+    def give_up(self, entity_id, value, current, attempts):
+        print(f"{entity_id} still {current} after {attempts} attempts to set it to {value}, giving up until the target changes")
+        self.given_up[entity_id] = value
+        self.commanded.pop(entity_id, None)
+        if self.on_give_up != None:
+            try:
+                self.on_give_up(entity_id, value, current)
+            except Exception as e:
+                print(f"Failed to report {entity_id} not taking {value}: {e}")
+
+    def mark_commanded(self, entity_id, value):
+        pending = self.commanded.get(entity_id)
+        attempts = pending["attempts"] + 1 if pending != None and pending["value"] == value else 1
+        self.commanded[entity_id] = {"value": value, "timestamp": time.time(), "attempts": attempts}
+        self.confirmed.pop(entity_id, None)
+
+    def pending_writes(self):
+        return {entity_id: pending["value"] for entity_id, pending in self.commanded.items()}
@@ -0,0 +1,204 @@
+import time
+import numpy as np
+from dataclasses import dataclass
+from ha_api import UTC_OFFSET
+
+MODES = ["Self Consumption", "Exporting Excess Solar", "Exporting All Solar", "Dispatching"] # In order of preference when they're worth the same
+
+@dataclass
+class DispatchPlan:
+    start: np.ndarray # epoch seconds of each interval
+    end: np.ndarray
+    modes: list # working mode for each interval
+    soc: np.ndarray # planned kWh above the backup buffer at the start of each interval
+    value: float # export revenue minus import cost over the horizon in cents, including the value of the energy left at the end
+    solve_time: float # seconds
+    created: float # epoch seconds
+
+    def mode_at(self, timestamp):
+        """Working mode planned for the interval containing timestamp, None if it's outside the plan"""
+        i = int(np.searchsorted(self.end, timestamp, side="right"))
+        if(i >= len(self.modes) or timestamp < self.start[0]):
+            return None
+        return self.modes[i]
+
+def spread_solar(start, end, kwh_remaining_today, now, sunrise_hour=6, sunset_hour=18, utc_offset=UTC_OFFSET):
+    """Solcast only reports the kWh remaining today, spread it over today's remaining intervals following a half sine between sunrise and sunset.
+    Solar after today isn't counted.
+    """
+    offset = utc_offset.total_seconds()
+    start = np.maximum(start, now)
+    mid_hour = (((start + end)/2 + offset) % 86400) / 3600
+    today = (start + offset)//86400 == (now + offset)//86400
+    weight = np.clip(np.sin(np.pi*(mid_hour - sunrise_hour)/(sunset_hour - sunrise_hour)), 0, None) * np.maximum(end - start, 0) * today
+    if(weight.sum() <= 0):
+        return np.zeros(len(start))
+    return kwh_remaining_today * weight / weight.sum()
+
+class DispatchPlanner:
+    """Chooses a working mode for every interval of the Amber forecast by dynamic programming over a grid of battery states of charge.
+    The value of each mode is export revenue minus import cost at the forecast prices, with the load taken from the average load day
+    and solar from Solcast. Energy left in the battery at the end of the horizon is valued by terminal_value.
+    With a reserve_kwh, dispatching or exporting all solar is never planned below the reserve still needed before reserve_hour.
+    Gives up and returns None if solving takes longer than time_budget seconds, so the caller can fall back to simpler logic.
+    """
+    def __init__(self, max_charge_power, max_discharge_power, max_export_power, efficiency=0.95, soc_step=0.25, max_levels=121, time_budget=0.05, sunrise_hour=6, sunset_hour=18, reserve_hour=6):
+        self.max_charge_power = max_charge_power # kW
+        self.max_discharge_power = max_discharge_power
+        self.max_export_power = max_export_power
+        self.efficiency = efficiency # One way, applied to both charging and discharging
+        self.soc_step = soc_step # kWh between SOC grid levels
+        self.max_levels = max_levels
+        self.time_budget = time_budget
+        self.sunrise_hour = sunrise_hour
+        self.sunset_hour = sunset_hour
+        self.reserve_hour = reserve_hour # Local hour the reserve passed to plan() has to last until
+
+    def interval_flows(self, soc, load, solar, hours, capacity, floor=None):
+        """Grid export, grid import (kWh) and the next SOC for each mode at every interval and SOC level, each shaped (intervals, modes, levels).
+        floor: kWh per interval that dispatching stops at (the controller drops out of dispatching once it reaches the reserve)
+        """
+        s = soc[None, None, :]
+        L = load[:, None, None]
+        S = solar[:, None, None]
+        h = hours[:, None, None]
+        eff = self.efficiency
+        room = (capacity - s) / eff # AC kWh that fills the battery
+        deliverable = s * eff # AC kWh the battery can supply
+        charge_limit = self.max_charge_power * h
+        discharge_limit = self.max_discharge_power * h
+        export_limit = self.max_export_power * h
+
+        # Self consumption: solar covers the load, the surplus charges the battery and the battery covers any shortfall
+        surplus = S - L
+        charge = np.clip(np.minimum(np.minimum(surplus, charge_limit), room), 0, None)
+        discharge = np.clip(np.minimum(np.minimum(-surplus, discharge_limit), deliverable), 0, None)
+        imported = np.maximum(-surplus - discharge, 0)
+        self_soc = s + charge*eff - discharge/eff
+        no_export = np.zeros_like(self_soc)
+
+        # Exporting excess solar: as above but solar the battery can't take is exported
+        excess_export = np.minimum(np.maximum(surplus - charge, 0), export_limit) + no_export
+
+        # Exporting all solar: solar goes to the grid first, the battery covers the load and charges from anything left over
+        all_export = np.minimum(S, export_limit) + no_export
+        net = S - all_export - L
+        all_charge = np.clip(np.minimum(np.minimum(net, charge_limit), room), 0, None)
+        all_discharge = np.clip(np.minimum(np.minimum(-net, discharge_limit), deliverable), 0, None)
+        all_imported = np.maximum(-net - all_discharge, 0)
+        all_soc = s + all_charge*eff - all_discharge/eff
+
+        # Dispatching: the battery discharges as hard as the export limit allows, down to the floor
+        dispatchable = deliverable if floor is None else np.maximum(s - floor[:, None, None], 0) * eff
+        dispatch_discharge = np.clip(np.minimum(np.minimum(discharge_limit, dispatchable), export_limit + L - S), 0, None)
+        supply = S + dispatch_discharge
+        dispatch_export = np.clip(supply - L, 0, export_limit)
+        dispatch_imported = np.maximum(L - supply, 0)
+        dispatch_soc = s - dispatch_discharge/eff
+
+        export = np.concatenate([no_export, excess_export, all_export, dispatch_export], axis=1)
+        imported = np.concatenate([imported + no_export, imported + no_export, all_imported, dispatch_imported], axis=1)
+        next_soc = np.concatenate([self_soc, self_soc, all_soc, dispatch_soc], axis=1)
+        return export, imported, next_soc
+
+    def terminal_value(self, soc_grid, horizon_end, load_index, general_price, feedIn_price):
+        """Cents the energy left at the end of the horizon is worth. The kWh the load still needs before reserve_hour
+        save importing at the last general price, the rest can only be exported (tomorrow's solar refills the battery anyway).
+        Nothing is needed at a daytime horizon end, the solar covers the load.
+        """
+        local_end = ((horizon_end + UTC_OFFSET.total_seconds()) % 86400)
+        end_hour = local_end / 3600
+        needed = 0
+        if(end_hour >= self.sunset_hour or end_hour < self.reserve_hour):
+            needed = load_index.kwh_between_seconds(local_end, self.reserve_hour*3600.0) / self.efficiency # Battery kWh to supply it
+        delivered = soc_grid * self.efficiency
+        return np.minimum(delivered, needed*self.efficiency)*general_price + np.maximum(delivered - needed*self.efficiency, 0)*max(feedIn_price, 0)
+
+    def reserve_floor(self, end, now, load_index, reserve_kwh):
+        """kWh to keep in the battery at the end of each interval until the next reserve_hour: reserve_kwh
+        in proportion to the load still to come before reserve_hour, nothing after it.
+        """
+        offset = UTC_OFFSET.total_seconds()
+        reserve_seconds = self.reserve_hour*3600.0
+        local_now = now + offset
+        deadline = local_now - local_now % 86400 + reserve_seconds
+        if(deadline <= local_now):
+            deadline += 86400
+        deadline -= offset
+        total = load_index.kwh_between_seconds(local_now % 86400, reserve_seconds)
+        remaining = load_index.kwh_between_arrays((end + offset) % 86400, np.full(len(end), reserve_seconds))
+        share = remaining/total if total > 0 else np.ones(len(end))
+        return np.where(end < deadline, reserve_kwh*share, 0)
+
+    def plan(self, feedIn_forecast, general_forecast, load_index, solar_kwh_remaining_today, soc, capacity, now=None, feedIn_price=None, general_price=None, min_dispatch_price=None, reserve_kwh=None):
+        """feedIn_forecast/general_forecast: amber_api.ForecastArrays, load_index: load_profile.LoadProfileIndex,
+        soc and capacity: kWh above the backup buffer now and when full, feedIn_price/general_price: current prices to use for the first interval,
+        min_dispatch_price: dispatching isn't planned for intervals with a lower feed in price,
+        reserve_kwh: kWh needed until reserve_hour including the buffer (Plant.kwh_required_remaining).
+        """
+        started = time.perf_counter()
+        deadline = started + self.time_budget
+        now = now or time.time()
+
+        keep = feedIn_forecast.end > now
+        start = np.maximum(feedIn_forecast.start[keep], now)
+        end = feedIn_forecast.end[keep]
+        if(len(end) == 0 or capacity <= 0):
+            return None
+        feed_in = feedIn_forecast.price[keep].copy()
+        general = np.interp(start, general_forecast.start, general_forecast.price) # Channels normally share intervals
+        if(feedIn_price != None):
+            feed_in[0] = feedIn_price
+        if(general_price != None):
+            general[0] = general_price
+
+        offset = UTC_OFFSET.total_seconds()
+        hours = (end - start) / 3600
+        load = load_index.kwh_between_arrays((start + offset) % 86400, (end + offset) % 86400)
+        solar = spread_solar(start, end, solar_kwh_remaining_today, now, self.sunrise_hour, self.sunset_hour)
+
+        levels = int(min(max(round(capacity/self.soc_step) + 1, 2), self.max_levels))
+        soc_grid = np.linspace(0, capacity, levels)
+        floor = self.reserve_floor(end, now, load_index, reserve_kwh) if reserve_kwh != None else None
+        export, imported, next_soc = self.interval_flows(soc_grid, load, solar, hours, capacity, floor)
+        reward = export*feed_in[:, None, None] - imported*general[:, None, None] # cents
+        if(min_dispatch_price != None):
+            reward[:, MODES.index("Dispatching"), :] = np.where(feed_in[:, None] < min_dispatch_price, -np.inf, reward[:, MODES.index("Dispatching"), :])
+        if(floor is not None): # Self consumption can still use the reserve for the load
+            end_hour = ((end + offset) % 86400) / 3600
+            night = (end_hour >= self.sunset_hour) | (end_hour < self.reserve_hour) # In the day the solar still to come refills the battery
+            m = MODES.index("Exporting All Solar")
+            reward[:, m, :] = np.where(night[:, None] & (next_soc[:, m, :] < floor[:, None] - 1e-6), -np.inf, reward[:, m, :])
+            m = MODES.index("Dispatching")
+            reward[:, m, :] = np.where(soc_grid[None, :] <= floor[:, None], -np.inf, reward[:, m, :])
+
+        # Linear interpolation weights of every next SOC between the grid levels either side
+        position = np.clip(next_soc / soc_grid[1], 0, levels-1)
+        lower = np.minimum(position.astype(np.int64), levels-2)
+        fraction = position - lower
+
+        value = self.terminal_value(soc_grid, end[-1], load_index, general[-1], feed_in[-1])
+        policy = np.empty((len(end), levels), dtype=np.int8)
+        for t in range(len(end)-1, -1, -1):
+            if(time.perf_counter() > deadline):
+                print(f"Dispatch plan took longer than {self.time_budget*1000:.0f} ms, skipped")
+                return None
+            q = reward[t] + value[lower[t]]*(1-fraction[t]) + value[lower[t]+1]*fraction[t]
+            policy[t] = q.argmax(axis=0)
+            value = q.max(axis=0)
+
+        # Follow the policy from the current SOC
+        level = int(round(min(max(soc, 0), capacity) / soc_grid[1]))
+        modes = []
+        trajectory = np.empty(len(end))
+        planned_soc = min(max(soc, 0), capacity)
+        for t in range(len(end)):
+            trajectory[t] = planned_soc
+            action = policy[t, level]
+            modes.append(MODES[action])
+            planned_soc = next_soc[t, action, level]
+            level = int(round(planned_soc / soc_grid[1]))
+
+        expected_value = float(np.interp(min(max(soc, 0), capacity), soc_grid, value))
+        return DispatchPlan(start=start, end=end, modes=modes, soc=trajectory, value=expected_value,
+                            solve_time=time.perf_counter() - started, created=time.time())
@@ -1,5 +1,56 @@
+import time
+from dispatch_planner import DispatchPlanner, MODES
+from metrics import metrics
+
+# The decisions below are plain functions of the plant state so backtest.py can replay them without a plant or HA
+
+def hours_of_discharge_available(kwh_energy_available, kwh_required_remaining, max_export_power):
+    return max((kwh_energy_available - kwh_required_remaining) / max_export_power, 0) #constrain to not go negative
+
+def target_dispatch_price(forecast_price, target_price_reduction_percentage, minimum_dispatch_price):
+    price = (target_price_reduction_percentage/100.0) * forecast_price # Slightly reduce the target dispatch price to capture more events that are still valuable given forecast uncertanty 
+    return round(max(price, minimum_dispatch_price))
+
+def threshold_working_mode(feedIn_price, target_dispatch_price, kwh_energy_available, kwh_required_remaining, solar_kwh_forecast_remaining, kwh_till_full, solar_daytime):
+    if(feedIn_price >= target_dispatch_price and kwh_energy_available > kwh_required_remaining):
+        return "Dispatching"
+    elif(solar_kwh_forecast_remaining + kwh_energy_available > kwh_required_remaining + kwh_till_full + 20 and feedIn_price > 2 and solar_daytime):
+        return "Exporting All Solar"
+    elif(feedIn_price >= 0):
+        return "Exporting Excess Solar"
+    else:
+        return "Self Consumption"
+
+def planned_working_mode(planned_mode, kwh_energy_available, kwh_required_remaining):
+    """The plan's mode for now, except dispatching stops once the battery is down to the overnight reserve (the plan's intervals are 30 minutes, this is checked every tick)"""
+    if(planned_mode == "Dispatching" and kwh_energy_available <= kwh_required_remaining):
+        return "Self Consumption"
+    return planned_mode
+
+def effective_price(general_price, feedIn_price, target_dispatch_price, remaining_solar_today, kwh_required_remaining, solar_daytime, kwh_stored_available, kwh_till_full, kwh_load_till_evening):
+    """What using a kWh right now costs: the general price, the feed in price it could have been sold at, or the price the battery could dispatch it at"""
+    available_energy = max(remaining_solar_today-10, 0) + kwh_stored_available # kWh of energy available right now
+    energy_consumption_available = kwh_till_full + kwh_load_till_evening # kWh that can be used of the available solar
+
+    effective_dispatch_price = max(target_dispatch_price, feedIn_price)
+
+    if(general_price < 0):
+        return general_price
+    elif(solar_daytime): # Solar > base load estimate
+        if(remaining_solar_today > energy_consumption_available): # There should be excess power that would be sold at the feed in price or wasted
+            return max(feedIn_price, 0)
+        elif(available_energy > kwh_required_remaining): # Energy used will cut into feed in profits 
+            return effective_dispatch_price
+        else:
+            return general_price
+    else: # Not solar daytime
+        if(kwh_stored_available > kwh_required_remaining): # More battery than required overnight, energy use will cut into feed in profits
+            return effective_dispatch_price
+        else:
+            return general_price # default to the general price
+
 class EnergyController():
-    def __init__(self, ha, ha_mqtt, plant, buffer_percentage_remaining, max_discharge_rate = 15, MINIMUM_BATTERY_DISPATCH_PRICE = 10):
+    def __init__(self, ha, ha_mqtt, plant, buffer_percentage_remaining, max_discharge_rate = 15, MINIMUM_BATTERY_DISPATCH_PRICE = 10, max_price_age = 15*60, use_planner = True, working_mode = None): # working_mode: the mode from before a restart, if recent
         self.ha = ha
         self.ha_mqtt = ha_mqtt
         self.plant = plant
@@ -17,81 +68,109 @@ class EnergyController():
         self.target_price_reduction_percentage = 100 # Percentage of ideal sell price to sell at (Assumes the max price won't occour)
 
         self.last_control_mode = self.plant.get_plant_mode()
+        self.max_price_age = max_price_age # Seconds old the Amber prices can be before they're too stale to trade on
+
+        # With use_planner working modes come from the dispatch plan when there is one, otherwise from the price thresholds in decide_working_mode.
+        # Only enable it while `python backtest.py --check-planner` passes, ie. it earns more than the thresholds without importing more
+        self.planner = None
+        if(use_planner):
+            self.planner = DispatchPlanner(
+                max_charge_power=self.plant.max_charge_power,
+                max_discharge_power=self.plant.max_discharge_power,
+                max_export_power=self.plant.max_export_power)
+        self.plan = None
+        self.replan_interval = 60 # seconds, the plan is also redone whenever new prices arrive
 
         #Self consume on startup for saftey if auto control on
-        if(ha.get_state("input_select.automatic_control_mode")["state"] == "On"):
+        #After a restart the plant is still in the mode it was left in, so carry on from it rather than writing self consumption only to switch straight back on the first tick
+        if(working_mode in MODES):
+            self.working_mode = working_mode
+        elif(ha.get_state("input_select.automatic_control_mode")["state"] == "On"):
             self.self_consumption()
                 
-    def dispatch(self):
-        self.working_mode = "Dispatching"
-        self.plant.check_control_limits(
-            working_mode=self.working_mode,
-            control_mode="Command Discharging (PV First)",
-            discharge=self.plant.max_discharge_power,
-            charge=0,
-            pv=self.plant.max_pv_power,
-            grid_export=self.plant.max_export_power,
-            grid_import=0)
-        
-    def export_all_solar(self):
-        self.working_mode = "Exporting All Solar"
-
-        solar_buffer = 2 # Buffer to ensure load is covered by battery or solar
-        if(self.plant.load_power + solar_buffer < self.plant.solar_kw): # Let the battery charge with excess DC power available
-            self.plant.check_control_limits(
-                working_mode=self.working_mode,
+    def mode_limits(self, working_mode): # Control mode and power limits the plant is set to for each working mode
+        if(working_mode == "Dispatching"):
+            return dict(
                 control_mode="Command Discharging (PV First)",
-                discharge=0,
-                charge=self.plant.max_charge_power,
+                discharge=self.plant.max_discharge_power,
+                charge=0,
                 pv=self.plant.max_pv_power,
                 grid_export=self.plant.max_export_power,
                 grid_import=0)
-        else: # Make sure the battery supplies the load if solar power is minimal
-            self.plant.check_control_limits(
-                working_mode=self.working_mode,
-                control_mode="Command Charging (PV First)",
+        elif(working_mode == "Exporting All Solar"):
+            solar_buffer = 2 # Buffer to ensure load is covered by battery or solar
+            if(self.plant.load_power + solar_buffer < self.plant.solar_kw): # Let the battery charge with excess DC power available
+                return dict(
+                    control_mode="Command Discharging (PV First)",
+                    discharge=0,
+                    charge=self.plant.max_charge_power,
+                    pv=self.plant.max_pv_power,
+                    grid_export=self.plant.max_export_power,
+                    grid_import=0)
+            else: # Make sure the battery supplies the load if solar power is minimal
+                return dict(
+                    control_mode="Command Charging (PV First)",
+                    discharge=self.plant.max_discharge_power,
+                    charge=0,
+                    pv=self.plant.max_pv_power,
+                    grid_export=self.plant.max_export_power,
+                    grid_import=0)
+        elif(working_mode == "Exporting Excess Solar"):
+            return dict(
+                control_mode="Maximum Self Consumption",
                 discharge=self.plant.max_discharge_power,
-                charge=0,
+                charge=self.plant.max_charge_power,
                 pv=self.plant.max_pv_power,
                 grid_export=self.plant.max_export_power,
                 grid_import=0)
+        elif(working_mode == "Self Consumption"):
+            return dict(
+                control_mode="Maximum Self Consumption",
+                discharge=self.plant.max_discharge_power,
+                charge=self.plant.max_charge_power,
+                pv=self.plant.max_pv_power,
+                grid_export=0,
+                grid_import=0)
+        else:
+            raise Exception(f"Working mode {working_mode} not defined")
+
+    def dispatch(self):
+        self.working_mode = "Dispatching"
+        self.plant.check_control_limits(working_mode=self.working_mode, **self.mode_limits(self.working_mode))
+        
+    def export_all_solar(self):
+        self.working_mode = "Exporting All Solar"
+        self.plant.check_control_limits(working_mode=self.working_mode, **self.mode_limits(self.working_mode))
 
     def export_excess_solar(self):
         self.working_mode = "Exporting Excess Solar"
-        self.plant.check_control_limits(
-            working_mode=self.working_mode,
-            control_mode="Maximum Self Consumption",
-            discharge=self.plant.max_discharge_power,
-            charge=self.plant.max_charge_power,
-            pv=self.plant.max_pv_power,
-            grid_export=self.plant.max_export_power,
-            grid_import=0)
-
+        self.plant.check_control_limits(working_mode=self.working_mode, **self.mode_limits(self.working_mode))
 
     def self_consumption(self):
         self.working_mode = "Self Consumption"
-        self.plant.check_control_limits(
-            working_mode=self.working_mode,
-            control_mode="Maximum Self Consumption",
-            discharge=self.plant.max_discharge_power,
-            charge=self.plant.max_charge_power,
-            pv=self.plant.max_pv_power,
-            grid_export=0,
-            grid_import=0)
+        self.plant.check_control_limits(working_mode=self.working_mode, **self.mode_limits(self.working_mode))
         
-    def update_values(self, amber_data):
-        self.plant.update_data()
+    def update_values(self, amber_data, snapshot=None): # snapshot: this tick's StateSnapshot, fetched by the plant if not provided
+        with metrics.timer("update_values"):
+            self.plant.update_data(snapshot)
+            self.calculate_values(amber_data)
+
+    async def async_update_values(self, amber_data, aha, snapshot=None):
+        with metrics.timer("update_values"):
+            await self.plant.async_update_data(aha, snapshot)
+            self.calculate_values(amber_data)
+
+    def calculate_values(self, amber_data):
         self.feedIn_price = amber_data.feedIn_price
-        self.solar_kwh_forecast_remaining = self.ha.get_numeric_state("sensor.solcast_pv_forecast_forecast_remaining_today")
+        self.solar_kwh_forecast_remaining = self.plant.solar_kw_remaining_today
         self.kwh_required_remaining = self.plant.kwh_required_remaining(buffer_percentage=self.buffer_percentage_remaining)
 
         self.kwh_energy_available = self.plant.kwh_stored_available
         
-        self.hrs_of_discharge_available = max((self.kwh_energy_available - self.kwh_required_remaining) / self.plant.max_export_power, 0) #constrain to not go negative
+        self.hrs_of_discharge_available = hours_of_discharge_available(self.kwh_energy_available, self.kwh_required_remaining, self.plant.max_export_power)
 
-        self.target_dispatch_price = amber_data.feedIn_12hr_forecast_sorted[max(round(self.hrs_of_discharge_available*2),0)].price # get the number of 30 minute periods that the battery is allowed to discharge to
-        self.target_dispatch_price = (self.target_price_reduction_percentage/100.0) * self.target_dispatch_price # Slightly reduce the target dispatch price to capture more events that are still valuable given forecast uncertanty 
-        self.target_dispatch_price = round(max(self.target_dispatch_price, self.MINIMUM_BATTERY_DISPATCH_PRICE)) 
+        forecast_price = amber_data.feedIn_forecast.price_for_hours(self.hrs_of_discharge_available) # price of the last forecast interval the battery has enough energy to discharge through
+        self.target_dispatch_price = target_dispatch_price(forecast_price, self.target_price_reduction_percentage, self.MINIMUM_BATTERY_DISPATCH_PRICE)
         #print(f"Discharge 30 minute windows: {self.hrs_of_discharge_available*2}")
         
 
@@ -102,46 +181,89 @@ class EnergyController():
         print(f"Current FeedIn Price: {self.feedIn_price} c/kWh")
         print(f"Max Forecasted FeedIn Price: {amber_data.feedIn_max_forecast_price} c/kWh")
         print(f"Target Dispatch Price: {self.target_dispatch_price} c/kWh")
+        if(self.plan != None):
+            print(f"Dispatch Plan: {self.plan.mode_at(time.time())}, expected value ${round(self.plan.value/100, 2)}, solved in {round(self.plan.solve_time*1000, 1)} ms")
 
-    def run(self, amber_data):
-        self.update_values(amber_data=amber_data)
+    def run(self, amber_data, snapshot=None, refresh=True): # refresh=False when update_values already ran with this snapshot
+        with metrics.timer("controller_run"):
+            if(refresh):
+                self.update_values(amber_data=amber_data, snapshot=snapshot)
+            self.decide_working_mode(amber_data)
+            self.mainain_control_mode()
 
+    async def async_run(self, amber_data, aha, snapshot=None, refresh=True): # aha: AsyncHomeAssistantAPI
+        with metrics.timer("controller_run"):
+            if(refresh):
+                await self.async_update_values(amber_data=amber_data, aha=aha, snapshot=snapshot)
+            self.decide_working_mode(amber_data)
+            await self.async_mainain_control_mode(aha)
+
+    def decide_working_mode(self, amber_data):
         #Plant.display_data()
         #print(f"Current General Price: {round(general_price)} c/kWh")
 
         last_working_mode = self.working_mode
 
-        if(self.feedIn_price >= self.target_dispatch_price and self.kwh_energy_available > self.kwh_required_remaining):
-            self.working_mode = "Dispatching"
-            if(self.last_control_mode != self.plant.get_plant_mode()):
-                self.last_control_mode = self.plant.get_plant_mode()
-                #self.ha.send_notification(f"Dispatching at {self.feedIn_price} c/kWh", f"kWh Drained: {self.plant.kwh_till_full} kWh", "mobile_app_pixel_10_pro")
-            
-        elif(self.solar_kwh_forecast_remaining + self.kwh_energy_available > self.kwh_required_remaining + self.plant.kwh_till_full + 20 and self.feedIn_price > 2 and self.plant.solar_daytime):
-            self.working_mode = "Exporting All Solar"
-            if(self.last_control_mode != self.plant.get_plant_mode()):
-                self.last_control_mode = self.plant.get_plant_mode()
-                #self.ha.send_notification(f"Selling All Solar at {self.feedIn_price} c/kWh", f"kWh Drained: {self.plant.kwh_till_full} kWh", "mobile_app_pixel_10_pro")
-
-        elif(self.feedIn_price < self.target_dispatch_price or self.kwh_energy_available <= self.kwh_required_remaining):
-            if(self.feedIn_price >= 0):
-                self.working_mode = "Exporting Excess Solar"
-                if(self.last_control_mode != self.plant.get_plant_mode()):
-                    self.last_control_mode = self.plant.get_plant_mode()
-                    #self.ha.send_notification(f"Exporting Excess Solar at {self.feedIn_price} c/kWh", f"kWh Drained: {self.plant.kwh_till_full} kWh", "mobile_app_pixel_10_pro")
-            else:
-                self.working_mode = "Self Consumption"
-                if(self.last_control_mode != self.plant.get_plant_mode()):
-                    self.last_control_mode = self.plant.get_plant_mode()
-                    #self.ha.send_notification(f"Self Consuming at {self.feedIn_price} c/kWh", f"kWh Drained: {self.plant.kwh_till_full} kWh", "mobile_app_pixel_10_pro")
+        if(amber_data.stale and amber_data.age > self.max_price_age): # Don't dispatch or export on prices that could be well out of date
+            self.working_mode = "Self Consumption"
+            if(last_working_mode != self.working_mode):
+                print(f"Amber prices are {round(amber_data.age/60)} minutes old, falling back to self consumption")
+                self.print_values(amber_data)
+            return
+
+        planned_mode = self.planned_mode(amber_data)
+        if(planned_mode != None):
+            self.working_mode = planned_working_mode(planned_mode, self.kwh_energy_available, self.kwh_required_remaining)
+            if(last_working_mode != self.working_mode):
+                self.print_values(amber_data)
+            return
+
+        self.working_mode = threshold_working_mode(
+            feedIn_price=self.feedIn_price,
+            target_dispatch_price=self.target_dispatch_price,
+            kwh_energy_available=self.kwh_energy_available,
+            kwh_required_remaining=self.kwh_required_remaining,
+            solar_kwh_forecast_remaining=self.solar_kwh_forecast_remaining,
+            kwh_till_full=self.plant.kwh_till_full,
+            solar_daytime=self.plant.solar_daytime)
+        if(self.last_control_mode != self.plant.get_plant_mode()):
+            self.last_control_mode = self.plant.get_plant_mode()
+            #self.ha.send_notification(f"{self.working_mode} at {self.feedIn_price} c/kWh", f"kWh Drained: {self.plant.kwh_till_full} kWh", "mobile_app_pixel_10_pro")
         
         if(last_working_mode != self.working_mode):
             self.print_values(amber_data)
 
-        self.mainain_control_mode()
+    def update_plan(self, amber_data):
+        if(self.plan != None and time.time() - self.plan.created < self.replan_interval and self.plan.created > amber_data.fetched_timestamp):
+            return self.plan
+        self.plan = None
+        if(self.plant.load_index == None):
+            return None
+        try:
+            self.plan = self.planner.plan(
+                feedIn_forecast=amber_data.feedIn_forecast,
+                general_forecast=amber_data.general_forecast,
+                load_index=self.plant.load_index,
+                solar_kwh_remaining_today=self.solar_kwh_forecast_remaining,
+                soc=self.plant.kwh_stored_available,
+                capacity=self.plant.kwh_stored_available + self.plant.kwh_till_full,
+                feedIn_price=amber_data.feedIn_price,
+                general_price=amber_data.general_price,
+                min_dispatch_price=self.MINIMUM_BATTERY_DISPATCH_PRICE,
+                reserve_kwh=self.kwh_required_remaining) # Buffered, so the plan keeps the same overnight margin as the thresholds
+        except Exception as e:
+            print(f"Dispatch planning failed: {e}")
+        return self.plan
+
+    def planned_mode(self, amber_data): # Working mode from the dispatch plan for now, None to use the price thresholds instead
+        if(self.planner == None):
+            return None
+        plan = self.update_plan(amber_data)
+        if(plan == None):
+            return None
+        return plan.mode_at(time.time())
 
     def mainain_control_mode(self):
-        self.plant.update_data()
         if(self.working_mode == "Self Consumption"):
             self.self_consumption()
         elif(self.working_mode == "Exporting Excess Solar"):  
@@ -153,5 +275,11 @@ class EnergyController():
         else:
             self.self_consumption()
             raise(f"Error, control mode {self.working_mode} not defined. Defaulting to self consumption.")
-            
-                
\ No newline at end of file
+
+    async def async_mainain_control_mode(self, aha):
+        requested_mode = self.working_mode
+        if(requested_mode not in ["Self Consumption", "Exporting Excess Solar", "Exporting All Solar", "Dispatching"]):
+            self.working_mode = "Self Consumption"
+        await self.plant.async_check_control_limits(aha, working_mode=self.working_mode, **self.mode_limits(self.working_mode))
+        if(requested_mode != self.working_mode):
+            raise Exception(f"Error, control mode {requested_mode} not defined. Defaulting to self consumption.")
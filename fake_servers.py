@@ -0,0 +1,663 @@
+import re
+import json
+import math
+import time
+import base64
+import random
+import socket
+import struct
+import hashlib
+import datetime
+import threading
+import http.server
+import urllib.parse
+
+# Local stand-ins for Home Assistant, the Amber API and an MQTT broker, for load testing without the real services (see loadtest.py)
+# python fake_servers.py   runs all three until Ctrl+C
+
+class FaultInjector:
+    """Latency and errors to add to every request a fake server handles"""
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency # seconds added to every request
+        self.jitter = jitter # up to this many more seconds, uniformly random
+        self.error_rate = error_rate # fraction of requests that fail
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.errors = 0
+
+    def delay(self):
+        with self.lock:
+            extra = self.random.uniform(0, self.jitter) if self.jitter > 0 else 0
+        if self.latency + extra > 0:
+            time.sleep(self.latency + extra)
+
+    def should_fail(self):
+        with self.lock:
+            fail = self.error_rate > 0 and self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return fail
+
+class JSONRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive, so connection reuse behaves like the real servers
+    disable_nagle_algorithm = True # Headers and body go out in separate writes, don't let them wait on delayed ACKs
+
+    def send_json(self, obj, code=200, headers=None):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeServer:
+    """ThreadingHTTPServer on a background thread, handler_class gets the server object as self.server.fake"""
+    handler_class = None
+
+    def __init__(self, host="127.0.0.1", port=0, faults=None):
+        self.host = host
+        self.port = port
+        self.faults = faults or FaultInjector()
+        self.request_count = 0
+        self.count_lock = threading.Lock()
+        self.httpd = None
+
+    def count_request(self):
+        with self.count_lock:
+            self.request_count += 1
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.httpd.server_port}"
+
+    def start(self):
+        self.httpd = http.server.ThreadingHTTPServer((self.host, self.port), self.handler_class)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.httpd != None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+# ---------------------------------------------------------------- Home Assistant
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+DEFAULT_STATES = {
+    "sensor.sigen_plant_rated_energy_capacity": "35",
+    "number.sigen_plant_ess_backup_state_of_charge": "10",
+    "sensor.sigen_plant_available_max_discharging_capacity": "18",
+    "number.sigen_plant_ess_charge_cut_off_state_of_charge": "100",
+    "sensor.sigen_plant_available_max_charging_capacity": "14",
+    "sensor.reversed_battery_power": "-2.1",
+    "sensor.sigen_plant_pv_power": "6.5",
+    "sensor.sigen_inverter_daily_pv_energy": "21.4",
+    "sensor.solcast_pv_forecast_forecast_remaining_today": "18.2",
+    "sensor.solcast_pv_forecast_forecast_this_hour": "5.1",
+    "sensor.sigen_plant_plant_active_power": "4.3",
+    "sensor.sigen_plant_grid_active_power": "3.1",
+    "sensor.sigen_plant_consumed_power": "1.2",
+    "sensor.sigen_plant_daily_load_consumption": "9.6",
+    "select.sigen_plant_remote_ems_control_mode": "Maximum Self Consumption",
+    "number.sigen_plant_ess_max_discharging_limit": "24",
+    "number.sigen_plant_ess_max_charging_limit": "21",
+    "number.sigen_plant_pv_max_power_limit": "24",
+    "number.sigen_plant_grid_export_limitation": "0",
+    "number.sigen_plant_grid_import_limitation": "0",
+    "input_select.automatic_control_mode": "On",
+    "sensor.sigen_plant_grid_export_power": "3.1",
+    "sensor.daily_feed_in": "2.35",
+    "sensor.daily_general_usage": "0.4",
+}
+
+def iso(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+def synthetic_history_value(entity_id, timestamp, utc_offset=10*3600):
+    """Plausible history for the sensors the energy manager reads history of"""
+    local_hours = ((timestamp + utc_offset) % 86400) / 3600
+    load_kw = 0.6 + 1.5*math.exp(-((local_hours - 18.5)**2)/3) + 0.1*math.sin(timestamp/700)
+    if "daily" in entity_id: # Cumulative kWh that resets at local midnight, integral of load_kw
+        return 0.6*local_hours + 1.5*math.sqrt(3*math.pi)/2*(math.erf((local_hours - 18.5)/math.sqrt(3)) + math.erf(18.5/math.sqrt(3)))
+    return load_kw
+
+class HomeAssistantHandler(JSONRequestHandler):
+    def do_GET(self):
+        fake = self.server.fake
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/api/websocket" and self.headers.get("Upgrade", "").lower() == "websocket":
+            return fake.serve_websocket(self)
+        fake.count_request()
+        fake.faults.delay()
+        if fake.faults.should_fail():
+            return self.send_json({"message": "Injected error"}, 500)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == "/api/states":
+            return self.send_json(fake.all_states())
+        match = re.fullmatch(r"/api/states/(.+)", url.path)
+        if match:
+            state = fake.states.get(match[1])
+            if state == None:
+                return self.send_json({"message": "Entity not found."}, 404)
+            return self.send_json(state)
+        match = re.fullmatch(r"/api/history/period/(.+)", url.path)
+        if match:
+            start = datetime.datetime.fromisoformat(urllib.parse.unquote(match[1])).timestamp()
+            end = datetime.datetime.fromisoformat(query["end_time"][0]).timestamp() if "end_time" in query else time.time()
+            return self.send_json(fake.history(query["filter_entity_id"][0], start, end, "minimal_response" in query))
+        self.send_json({"message": "Not found"}, 404)
+
+    def do_POST(self):
+        fake = self.server.fake
+        fake.count_request()
+        fake.faults.delay()
+        data = self.read_json()
+        if fake.faults.should_fail():
+            return self.send_json({"message": "Injected error"}, 500)
+        match = re.fullmatch(r"/api/services/([^/]+)/([^/]+)", self.path)
+        if match:
+            return self.send_json(fake.call_service(match[1], match[2], data))
+        match = re.fullmatch(r"/api/events/([^/]+)", self.path)
+        if match:
+            fake.events.append((match[1], data))
+            return self.send_json({"message": f"Event {match[1]} fired."})
+        self.send_json({"message": "Not found"}, 404)
+
+class WebSocketConnection:
+    """Just enough of RFC 6455 for HA's websocket API: unfragmented text frames, ping and close"""
+    def __init__(self, handler):
+        self.rfile = handler.rfile
+        self.wfile = handler.wfile
+        self.send_lock = threading.Lock()
+        self.closed = False
+
+    def read_exact(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise ConnectionError("Websocket closed")
+        return data
+
+    def recv(self):
+        while True:
+            first, second = self.read_exact(2)
+            opcode = first & 0x0F
+            length = second & 0x7F
+            if length == 126:
+                length = struct.unpack(">H", self.read_exact(2))[0]
+            elif length == 127:
+                length = struct.unpack(">Q", self.read_exact(8))[0]
+            mask = self.read_exact(4) if second & 0x80 else None
+            payload = self.read_exact(length)
+            if mask != None:
+                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+            if opcode == 0x8: # Close
+                raise ConnectionError("Websocket closed by client")
+            if opcode == 0x9: # Ping
+                self.send_frame(0xA, payload)
+                continue
+            if opcode == 0x1:
+                return payload.decode()
+
+    def send_frame(self, opcode, payload):
+        header = bytes([0x80 | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        elif len(payload) < 65536:
+            header += bytes([126]) + struct.pack(">H", len(payload))
+        else:
+            header += bytes([127]) + struct.pack(">Q", len(payload))
+        with self.send_lock:
+            if self.closed:
+                return
+            self.wfile.write(header + payload)
+            self.wfile.flush()
+
+    def send(self, message):
+        self.send_frame(0x1, json.dumps(message).encode())
+
+class FakeHomeAssistant(FakeServer):
+    """HA REST endpoints used by HomeAssistantAPI (states, services, events, history) and the websocket API used by HAStateMirror.
+    Service calls that set a number, select or switch update the entity and push a state_changed event to websocket subscribers.
+    With simulate_interval set, the power sensors drift on a background thread so the mirror sees a stream of changes.
+    """
+    handler_class = HomeAssistantHandler
+
+    def __init__(self, host="127.0.0.1", port=0, faults=None, states=None, token=None, history_step=60, simulate_interval=None, seed=0):
+        super().__init__(host, port, faults)
+        self.token = token # None accepts any token
+        self.history_step = history_step # seconds between history samples
+        self.simulate_interval = simulate_interval
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.states = {}
+        for entity_id, value in (states or DEFAULT_STATES).items():
+            self.states[entity_id] = self.make_state(entity_id, value)
+        self.service_calls = []
+        self.events = []
+        self.subscribers = [] # (WebSocketConnection, subscription id)
+        self.websocket_messages_sent = 0
+        self.stop_event = threading.Event()
+
+    def make_state(self, entity_id, value, attributes=None):
+        now = iso(time.time())
+        return {"entity_id": entity_id, "state": str(value), "attributes": attributes or {}, "last_changed": now, "last_updated": now}
+
+    def all_states(self):
+        with self.lock:
+            return list(self.states.values())
+
+    def set_state(self, entity_id, value):
+        with self.lock:
+            old_state = self.states.get(entity_id)
+            new_state = self.make_state(entity_id, value, old_state["attributes"] if old_state else None)
+            self.states[entity_id] = new_state
+            subscribers = list(self.subscribers)
+        event = {"event_type": "state_changed", "data": {"entity_id": entity_id, "old_state": old_state, "new_state": new_state}, "time_fired": new_state["last_updated"]}
+        for connection, subscription_id in subscribers:
+            try:
+                connection.send({"id": subscription_id, "type": "event", "event": event})
+                self.websocket_messages_sent += 1
+            except Exception:
+                pass
+        return new_state
+
+    def call_service(self, domain, service, data):
+        self.service_calls.append((domain, service, data))
+        entity_id = data.get("entity_id")
+        value = data.get("value", data.get("option"))
+        if service in ("turn_on", "turn_off"):
+            value = "on" if service == "turn_on" else "off"
+        if entity_id != None and value != None:
+            if domain in ("number", "input_number"):
+                value = float(value)
+            return [self.set_state(entity_id, value)]
+        return []
+
+    def history(self, entity_id, start, end, minimal_response):
+        first = math.ceil(start / self.history_step) * self.history_step
+        timestamps = [first + i*self.history_step for i in range(max(int((end - first) // self.history_step) + 1, 0)) if first + i*self.history_step < end]
+        rows = []
+        for i, timestamp in enumerate(timestamps):
+            row = {"state": f"{synthetic_history_value(entity_id, timestamp):.3f}", "last_changed": iso(timestamp)}
+            if i == 0 or not minimal_response:
+                row.update({"entity_id": entity_id, "attributes": {}, "last_updated": iso(timestamp)})
+            rows.append(row)
+        return [rows] if rows else []
+
+    def serve_websocket(self, handler):
+        key = handler.headers["Sec-WebSocket-Key"]
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        handler.send_response(101, "Switching Protocols")
+        handler.send_header("Upgrade", "websocket")
+        handler.send_header("Connection", "Upgrade")
+        handler.send_header("Sec-WebSocket-Accept", accept)
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = True
+
+        connection = WebSocketConnection(handler)
+        try:
+            connection.send({"type": "auth_required", "ha_version": "2025.1.0"})
+            auth = json.loads(connection.recv())
+            if auth.get("type") != "auth" or (self.token != None and auth.get("access_token") != self.token):
+                connection.send({"type": "auth_invalid", "message": "Invalid access token"})
+                return
+            connection.send({"type": "auth_ok", "ha_version": "2025.1.0"})
+            while True:
+                message = json.loads(connection.recv())
+                self.faults.delay()
+                if message.get("type") == "subscribe_events":
+                    with self.lock:
+                        self.subscribers.append((connection, message["id"]))
+                    connection.send({"id": message["id"], "type": "result", "success": True, "result": None})
+                elif message.get("type") == "get_states":
+                    connection.send({"id": message["id"], "type": "result", "success": True, "result": self.all_states()})
+                elif message.get("type") == "ping":
+                    connection.send({"id": message["id"], "type": "pong"})
+                else:
+                    connection.send({"id": message.get("id"), "type": "result", "success": False, "error": {"code": "unknown_command", "message": "Unknown command."}})
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            connection.closed = True
+            with self.lock:
+                self.subscribers = [s for s in self.subscribers if s[0] is not connection]
+
+    def start(self):
+        super().start()
+        if self.simulate_interval:
+            threading.Thread(target=self.simulate, name="FakeHomeAssistant-simulate", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        with self.lock:
+            for connection, _ in self.subscribers:
+                connection.closed = True
+        super().stop()
+
+    def simulate(self): # Random walk of load and solar power
+        while not self.stop_event.wait(self.simulate_interval):
+            for entity_id, low, high in [("sensor.sigen_plant_consumed_power", 0.2, 6), ("sensor.sigen_plant_pv_power", 0, 13)]:
+                value = float(self.states[entity_id]["state"]) + self.random.gauss(0, 0.2)
+                self.set_state(entity_id, round(min(max(value, low), high), 2))
+
+# ---------------------------------------------------------------- Amber
+
+class AmberHandler(JSONRequestHandler):
+    def do_GET(self):
+        fake = self.server.fake
+        fake.count_request()
+        fake.faults.delay()
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        limited, headers = fake.take_request()
+        if limited:
+            return self.send_json({"message": "Too many requests"}, 429, headers)
+        if fake.faults.should_fail():
+            return self.send_json({"message": "Injected error"}, 500, headers)
+        if url.path.endswith("/sites"):
+            return self.send_json([{"id": "SITE", "nmi": "0000000000", "status": "active"}], headers=headers)
+        if re.fullmatch(r"/v1/sites/[^/]+/prices/current", url.path):
+            intervals = int(query.get("next", ["0"])[0])
+            resolution = int(query.get("resolution", ["30"])[0])
+            return self.send_json(fake.prices(intervals, resolution), headers=headers)
+        self.send_json({"message": "Not found"}, 404, headers)
+
+class FakeAmber(FakeServer):
+    """Amber's /sites and /sites/{id}/prices/current with RateLimit headers.
+    More than rate_limit requests in a rate_limit_window gets a 429 until the window resets.
+    """
+    handler_class = AmberHandler
+
+    def __init__(self, host="127.0.0.1", port=0, faults=None, rate_limit=50, rate_limit_window=300, estimate=False):
+        super().__init__(host, port, faults)
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.estimate = estimate
+        self.window_start = time.time()
+        self.window_requests = 0
+        self.rate_limited = 0
+
+    def take_request(self):
+        with self.count_lock:
+            now = time.time()
+            if now - self.window_start >= self.rate_limit_window:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            remaining = max(self.rate_limit - self.window_requests, 0)
+            headers = {"RateLimit-Limit": self.rate_limit, "RateLimit-Remaining": remaining,
+                       "RateLimit-Reset": int(self.window_start + self.rate_limit_window - now)}
+            limited = self.window_requests > self.rate_limit
+            if limited:
+                self.rate_limited += 1
+            return limited, headers
+
+    def price(self, channel, timestamp):
+        local_hours = ((timestamp + 10*3600) % 86400) / 3600
+        evening = math.exp(-((local_hours - 18.5)**2)/1.5)
+        midday = max(math.sin(math.pi*(local_hours - 8)/8), 0)
+        if channel == "general":
+            return 22 + 30*evening - 12*midday
+        return -(4 + 25*evening - 10*midday) # Amber reports feed in as negative c/kWh when exporting earns
+
+    def prices(self, intervals, resolution):
+        period = resolution*60
+        now = time.time()
+        start = now - now % period
+        rows = []
+        for i in range(intervals + 1):
+            interval_start = start + i*period
+            for channel in ["general", "feedIn"]:
+                rows.append({
+                    "type": "CurrentInterval" if i == 0 else "ForecastInterval",
+                    "channelType": channel,
+                    "duration": resolution,
+                    "startTime": datetime.datetime.fromtimestamp(interval_start + 1, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "endTime": datetime.datetime.fromtimestamp(interval_start + period, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "perKwh": round(self.price(channel, interval_start), 2),
+                    "estimate": self.estimate or i > 0,
+                })
+        return rows
+
+# ---------------------------------------------------------------- MQTT
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(filter_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded.append(byte | 0x80 if length > 0 else byte)
+        if length == 0:
+            return bytes(encoded)
+
+def encode_string(text):
+    data = text.encode()
+    return struct.pack(">H", len(data)) + data
+
+class MQTTClientConnection:
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.send_lock = threading.Lock()
+        self.subscriptions = {} # topic filter -> qos
+        self.client_id = None
+
+    def read_exact(self, n):
+        data = b""
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError("MQTT client disconnected")
+            data += chunk
+        return data
+
+    def read_packet(self):
+        first = self.read_exact(1)[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self.read_exact(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return first >> 4, first & 0x0F, self.read_exact(length)
+
+    def send(self, packet_type, flags, body):
+        with self.send_lock:
+            self.sock.sendall(bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + body)
+
+    def deliver(self, topic, payload, retain=False):
+        self.send(3, 1 if retain else 0, encode_string(topic) + payload) # Always QoS 0
+        self.broker.count("messages_delivered")
+
+    def serve(self):
+        try:
+            while True:
+                packet_type, flags, body = self.read_packet()
+                self.broker.faults.delay()
+                if self.broker.faults.should_fail(): # Drop the connection like a broker restart
+                    return
+                if packet_type == 1: # CONNECT
+                    protocol_length = struct.unpack(">H", body[:2])[0]
+                    client_id_start = 2 + protocol_length + 4
+                    client_id_length = struct.unpack(">H", body[client_id_start:client_id_start+2])[0]
+                    self.client_id = body[client_id_start+2:client_id_start+2+client_id_length].decode()
+                    self.broker.count("connections")
+                    self.send(2, 0, b"\x00\x00")
+                elif packet_type == 3: # PUBLISH
+                    qos = (flags >> 1) & 0x03
+                    topic_length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2+topic_length].decode()
+                    position = 2 + topic_length
+                    packet_id = None
+                    if qos > 0:
+                        packet_id = body[position:position+2]
+                        position += 2
+                    self.broker.publish(topic, body[position:], retain=bool(flags & 0x01), from_client=True)
+                    if qos == 1:
+                        self.send(4, 0, packet_id) # PUBACK
+                    elif qos == 2:
+                        self.send(5, 0, packet_id) # PUBREC
+                elif packet_type == 6: # PUBREL
+                    self.send(7, 0, body[:2]) # PUBCOMP
+                elif packet_type == 8: # SUBSCRIBE
+                    packet_id = body[:2]
+                    position = 2
+                    granted = bytearray()
+                    new_filters = []
+                    while position < len(body):
+                        filter_length = struct.unpack(">H", body[position:position+2])[0]
+                        topic_filter = body[position+2:position+2+filter_length].decode()
+                        qos = body[position+2+filter_length] & 0x03
+                        position += 3 + filter_length
+                        self.subscriptions[topic_filter] = qos
+                        granted.append(min(qos, 1))
+                        new_filters.append(topic_filter)
+                    self.send(9, 0, packet_id + bytes(granted)) # SUBACK
+                    for topic, payload in self.broker.retained_matching(new_filters):
+                        self.deliver(topic, payload, retain=True)
+                elif packet_type == 10: # UNSUBSCRIBE
+                    position = 2
+                    while position < len(body):
+                        filter_length = struct.unpack(">H", body[position:position+2])[0]
+                        self.subscriptions.pop(body[position+2:position+2+filter_length].decode(), None)
+                        position += 2 + filter_length
+                    self.send(11, 0, body[:2]) # UNSUBACK
+                elif packet_type == 12: # PINGREQ
+                    self.send(13, 0, b"")
+                elif packet_type == 14: # DISCONNECT
+                    return
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker.remove(self)
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+class FakeMQTTBroker:
+    """Minimal MQTT 3.1.1 broker: CONNECT, PUBLISH (QoS 0-2 from clients, delivered at QoS 0), SUBSCRIBE with + and # wildcards,
+    retained messages, PING and DISCONNECT. No authentication, sessions or wills. Counts connections and messages.
+    """
+    def __init__(self, host="127.0.0.1", port=0, faults=None):
+        self.host = host
+        self.port = port
+        self.faults = faults or FaultInjector()
+        self.lock = threading.Lock()
+        self.clients = []
+        self.retained = {}
+        self.counts = {"connections": 0, "messages_received": 0, "messages_delivered": 0}
+        self.topic_counts = {}
+        self.server_socket = None
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counts[name] += amount
+
+    def start(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen(64)
+        self.port = self.server_socket.getsockname()[1]
+        threading.Thread(target=self.accept_loop, name="FakeMQTTBroker", daemon=True).start()
+        return self
+
+    def stop(self):
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR) # Wakes accept_loop so the port is really released and a new broker can take it
+        except OSError:
+            pass
+        try:
+            self.server_socket.close()
+        except OSError:
+            pass
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.sock.shutdown(socket.SHUT_RDWR) # Like a broker restart, the clients see the connection drop
+                client.sock.close()
+            except OSError:
+                pass
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = MQTTClientConnection(self, sock)
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(target=client.serve, name="FakeMQTTBroker-client", daemon=True).start()
+
+    def remove(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def retained_matching(self, topic_filters):
+        with self.lock:
+            return [(topic, payload) for topic, payload in self.retained.items() if any(topic_matches(f, topic) for f in topic_filters)]
+
+    def publish(self, topic, payload, retain=False, from_client=False):
+        """Route a message to the matching subscribers, also used to inject messages (eg. commands from HA)"""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self.lock:
+            if from_client:
+                self.counts["messages_received"] += 1
+                self.topic_counts[topic] = self.topic_counts.get(topic, 0) + 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            clients = [c for c in self.clients if any(topic_matches(f, topic) for f in c.subscriptions)]
+        for client in clients:
+            try:
+                client.deliver(topic, payload)
+            except OSError:
+                pass
+
+if __name__ == "__main__":
+    ha = FakeHomeAssistant(port=8123, simulate_interval=2).start()
+    amber = FakeAmber(port=8124).start()
+    broker = FakeMQTTBroker(port=1883).start()
+    print(f"Home Assistant: {ha.url}  Amber: {amber.url}/v1  MQTT: {broker.host}:{broker.port}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"HA requests: {ha.request_count}, Amber requests: {amber.request_count}, MQTT: {broker.counts}")
+    except KeyboardInterrupt:
+        pass
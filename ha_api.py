@@ -1,4 +1,8 @@
-import requests
+import time
+import json
+import codecs
+import numpy as np
+from http_session import get_shared_client
 from typing import Any, Dict, Optional
 from dataclasses import dataclass
 from datetime import datetime, timedelta
@@ -10,28 +14,163 @@ class History:
 
 UTC_OFFSET = timedelta(hours=10)
 
+def iter_json_objects(chunks):
+    """Yield each JSON object in a streamed response made of (nested) arrays of objects, eg. HA's [[{...}, {...}]]
+    chunks: iterable of bytes. Only the object being decoded is held in memory, not the whole response.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    for chunk in chunks:
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in "[], \t\r\n":
+                position += 1
+            if position >= len(buffer):
+                break
+            try:
+                obj, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break # Object continues in the next chunk
+            yield obj
+            position = end
+    if buffer[position:].strip(" []\t\r\n,"):
+        raise ValueError(f"Incomplete JSON response: {buffer[position:position+100]}")
+
+def to_float(state):
+    try:
+        return float(state)
+    except (TypeError, ValueError): # unavailable/unknown
+        return np.nan
+
+def parse_timestamps(times):
+    """ISO 8601 UTC times (eg. 2025-01-01T00:00:00.123456+00:00 from HA or 2025-01-01T00:00:00Z from Amber) to epoch seconds"""
+    times = [t[:-6] if t.endswith("+00:00") else t[:-1] if t.endswith("Z") else t for t in times]
+    try:
+        return np.array(times, dtype="datetime64[us]").astype(np.int64) / 1e6
+    except ValueError: # Not UTC, take the slow path
+        return np.array([datetime.fromisoformat(t).timestamp() for t in times], dtype=float)
+
+class StateSnapshot:
+    """States of a group of entities fetched with a single /api/states request.
+    Entities that weren't part of the snapshot are fetched individually on first use.
+    """
+    def __init__(self, ha, states, timestamp=None):
+        self.ha = ha
+        self.states = states
+        self.timestamp = timestamp or time.time()
+
+    def get_state(self, entity_id):
+        if entity_id not in self.states:
+            self.states[entity_id] = self.ha.get_state(entity_id)
+        return self.states[entity_id]
+
+    def get_numeric_state(self, entity_id):
+        return float(self.get_state(entity_id)["state"])
+
+    def invalidate(self, *entity_ids): # Drop entities that have been written to so the next read goes to HA
+        for entity_id in entity_ids:
+            self.states.pop(entity_id, None)
+
 class HomeAssistantAPI:
-    def __init__(self, base_url, token, errors):
+    def __init__(self, base_url, token, errors, http=None, cache_ttl=2): # http: HTTPClient, defaults to the shared pooled client
+        self.http = http or get_shared_client()
         self.base_url = base_url.rstrip('/')
         self.headers = {
             "Authorization": f"Bearer {token}",
             "Content-Type": "application/json"
         }
         self.errors = errors
+        self.token = token
+        self.mirror = None # Optional HAStateMirror, see start_mirror
+
+        # Repeated reads of an entity are served from here until new_tick() is called or cache_ttl seconds pass
+        self.cache_ttl = cache_ttl
+        self.state_cache = {}
+        self.cache_hits = 0
+
+    def new_tick(self):
+        self.state_cache = {}
+
+    def cache_states(self, states):
+        now = time.time()
+        for state in states:
+            self.state_cache[state["entity_id"]] = (now, state)
+
+    def invalidate(self, entity_ids):
+        if isinstance(entity_ids, str):
+            entity_ids = [entity_ids]
+        for entity_id in entity_ids:
+            self.state_cache.pop(entity_id, None)
+
+    def start_mirror(self, entity_ids=None, ws_url=None, wait_timeout=10):
+        """Keep the given entities mirrored over the websocket API so reads don't need a request.
+        Reads fall back to REST whenever the websocket is disconnected.
+        """
+        try:
+            from ha_websocket import HAStateMirror # Only needed (along with websocket-client) when the mirror is used
+        except ImportError as e:
+            print(f"HA websocket mirror unavailable, using the REST API: {e}")
+            self.mirror = None
+            return None
+        self.mirror = HAStateMirror(self.base_url, self.token, entity_ids=entity_ids, ws_url=ws_url).start()
+        if not self.mirror.wait_until_connected(wait_timeout):
+            print("HA websocket not connected yet, using REST API until it is")
+        return self.mirror
 
     def get_state(self, entity_id):
+        if self.mirror != None:
+            state = self.mirror.get_state(entity_id)
+            if state != None:
+                return state
+        cached = self.state_cache.get(entity_id)
+        if cached != None and time.time() - cached[0] < self.cache_ttl:
+            self.cache_hits += 1
+            return cached[1]
         url = f"{self.base_url}/api/states/{entity_id}"
-        r = requests.get(url, headers=self.headers)
+        r = self.http.get(url, endpoint="ha_states", headers=self.headers)
         r.raise_for_status()
-        return r.json()
+        state = r.json()
+        self.cache_states([state])
+        return state
     
     def get_numeric_state(self, entity_id):
         json_resp = self.get_state(entity_id)
         return float(json_resp["state"])
 
+    def get_states(self):
+        url = f"{self.base_url}/api/states"
+        r = self.http.get(url, endpoint="ha_states", headers=self.headers)
+        r.raise_for_status()
+        return r.json()
+
+    def get_snapshot(self, entity_ids=None):
+        """Fetch the state of every entity in one request and keep the ones in entity_ids (all if None)."""
+        if self.mirror != None and entity_ids != None and self.mirror.connected:
+            mirrored = self.mirror.states # Read once, the websocket thread replaces it on reconnect
+            states = {entity_id: mirrored.get(entity_id) for entity_id in entity_ids}
+            if all(state != None for state in states.values()):
+                return StateSnapshot(self, states)
+        if entity_ids != None:
+            now = time.time()
+            cached = [self.state_cache.get(entity_id) for entity_id in entity_ids]
+            if all(c != None and now - c[0] < self.cache_ttl for c in cached): # Already fetched this tick
+                self.cache_hits += 1
+                return StateSnapshot(self, {c[1]["entity_id"]: c[1] for c in cached})
+        states = self.get_states()
+        if entity_ids is not None:
+            entity_ids = set(entity_ids)
+            states = [s for s in states if s["entity_id"] in entity_ids]
+        self.cache_states(states)
+        return StateSnapshot(self, {s["entity_id"]: s for s in states})
+
     def call_service(self, domain, service, data):
+        if "entity_id" in data: # The entity's state is about to change, don't serve the old one from the cache
+            self.invalidate(data["entity_id"])
         url = f"{self.base_url}/api/services/{domain}/{service}"
-        r = requests.post(url, json=data, headers=self.headers)
+        r = self.http.post(url, endpoint="ha_services", json=data, headers=self.headers)
         r.raise_for_status()
         return r.json()
     
@@ -58,7 +197,7 @@ class HomeAssistantAPI:
         if end_time:
             params["end_time"] = end_time
 
-        r = requests.get(url, headers=self.headers, params=params)
+        r = self.http.get(url, endpoint="ha_history", headers=self.headers, params=params)
         r.raise_for_status()
         response = r.json()
         history = []
@@ -72,6 +211,37 @@ class HomeAssistantAPI:
 
             history.append(History(state=state_value, time=state_time))
         return history
+
+    def get_history_arrays(self, entity_id, start_time, end_time=None, batch_size=10000):
+        """Fetch history for a specific entity as (timestamps, values) NumPy arrays of epoch seconds and floats,
+        with NaN for states that aren't numbers. The response is parsed as it streams in and HA is asked
+        for the minimal response (state and time only), so no per sample objects are kept around.
+        """
+        url = self.base_url+f"/api/history/period/{start_time}"
+        params = {"filter_entity_id": entity_id, "minimal_response": "", "no_attributes": ""}
+        if end_time:
+            params["end_time"] = end_time
+
+        timestamps = []
+        values = []
+        batch_times = []
+        batch_states = []
+        with self.http.get(url, endpoint="ha_history", headers=self.headers, params=params, stream=True) as r:
+            r.raise_for_status()
+            for state in iter_json_objects(r.iter_content(chunk_size=65536)):
+                batch_times.append(state.get("last_changed") or state["last_updated"]) # Minimal responses only have last_changed after the first state
+                batch_states.append(to_float(state["state"]))
+                if len(batch_times) >= batch_size:
+                    timestamps.append(parse_timestamps(batch_times))
+                    values.append(np.array(batch_states, dtype=float))
+                    batch_times = []
+                    batch_states = []
+        if len(batch_times) > 0:
+            timestamps.append(parse_timestamps(batch_times))
+            values.append(np.array(batch_states, dtype=float))
+        if len(timestamps) == 0:
+            return np.empty(0), np.empty(0)
+        return np.concatenate(timestamps), np.concatenate(values)
     
     def set_switch_state(self, entity_id: str, state: bool):
         if(state == True):
@@ -109,6 +279,6 @@ class HomeAssistantAPI:
     def fire_event(self, event_type, data=None):
         data = data or {}
         url = f"{self.base_url}/api/events/{event_type}"
-        r = requests.post(url, json=data, headers=self.headers)
+        r = self.http.post(url, endpoint="ha_events", json=data, headers=self.headers)
         r.raise_for_status()
         return r.json()
\ No newline at end of file
@@ -1,66 +1,267 @@
-from paho.mqtt.client import Client, MQTTMessage
-from ha_mqtt_discoverable import Settings, DeviceInfo
-from ha_mqtt_discoverable.sensors import Select, SelectInfo, SensorInfo, Sensor, NumberInfo, Number
+from paho.mqtt.client import Client, MQTTMessage, CallbackAPIVersion
 from api_token_secrets import MQTT_HOST, MQTT_USER, MQTT_PASS
+import api_token_secrets
 import time
+import threading
 
+# ha_mqtt_discoverable (and pydantic under it) is only imported once the broker connects, in MQTTConnection.build_entities
 
-# Configure the required parameters for the MQTT broker
-mqtt_settings = Settings.MQTT(host=MQTT_HOST, username=MQTT_USER, password=MQTT_PASS)
+MQTT_PORT = getattr(api_token_secrets, "MQTT_PORT", 1883) # Optional in api_token_secrets
 
 # Define the device. At least one of `identifiers` or `connections` must be supplied
-device_info = DeviceInfo(name="Energy Manager Device", identifiers="energy-manager-py")
+DEVICE_NAME = "Energy Manager Device"
+DEVICE_IDENTIFIERS = "energy-manager-py"
+
+class MQTTConnection():
+    """One paho client and network thread shared by every entity instead of one each.
+    start() connects in the background and returns straight away, the controller runs without MQTT until the broker answers.
+    On the first connection every entity is built and their discovery configs are published together.
+    Command topics all land in dispatch(), which hands them to the callback registered for the topic.
+    """
+    def __init__(self, host, port, username, password):
+        self.host = host
+        self.port = port
+        self.client = Client(callback_api_version=CallbackAPIVersion.VERSION2)
+        self.client.username_pw_set(username, password=password)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=120) # One client backing off after a broker restart, not one per entity
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.command_callbacks = {} # command topic -> callback(client, user_data, message)
+        self.entities = [] # CreateSensor/CreateSelectInput/CreateNumberInput wrappers, built on the first connection
+        self.discoverables = [] # The ha_mqtt_discoverable entity built for each of them
+        self.connected = threading.Event()
+        self.ready = threading.Event() # Set once the entities are built and their discovery is published
+        self.started = False
+        self.connections = 0
+
+    def start(self):
+        if(self.started):
+            return
+        self.started = True
+        self.client.connect_async(self.host, self.port)
+        self.client.loop_start() # Keeps retrying in the background until the broker answers
+
+    def on_connect(self, client, user_data, flags, reason_code, properties):
+        if(reason_code.is_failure):
+            print(f"MQTT connection refused: {reason_code}")
+            return
+        self.connections += 1
+        self.connected.set()
+        try:
+            if(not self.ready.is_set()):
+                self.build_entities()
+            else: # Reconnected, the broker may have lost our subscriptions and retained configs
+                print("MQTT reconnected, resubscribing and republishing discovery")
+                if(len(self.command_callbacks) > 0):
+                    client.subscribe([(topic, 1) for topic in self.command_callbacks])
+            self.publish_discovery()
+            for entity, discoverable in zip(self.entities, self.discoverables):
+                entity.on_connected(discoverable)
+            self.ready.set()
+        except Exception as e: # Don't let it kill paho's network thread, the next connection tries again
+            print(f"Failed to set up the MQTT entities: {e}")
+
+    def on_disconnect(self, client, user_data, flags, reason_code, properties):
+        self.connected.clear()
+        if(reason_code.is_failure):
+            print(f"MQTT disconnected: {reason_code}, reconnecting")
+
+    def build_entities(self):
+        from ha_mqtt_discoverable import Settings, DeviceInfo
+        mqtt_settings = Settings.MQTT(host=self.host, port=self.port, client=self.client)
+        device_info = DeviceInfo(name=DEVICE_NAME, identifiers=DEVICE_IDENTIFIERS)
+        discoverables = [entity.build(mqtt_settings, device_info) for entity in self.entities]
+        for discoverable in discoverables:
+            discoverable.wrote_configuration = True # Stops the entity writing its own config on its first state, publish_discovery does it
+        self.discoverables = discoverables
+
+    def add_command_callback(self, topic, callback):
+        self.command_callbacks[topic] = callback
+
+    def dispatch(self, client, user_data, message: MQTTMessage):
+        callback = self.command_callbacks.get(message.topic)
+        if(callback == None):
+            return
+        try:
+            callback(client, user_data, message)
+        except Exception as e: # Don't let a bad command kill paho's network thread
+            print(f"Error handling MQTT command on {message.topic}: {e}")
+
+    def register(self, entity):
+        self.entities.append(entity)
+        return entity
+
+    def publish_discovery(self):
+        for discoverable in self.discoverables:
+            discoverable.write_config()
+
+# Configure the required parameters for the MQTT broker
+connection = MQTTConnection(host=MQTT_HOST, port=MQTT_PORT, username=MQTT_USER, password=MQTT_PASS)
 
+def initialise():
+    """Start connecting to the broker in the background, the entities appear in HA once it answers"""
+    connection.start()
 
-def CreateSensor(name, unique_id, unit_of_measurement, state_class="measurement", device_class=None):
-    sensor_info = SensorInfo(name=name, unique_id=unique_id, device=device_info, unit_of_measurement=unit_of_measurement, state_class=state_class, device_class=device_class)
-    sensor_settings = Settings(mqtt=mqtt_settings, entity=sensor_info)
-    return Sensor(sensor_settings)
+
+# When a new state is worth publishing, per kind of sensor. Anything not published is dropped, not queued.
+# deadband: smallest absolute change that gets published, relative_deadband: the same as a fraction of the last published value
+# min_interval: seconds a changed value waits after the last publish, max_interval: seconds before the state is resent even if unchanged (heartbeat)
+PUBLISH_POLICIES = {
+    "price": {"deadband": 1, "relative_deadband": 0, "min_interval": 0, "max_interval": 300}, # c/kWh, decisions hang off these so send them straight away
+    "energy": {"deadband": 0.05, "relative_deadband": 0, "min_interval": 10, "max_interval": 300}, # kWh
+    "power": {"deadband": 20, "relative_deadband": 0.02, "min_interval": 10, "max_interval": 300}, # w
+    "state": {"deadband": 0, "relative_deadband": 0, "min_interval": 0, "max_interval": 600}, # Strings, only sent when they change
+    "default": {"deadband": 0, "relative_deadband": 0, "min_interval": 5, "max_interval": 300},
+}
+
+def sensor_kind(unit_of_measurement):
+    if(unit_of_measurement == "c/kWh"):
+        return "price"
+    if(unit_of_measurement == "kWh"):
+        return "energy"
+    if(unit_of_measurement in ("w", "W", "kW")):
+        return "power"
+    if(unit_of_measurement == None):
+        return "state"
+    return "default"
+
+class ThrottledSensor():
+    """Wraps a Sensor so set_state can be called every tick but only changes past the deadband (or a heartbeat) go out over MQTT.
+    States set before the broker has connected are dropped.
+    """
+    def __init__(self, sensor_info, deadband=0, relative_deadband=0, min_interval=0, max_interval=300):
+        self.sensor_info = sensor_info # SensorInfo arguments, the Sensor is built by MQTTConnection
+        self.entity = None
+        self.deadband = deadband
+        self.relative_deadband = relative_deadband
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.last_value = None
+        self.last_publish_time = None
+        self.published = 0
+        self.suppressed = 0
+
+    def build(self, mqtt_settings, device_info):
+        from ha_mqtt_discoverable import Settings
+        from ha_mqtt_discoverable.sensors import SensorInfo, Sensor
+        sensor_info = SensorInfo(device=device_info, **self.sensor_info)
+        return Sensor(Settings(mqtt=mqtt_settings, entity=sensor_info))
+
+    def on_connected(self, entity):
+        self.entity = entity
+        self.last_publish_time = None # Send the next state straight away
+
+    def should_publish(self, state, now):
+        if(self.last_publish_time == None):
+            return True
+        since_last_publish = now - self.last_publish_time
+        if(since_last_publish >= self.max_interval):
+            return True # Heartbeat so HA can tell the value is still current
+        if(since_last_publish < self.min_interval or state == self.last_value):
+            return False
+        if(isinstance(state, (int, float)) and isinstance(self.last_value, (int, float))):
+            threshold = max(self.deadband, self.relative_deadband * abs(self.last_value))
+            return threshold == 0 or abs(state - self.last_value) >= threshold # Compared to the last published value so slow drift still gets sent
+        return True
+
+    def set_state(self, state, force=False):
+        now = time.monotonic()
+        if(self.entity != None and (force or self.should_publish(state, now))):
+            self.entity.set_state(state)
+            self.last_value = state
+            self.last_publish_time = now
+            self.published += 1
+        else:
+            self.suppressed += 1
+
+sensors = [] # Every sensor made by CreateSensor, for publish_counts()
+
+def CreateSensor(name, unique_id, unit_of_measurement, state_class="measurement", device_class=None, kind=None, **policy):
+    """kind picks the publish policy from PUBLISH_POLICIES (guessed from the unit if not given), policy overrides parts of it"""
+    sensor_info = dict(name=name, unique_id=unique_id, unit_of_measurement=unit_of_measurement, state_class=state_class, device_class=device_class)
+    publish_policy = dict(PUBLISH_POLICIES[kind or sensor_kind(unit_of_measurement)])
+    publish_policy.update(policy)
+    sensor = connection.register(ThrottledSensor(sensor_info, **publish_policy))
+    sensors.append(sensor)
+    return sensor
+
+def publish_counts():
+    """(states published, states suppressed) over all the sensors"""
+    return sum(sensor.published for sensor in sensors), sum(sensor.suppressed for sensor in sensors)
 
 class CreateSelectInput():
     def __init__(self, name, unique_id, options):
         self.state = None
         self.options = options
         self.name = name
-        select_info = SelectInfo(name=name, unique_id=unique_id, device=device_info, options=options, device_class=None,retain=True)
-        settings = Settings(mqtt=mqtt_settings, entity=select_info)
-        self.entity = Select(settings, self.callback_function)
-        self.entity.select_option(options[0])
-        self.entity.write_config()
+        self.unique_id = unique_id
+        self.entity = None # Built by MQTTConnection once the broker connects
+        self.listeners = []
+        connection.register(self)
+
+    def build(self, mqtt_settings, device_info):
+        from ha_mqtt_discoverable import Settings
+        from ha_mqtt_discoverable.sensors import Select, SelectInfo
+        select_info = SelectInfo(name=self.name, unique_id=self.unique_id, device=device_info, options=self.options, device_class=None,retain=True)
+        entity = Select(Settings(mqtt=mqtt_settings, entity=select_info), connection.dispatch)
+        connection.add_command_callback(entity._command_topic, self.callback_function)
+        return entity
+
+    def on_connected(self, entity):
+        self.entity = entity
+        self.entity.select_option(self.state if self.state != None else self.options[0])
+
+    def add_listener(self, callback): # callback(state) is called from the MQTT thread when HA changes the selection
+        self.listeners.append(callback)
         
     def callback_function(self, client: Client, user_data, message: MQTTMessage):
         self.state = message.payload.decode()
         self.entity.select_option(self.state)
+        for callback in self.listeners:
+            callback(self.state)
         
     def set_state(self, state):
         if(state in self.options):
-            self.entity.select_option(state)
+            if(self.entity != None):
+                self.entity.select_option(state)
             self.state = state
         else:
             raise(f"{state} option is not a valid option: {self.options} for {self.name} selector")
 
 
 class CreateNumberInput():
-    def __init__(self, name, unique_id, unit_of_measurement):
-        self.value = None
-        number_info = NumberInfo(name=name, unique_id=unique_id, device=device_info, min=0, max=50, mode="box", step=1, unit_of_measurement=unit_of_measurement, retain=True)
-        settings = Settings(mqtt=mqtt_settings, entity=number_info)
-        # Send an MQTT message to confirm to HA that the value was changed
-        self.entity = Number(settings, self.callback_function)
+    def __init__(self, name, unique_id, unit_of_measurement, default=None): # default: value until HA sends one
+        self.value = default
+        self.name = name
+        self.unique_id = unique_id
+        self.unit_of_measurement = unit_of_measurement
+        self.entity = None # Built by MQTTConnection once the broker connects
+        self.listeners = []
+        connection.register(self)
+
+    def build(self, mqtt_settings, device_info):
+        from ha_mqtt_discoverable import Settings
+        from ha_mqtt_discoverable.sensors import NumberInfo, Number
+        number_info = NumberInfo(name=self.name, unique_id=self.unique_id, device=device_info, min=0, max=50, mode="box", step=1, unit_of_measurement=self.unit_of_measurement, retain=True)
+        entity = Number(Settings(mqtt=mqtt_settings, entity=number_info), connection.dispatch)
+        connection.add_command_callback(entity._command_topic, self.callback_function)
+        return entity
+
+    def on_connected(self, entity):
+        self.entity = entity
+
+    def add_listener(self, callback): # callback(value) is called from the MQTT thread when HA changes the value
+        self.listeners.append(callback)
         
     def callback_function(self, client: Client, user_data, message: MQTTMessage):
         self.value = int(message.payload.decode())
         # Send an MQTT message to confirm to HA that the value was changed
         self.entity.set_value(self.value)
+        for callback in self.listeners:
+            callback(self.value)
 
 
-class CreateText():
-    def __init__(self, name, unique_id, unit_of_measurement):
-        self.value = None
-        number_info = NumberInfo(name=name, unique_id=unique_id, device=device_info, min=0, max=50, mode="box", step=1, unit_of_measurement=unit_of_measurement, retain=True)
-        settings = Settings(mqtt=mqtt_settings, entity=number_info)
-        self.entity = Number(settings, self.callback_function)
-        
+class CreateText(CreateNumberInput):
     def callback_function(self, client: Client, user_data, message: MQTTMessage):
         self.value = int(message.payload.decode())
         # Send an MQTT message to confirm to HA that the number was changed
@@ -75,7 +276,8 @@ controller_update_selector = CreateSelectInput(
 min_dispatch_price_number = CreateNumberInput(
     name="Min Dispatch Price",
     unique_id="min_dispatch_price",
-    unit_of_measurement="c/kWh"
+    unit_of_measurement="c/kWh",
+    default=10 # Until HA sends the value it holds, or for good if the broker can't be reached
 )
 
 base_load_sensor = CreateSensor(
@@ -87,7 +289,8 @@ base_load_sensor = CreateSensor(
 alive_time_sensor = CreateSensor(
     name = "Alive Time",
     unique_id="alive-time-python",
-    unit_of_measurement="s"
+    unit_of_measurement="s",
+    min_interval=60 # Counts up every tick, only needed to show the manager is still running
 )
 
 working_mode_sensor = CreateSensor(
@@ -101,7 +304,8 @@ system_state_sensor = CreateSensor(
     name = "System State",
     unique_id="system_state_python",
     unit_of_measurement=None,
-    state_class = None
+    state_class = None,
+    min_interval=10 # Includes the export power so it changes nearly every tick
 )
 
 effective_price_sensor = CreateSensor(
@@ -123,7 +327,8 @@ current_general_price_sensor = CreateSensor(
 amber_api_calls_remaining_sensor = CreateSensor(
     name = "Remaining API Calls",
     unique_id="remaining_api_calls_python",
-    unit_of_measurement="calls"
+    unit_of_measurement="calls",
+    min_interval=30
 )
 
 max_feedIn_sensor = CreateSensor(
@@ -160,7 +365,40 @@ kwh_required_overnight_sensor = CreateSensor(
 avg_daily_load_sensor = CreateSensor(
     name = "Average Daily Load",
     unique_id="avg_daily_load_python",
-    unit_of_measurement="kWh"
+    unit_of_measurement="kWh",
+    deadband=0.1,
+    min_interval=300 # Only changes when the load model is rebuilt
+)
+
+tick_time_sensor = CreateSensor(
+    name = "Tick Time",
+    unique_id="tick_time_python",
+    unit_of_measurement="ms"
+)
+
+tick_time_p95_sensor = CreateSensor(
+    name = "Tick Time p95",
+    unique_id="tick_time_p95_python",
+    unit_of_measurement="ms"
+)
+
+http_requests_per_tick_sensor = CreateSensor(
+    name = "HTTP Requests Per Tick",
+    unique_id="http_requests_per_tick_python",
+    unit_of_measurement="requests"
+)
+
+http_kb_per_tick_sensor = CreateSensor(
+    name = "HTTP kB Per Tick",
+    unique_id="http_kb_per_tick_python",
+    unit_of_measurement="kB"
+)
+
+slowest_phase_sensor = CreateSensor(
+    name = "Slowest Tick Phase",
+    unique_id="slowest_tick_phase_python",
+    unit_of_measurement=None,
+    state_class = None
 )
 
 def initalise_entities():
@@ -180,6 +418,11 @@ def initalise_entities():
     effective_price_sensor.set_state(0)
     base_load_sensor.set_state(0)
     avg_daily_load_sensor.set_state(0)
+    tick_time_sensor.set_state(0)
+    tick_time_p95_sensor.set_state(0)
+    http_requests_per_tick_sensor.set_state(0)
+    http_kb_per_tick_sensor.set_state(0)
+    slowest_phase_sensor.set_state("None")
     time.sleep(10)
 
 #initalise_entities()
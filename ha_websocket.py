@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+import websocket # websocket-client
+
+class HAStateMirror:
+    """In-memory copy of Home Assistant entity states kept up to date over the websocket API.
+    Subscribes to state_changed events then loads the current states, so no change is missed in between.
+    get_state returns None while disconnected so callers can fall back to the REST API.
+    """
+    def __init__(self, base_url, token, entity_ids=None, ws_url=None, reconnect_delay=5, ping_interval=30):
+        if ws_url == None:
+            ws_url = base_url.rstrip('/').replace("https://", "wss://").replace("http://", "ws://") + "/api/websocket"
+        self.ws_url = ws_url
+        self.token = token
+        self.entity_ids = set(entity_ids) if entity_ids != None else None # None mirrors every entity
+        self.reconnect_delay = reconnect_delay
+        self.ping_interval = ping_interval
+
+        self.states = {}
+        self.connected = False # True once subscribed and the initial states have been loaded
+        self.listeners = []
+        self.last_message_timestamp = 0
+        self.reconnects = 0
+
+        self.ws = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.message_id = 0
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="ha-websocket", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.ws != None:
+            try:
+                self.ws.close()
+            except Exception:
+                pass
+        if self.thread != None:
+            self.thread.join(timeout=5)
+
+    def wait_until_connected(self, timeout=10):
+        end_time = time.time() + timeout
+        while not self.connected and time.time() < end_time:
+            time.sleep(0.05)
+        return self.connected
+
+    def get_state(self, entity_id):
+        if not self.connected:
+            return None
+        return self.states.get(entity_id)
+
+    def add_listener(self, callback): # callback(entity_id, new_state) is called from the websocket thread on every change
+        self.listeners.append(callback)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.connect_and_listen()
+            except Exception as e:
+                if not self.stop_event.is_set():
+                    print(f"HA websocket disconnected: {e}")
+            self.connected = False
+            if self.stop_event.wait(self.reconnect_delay):
+                break
+            self.reconnects += 1
+
+    def next_id(self):
+        self.message_id += 1
+        return self.message_id
+
+    def send(self, message):
+        self.ws.send(json.dumps(message))
+
+    def connect_and_listen(self):
+        self.ws = websocket.create_connection(self.ws_url, timeout=self.ping_interval)
+        try:
+            message = json.loads(self.ws.recv())
+            if message.get("type") != "auth_required":
+                raise Exception(f"Unexpected websocket message: {message}")
+            self.send({"type": "auth", "access_token": self.token})
+            message = json.loads(self.ws.recv())
+            if message.get("type") != "auth_ok":
+                raise Exception(f"Websocket authentication failed: {message}")
+
+            self.message_id = 0
+            self.send({"id": self.next_id(), "type": "subscribe_events", "event_type": "state_changed"})
+            states_request_id = self.next_id()
+            self.send({"id": states_request_id, "type": "get_states"})
+
+            self.last_message_timestamp = time.time()
+            while not self.stop_event.is_set():
+                try:
+                    raw = self.ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    if time.time() - self.last_message_timestamp > 2*self.ping_interval:
+                        raise Exception("No response to ping")
+                    self.send({"id": self.next_id(), "type": "ping"})
+                    continue
+                if not raw:
+                    raise Exception("Connection closed")
+                self.last_message_timestamp = time.time()
+                message = json.loads(raw)
+
+                if message.get("type") == "event":
+                    data = message["event"]["data"]
+                    self.update_state(data["entity_id"], data.get("new_state"))
+                elif message.get("type") == "result" and message.get("id") == states_request_id:
+                    if not message.get("success"):
+                        raise Exception(f"get_states failed: {message}")
+                    self.states = {
+                        s["entity_id"]: s for s in message["result"]
+                        if self.entity_ids == None or s["entity_id"] in self.entity_ids
+                    }
+                    self.connected = True
+        finally:
+            self.connected = False
+            self.ws.close()
+
+    def update_state(self, entity_id, new_state):
+        if self.entity_ids != None and entity_id not in self.entity_ids:
+            return
+        states = dict(self.states) # Replace rather than mutate so a snapshot reading the old dict sees one consistent set of states
+        if new_state == None: # Entity was removed
+            states.pop(entity_id, None)
+        else:
+            states[entity_id] = new_state
+        self.states = states
+        if self.connected:
+            for callback in self.listeners:
+                try:
+                    callback(entity_id, new_state)
+                except Exception as e:
+                    print(f"HA websocket listener failed: {e}")
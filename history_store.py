@@ -0,0 +1,86 @@
+import os
+import sqlite3
+import threading
+import time
+import datetime
+import numpy as np
+from ha_api import History, UTC_OFFSET
+
+DATA_DIR = os.environ.get("ENERGY_MANAGER_DATA_DIR", os.path.dirname(os.path.abspath(__file__))) # Where local state is kept, next to the code unless overridden
+os.makedirs(DATA_DIR, exist_ok=True)
+DEFAULT_PATH = os.path.join(DATA_DIR, "history.db")
+
+class HistoryStore:
+    """Local SQLite copy of HA sensor history.
+    Each entity remembers the time range it has been synced for, so only the part of a request
+    outside that range is downloaded from HA, in chunks of at most fetch_chunk_days.
+    """
+    def __init__(self, ha, path=DEFAULT_PATH, fetch_chunk_days=7, retention_days=400):
+        self.ha = ha
+        self.fetch_chunk_days = fetch_chunk_days
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS samples (entity_id TEXT, ts REAL, value REAL, PRIMARY KEY (entity_id, ts)) WITHOUT ROWID")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS synced (entity_id TEXT PRIMARY KEY, start_ts REAL, end_ts REAL)")
+
+    def synced_range(self, entity_id):
+        row = self.conn.execute("SELECT start_ts, end_ts FROM synced WHERE entity_id = ?", (entity_id,)).fetchone()
+        return row if row != None else (None, None)
+
+    def fetch(self, entity_id, start_ts, end_ts): # Download [start_ts, end_ts] from HA and store it
+        chunk_start = start_ts
+        while chunk_start < end_ts:
+            chunk_end = min(chunk_start + self.fetch_chunk_days*24*60*60, end_ts)
+            timestamps, values = self.ha.get_history_arrays(
+                entity_id,
+                start_time=datetime.datetime.fromtimestamp(chunk_start, datetime.timezone.utc).isoformat(),
+                end_time=datetime.datetime.fromtimestamp(chunk_end, datetime.timezone.utc).isoformat())
+            with self.conn: # NaN is stored as NULL
+                self.conn.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?)", zip([entity_id]*len(timestamps), timestamps.tolist(), values.tolist()))
+            chunk_start = chunk_end
+
+    def sync(self, entity_id, start_ts, end_ts):
+        end_ts = min(end_ts, time.time())
+        synced_start, synced_end = self.synced_range(entity_id)
+        if synced_start == None or end_ts < synced_start or start_ts > synced_end: # Nothing usable stored, the gap would be refetched anyway
+            with self.conn:
+                self.conn.execute("DELETE FROM samples WHERE entity_id = ?", (entity_id,))
+            self.fetch(entity_id, start_ts, end_ts)
+            synced_start, synced_end = start_ts, end_ts
+        else:
+            if start_ts < synced_start:
+                self.fetch(entity_id, start_ts, synced_start)
+                synced_start = start_ts
+            if end_ts > synced_end:
+                self.fetch(entity_id, synced_end, end_ts)
+                synced_end = end_ts
+
+        oldest_kept = time.time() - self.retention_days*24*60*60
+        synced_start = max(synced_start, oldest_kept)
+        with self.conn:
+            self.conn.execute("DELETE FROM samples WHERE entity_id = ? AND ts < ?", (entity_id, oldest_kept))
+            self.conn.execute("INSERT OR REPLACE INTO synced VALUES (?, ?, ?)", (entity_id, synced_start, synced_end))
+
+    def get_arrays(self, entity_id, start_time, end_time):
+        """(timestamps, values) NumPy arrays of epoch seconds and floats (NaN for unavailable) sorted by time.
+        start_time and end_time must be timezone aware datetimes.
+        """
+        start_ts = start_time.timestamp()
+        end_ts = end_time.timestamp()
+        with self.lock:
+            self.sync(entity_id, start_ts, end_ts)
+            rows = self.conn.execute(
+                "SELECT ts, value FROM samples WHERE entity_id = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (entity_id, start_ts, end_ts)).fetchall()
+        rows = np.array(rows, dtype=float).reshape(-1, 2) # NULL becomes NaN
+        return rows[:, 0], rows[:, 1]
+
+    def get_history(self, entity_id, start_time, end_time):
+        """Same result as HomeAssistantAPI.get_history"""
+        timestamps, values = self.get_arrays(entity_id, start_time, end_time)
+        return [
+            History(state=None if np.isnan(value) else value, time=datetime.datetime.fromtimestamp(ts, datetime.timezone.utc) + UTC_OFFSET)
+            for ts, value in zip(timestamps.tolist(), values.tolist())
+        ]
@@ -0,0 +1,92 @@
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+
+DEFAULT_TIMEOUT = (3.05, 10) # (connect, read) seconds
+
+# Per endpoint (connect, read) timeouts, anything not listed uses DEFAULT_TIMEOUT
+ENDPOINT_TIMEOUTS = {
+    "ha_history": (3.05, 60), # Days of history can take HA a while to put together
+    "amber": (5, 15),
+}
+
+class HTTPClient:
+    """requests.Session shared between the API clients so connections are kept alive and reused.
+    Every request gets a timeout, chosen by the endpoint name passed with it.
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=10, timeouts=None, default_timeout=DEFAULT_TIMEOUT):
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", self.adapter)
+        self.session.mount("https://", self.adapter)
+        self.timeouts = dict(ENDPOINT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self.default_timeout = default_timeout
+        self.request_count = 0
+
+    def timeout_for(self, endpoint):
+        return self.timeouts.get(endpoint, self.default_timeout)
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        kwargs.setdefault("timeout", self.timeout_for(endpoint))
+        self.request_count += 1
+        started = time.perf_counter()
+        try:
+            r = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            metrics.record_request(endpoint, time.perf_counter() - started, 0, error=True)
+            raise
+        # Streamed bodies haven't been read yet, count them by Content-Length when there is one
+        response_bytes = int(r.headers.get("Content-Length", 0) or 0) if kwargs.get("stream") else len(r.content)
+        metrics.record_request(endpoint, r.elapsed.total_seconds(), response_bytes, error=r.status_code >= 400)
+        return r
+
+    def get(self, url, endpoint=None, **kwargs):
+        return self.request("GET", url, endpoint=endpoint, **kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        return self.request("POST", url, endpoint=endpoint, **kwargs)
+
+    def stats(self):
+        """Connections opened vs requests sent for each host, requests - connections were served by a reused connection."""
+        stats = {}
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool == None:
+                continue
+            host = f"{pool.scheme}://{pool.host}:{pool.port}"
+            stats[host] = {
+                "requests": pool.num_requests,
+                "connections": pool.num_connections,
+                "reused": pool.num_requests - pool.num_connections,
+            }
+        return stats
+
+    def stats_summary(self):
+        return ", ".join(
+            f"{host}: {s['requests']} requests over {s['connections']} connections ({s['reused']} reused)"
+            for host, s in self.stats().items()
+        ) or "No requests yet"
+
+    def close(self):
+        self.session.close()
+
+
+shared_client = None
+
+def get_shared_client():
+    global shared_client
+    if shared_client == None:
+        shared_client = HTTPClient()
+    return shared_client
+
+def configure_shared_client(**kwargs):
+    """Replace the shared client, eg. configure_shared_client(pool_maxsize=20, timeouts={"ha_states": (2, 5)})"""
+    global shared_client
+    if shared_client != None:
+        shared_client.close()
+    shared_client = HTTPClient(**kwargs)
+    return shared_client
@@ -0,0 +1,204 @@
+import threading
+import numpy as np
+from ha_api import UTC_OFFSET
+
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = int(24*60/SLOT_MINUTES)
+
+def fill_gaps(grid):
+    """Linearly interpolate the NaN slots in each row of grid from the nearest slots with data either side.
+    Slots before the first or after the last value in a row take that value. Rows with no data are left as NaN.
+    """
+    slots = np.arange(grid.shape[1])
+    valid = ~np.isnan(grid)
+    prev_index = np.maximum.accumulate(np.where(valid, slots, -1), axis=1)
+    next_index = np.flip(np.minimum.accumulate(np.flip(np.where(valid, slots, grid.shape[1]), axis=1), axis=1), axis=1)
+    has_prev = prev_index >= 0
+    has_next = next_index < grid.shape[1]
+    rows = np.arange(grid.shape[0])[:, None]
+    prev_value = grid[rows, np.clip(prev_index, 0, grid.shape[1]-1)]
+    next_value = grid[rows, np.clip(next_index, 0, grid.shape[1]-1)]
+
+    filled = np.where(has_prev, prev_value, next_value) # Edges take the nearest value
+    between = has_prev & has_next & ~valid
+    fraction = (slots - prev_index)[between] / (next_index - prev_index)[between]
+    filled[between] = prev_value[between] + fraction * (next_value[between] - prev_value[between])
+    return np.where(valid, grid, filled)
+
+def build_load_profile(timestamps, values, slot_minutes=SLOT_MINUTES, reset_threshold=0.05, utc_offset=UTC_OFFSET):
+    """Average day of a daily cumulative kWh sensor (eg. sensor.sigen_plant_daily_load_consumption).
+    timestamps: epoch seconds, values: kWh with NaN for unavailable samples.
+    Samples are averaged into slot_minutes slots per local day, slots without samples are interpolated,
+    then each slot is averaged over the days that have data.
+    Returns (profile, days) where profile has one kWh value per slot and days is the (number of days, slots) grid.
+    """
+    slots_per_day = int(24*60/slot_minutes)
+    timestamps = np.asarray(timestamps, dtype=float)
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    timestamps = timestamps[valid]
+    values = values[valid]
+    if len(values) == 0:
+        raise Exception("No load history to build the load profile from")
+    if np.any(np.diff(timestamps) < 0):
+        order = np.argsort(timestamps, kind="stable")
+        timestamps = timestamps[order]
+        values = values[order]
+
+    local_seconds = np.floor(timestamps + utc_offset.total_seconds()).astype(np.int64)
+    day_number = local_seconds // 86400
+    day_start = np.flatnonzero(np.diff(day_number, prepend=day_number[0]-1)) # index of the first sample of each day
+    day_index = np.cumsum(np.diff(day_number, prepend=day_number[0]) != 0)
+    slot = (local_seconds - day_number*86400) // (slot_minutes*60)
+
+    # The first samples of a day can still hold yesterday's total until the sensor resets, drop everything before the first reset
+    reset_position = np.flatnonzero(values <= reset_threshold)
+    next_reset = np.searchsorted(reset_position, day_start)
+    first_reset = np.append(reset_position, len(values))[next_reset] # days without a reset are dropped
+    keep = np.arange(len(values)) >= first_reset[day_index]
+
+    key = day_index[keep]*slots_per_day + slot[keep]
+    sums = np.bincount(key, weights=values[keep], minlength=len(day_start)*slots_per_day)
+    counts = np.bincount(key, minlength=len(day_start)*slots_per_day)
+    with np.errstate(invalid="ignore"):
+        days = (sums / counts).reshape(len(day_start), slots_per_day)
+
+    days = fill_gaps(days[~np.all(np.isnan(days), axis=1)])
+    if len(days) == 0:
+        raise Exception("No complete days of load history to build the load profile from")
+    return days.mean(axis=0), days
+
+class LoadProfileIndex:
+    """Cumulative kWh of an average day at every slot boundary, answers how much load is expected
+    between two times of day in constant time. Times between slots are linearly interpolated.
+    """
+    def __init__(self, profile, slot_minutes=SLOT_MINUTES):
+        # profile[i] is the kWh used since midnight by slot i, the day total closes the last slot
+        self.cumulative = [float(v) for v in profile] + [float(profile[-1])]
+        self.slot_seconds = slot_minutes*60
+        self.day_total = self.cumulative[-1]
+
+    def kwh_at(self, seconds):
+        position = min(max(seconds / self.slot_seconds, 0), len(self.cumulative)-1)
+        i = min(int(position), len(self.cumulative)-2)
+        return self.cumulative[i] + (position - i) * (self.cumulative[i+1] - self.cumulative[i])
+
+    def kwh_between_seconds(self, start_seconds, end_seconds):
+        if(end_seconds >= start_seconds):
+            return self.kwh_at(end_seconds) - self.kwh_at(start_seconds)
+        return self.day_total - self.kwh_at(start_seconds) + self.kwh_at(end_seconds) # Wraps past midnight
+
+    def kwh_between_arrays(self, start_seconds, end_seconds):
+        """kwh_between_seconds for NumPy arrays of seconds since midnight"""
+        boundaries = np.arange(len(self.cumulative)) * self.slot_seconds
+        start_kwh = np.interp(start_seconds, boundaries, self.cumulative)
+        end_kwh = np.interp(end_seconds, boundaries, self.cumulative)
+        return np.where(end_seconds >= start_seconds, end_kwh - start_kwh, self.day_total - start_kwh + end_kwh)
+
+    def kwh_between(self, start, end):
+        """kWh expected from start until end (datetime or datetime.time), wrapping past midnight if end is earlier in the day"""
+        return self.kwh_between_seconds(seconds_since_midnight(start), seconds_since_midnight(end))
+
+    def kwh_for_hours(self, start, hours):
+        """kWh expected over the given number of hours from start (datetime or datetime.time)"""
+        start_seconds = seconds_since_midnight(start)
+        whole_days, remainder = divmod(hours*3600, 86400)
+        kwh = whole_days*self.day_total
+        if(remainder > 0):
+            kwh += self.kwh_between_seconds(start_seconds, (start_seconds + remainder) % 86400)
+        return kwh
+
+class IncrementalLoadProfile:
+    """Average day kept up to date from live load power, one slot at a time.
+    Power samples are integrated into the current slot, when it ends its kWh are folded into that slot's
+    exponentially weighted mean and variance. Slots with less than min_coverage of samples are dropped.
+    seed() starts it from the days x slots grid build_load_profile returns.
+    """
+    def __init__(self, alpha=0.5, slot_minutes=SLOT_MINUTES, min_coverage=0.5, max_sample_gap=5*60, utc_offset=UTC_OFFSET):
+        self.alpha = alpha # Weight of the newest day in each slot
+        self.slot_seconds = slot_minutes*60
+        self.slots_per_day = int(24*60/slot_minutes)
+        self.min_coverage = min_coverage
+        self.max_sample_gap = max_sample_gap # Longer gaps between samples aren't integrated
+        self.offset_seconds = utc_offset.total_seconds()
+        self.mean = np.zeros(self.slots_per_day) # kWh used in each slot
+        self.variance = np.zeros(self.slots_per_day)
+        self.counts = np.zeros(self.slots_per_day, dtype=np.int64) # Days folded into each slot
+        self.current_slot = None # Slots since the epoch in local time
+        self.slot_kwh = 0
+        self.slot_covered = 0 # Seconds of the current slot with samples
+        self.last_timestamp = None
+        self.last_value = None
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self): # Every slot has at least a day in it
+        return bool(np.all(self.counts > 0))
+
+    def seed(self, days):
+        increments = np.clip(np.diff(days, axis=1, prepend=0), 0, None) # Cumulative kWh to kWh per slot, the daily reset isn't usage
+        with self.lock:
+            self.mean = increments.mean(axis=0)
+            self.variance = increments.var(axis=0)
+            self.counts = np.full(self.slots_per_day, len(days), dtype=np.int64)
+
+    def fold(self, slot, kwh):
+        self.counts[slot] += 1
+        alpha = max(self.alpha, 1/self.counts[slot]) # Plain mean until there are enough days for the weighting
+        diff = kwh - self.mean[slot]
+        increment = alpha * diff
+        self.mean[slot] += increment
+        self.variance[slot] = (1-alpha) * (self.variance[slot] + diff*increment)
+
+    def move_to(self, slot): # Returns True if the slot being left was folded in
+        if(slot == self.current_slot):
+            return False
+        folded = False
+        if(self.current_slot != None and self.slot_covered >= self.min_coverage*self.slot_seconds):
+            self.fold(self.current_slot % self.slots_per_day, self.slot_kwh * self.slot_seconds/self.slot_covered)
+            folded = True
+        self.current_slot = slot
+        self.slot_kwh = 0
+        self.slot_covered = 0
+        return folded
+
+    def add(self, kw, timestamp):
+        """Add a load power sample (kW at epoch seconds timestamp). Each holds until the next one.
+        Returns True if a slot was completed and folded into the profile.
+        """
+        folded = False
+        with self.lock:
+            if(self.last_timestamp != None and 0 < timestamp - self.last_timestamp <= self.max_sample_gap):
+                start = self.last_timestamp
+                while start < timestamp: # Split the interval at slot boundaries
+                    slot = int((start + self.offset_seconds) // self.slot_seconds)
+                    folded = self.move_to(slot) or folded
+                    end = min(timestamp, (slot+1)*self.slot_seconds - self.offset_seconds)
+                    self.slot_kwh += self.last_value * (end - start)/3600
+                    self.slot_covered += end - start
+                    start = end
+            folded = self.move_to(int((timestamp + self.offset_seconds) // self.slot_seconds)) or folded
+            valid = kw != None and np.isfinite(kw)
+            self.last_timestamp = timestamp if valid else None
+            self.last_value = kw if valid else None
+        return folded
+
+    def profile(self): # Cumulative kWh since midnight at the end of each slot, like build_load_profile's
+        with self.lock:
+            return np.cumsum(self.mean)
+
+    def state(self): # (mean, variance, counts) for saving
+        with self.lock:
+            return self.mean.copy(), self.variance.copy(), self.counts.copy()
+
+    def restore(self, mean, variance, counts):
+        if(len(mean) != self.slots_per_day):
+            print(f"Ignoring saved load profile with {len(mean)} slots, expected {self.slots_per_day}")
+            return
+        with self.lock:
+            self.mean = np.array(mean, dtype=float)
+            self.variance = np.array(variance, dtype=float)
+            self.counts = np.array(counts, dtype=np.int64)
+
+def seconds_since_midnight(t):
+    return t.hour*3600 + t.minute*60 + t.second + t.microsecond/1e6
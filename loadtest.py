@@ -0,0 +1,214 @@
+import io
+import os
+import sys
+import json
+import time
+import types
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+import numpy as np
+from fake_servers import FakeHomeAssistant, FakeAmber, FakeMQTTBroker, FaultInjector
+
+# Runs main.py's tick against fake_servers and reports tick latency, HTTP requests and MQTT messages per tick
+# python loadtest.py --ticks 200
+# python loadtest.py --ticks 200 --ha-latency 0.02 --ha-error-rate 0.01 --amber-every 10 --async
+
+def install_secrets(ha, amber, broker):
+    """main.py and ha_mqtt import their settings from api_token_secrets, point them at the fake servers"""
+    secrets = types.ModuleType("api_token_secrets")
+    secrets.HA_URL = ha.url
+    secrets.HA_TOKEN = "loadtest"
+    secrets.AMBER_API_TOKEN = "loadtest"
+    secrets.SITE_ID = "SITE"
+    secrets.MQTT_HOST = broker.host
+    secrets.MQTT_PORT = broker.port
+    secrets.MQTT_USER = "loadtest"
+    secrets.MQTT_PASS = "loadtest"
+    sys.modules["api_token_secrets"] = secrets
+    os.environ["AMBER_API_URL"] = amber.url + "/v1"
+
+def wait_for(condition, timeout):
+    end_time = time.time() + timeout
+    while not condition() and time.time() < end_time:
+        time.sleep(0.01)
+    return condition()
+
+def summarise(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {}
+    return {"mean": float(values.mean()), "p50": float(np.percentile(values, 50)), "p90": float(np.percentile(values, 90)),
+            "p99": float(np.percentile(values, 99)), "max": float(values.max())}
+
+def run(args):
+    ha = FakeHomeAssistant(faults=FaultInjector(args.ha_latency, args.ha_jitter, args.ha_error_rate, seed=1), simulate_interval=args.simulate_interval).start()
+    amber = FakeAmber(faults=FaultInjector(args.amber_latency, args.amber_jitter, args.amber_error_rate, seed=2), rate_limit=args.amber_rate_limit).start()
+    broker = FakeMQTTBroker(faults=FaultInjector(args.mqtt_latency, 0, 0, seed=3)).start()
+    install_secrets(ha, amber, broker)
+    os.environ["ENERGY_MANAGER_DATA_DIR"] = args.data_dir or tempfile.mkdtemp(prefix="energy-manager-loadtest-")
+    os.environ["ENERGY_MANAGER_METRICS_PORT"] = str(args.metrics_port)
+    os.environ["ENERGY_MANAGER_HA_WEBSOCKET"] = "0" if args.no_mirror else "1"
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    started = time.perf_counter()
+    with output:
+        import ha_mqtt
+        ha_mqtt.initialise()
+        wait_for(ha_mqtt.connection.ready.is_set, 5)
+        # HA normally holds the min dispatch price, send it like HA would
+        broker.publish(ha_mqtt.min_dispatch_price_number.entity._command_topic, str(args.min_dispatch_price), retain=True)
+        wait_for(lambda: ha_mqtt.min_dispatch_price_number.value == args.min_dispatch_price, 5)
+        import main as energy_manager
+        import http_session
+        from metrics import metrics
+    startup_seconds = time.perf_counter() - started
+
+    loop = None
+    if(args.use_async):
+        from async_api import AsyncHomeAssistantAPI, AsyncAmberAPI
+        energy_manager.aha = AsyncHomeAssistantAPI(energy_manager.ha)
+        energy_manager.aamber = AsyncAmberAPI(energy_manager.amber)
+        energy_manager.scheduler = energy_manager.build_scheduler(async_mode=True)
+        loop = asyncio.new_event_loop()
+    task_errors = []
+    energy_manager.scheduler.on_error = lambda name, e: task_errors.append((name, e)) # Tasks catch their own exceptions
+
+    http = http_session.get_shared_client()
+    latencies = []
+    http_per_tick = []
+    ha_per_tick = []
+    mqtt_per_tick = []
+    tick_errors = 0
+    mqtt_start = broker.counts["messages_received"]
+    for tick in range(args.warmup + args.ticks):
+        if(args.amber_every and tick % args.amber_every == 0):
+            energy_manager.scheduler.trigger("prices") # Force an Amber update this tick
+        errors_before = len(task_errors)
+        http_before = http.request_count
+        ha_before = ha.request_count
+        mqtt_before = broker.counts["messages_received"]
+        tick_started = time.perf_counter()
+        try:
+            with (contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())):
+                if(loop != None):
+                    loop.run_until_complete(energy_manager.async_main_loop_code())
+                else:
+                    energy_manager.main_loop_code()
+        except Exception as e:
+            task_errors.append(("tick", e))
+        if(len(task_errors) > errors_before):
+            tick_errors += 1
+            print(f"Tick {tick} failed: {task_errors[-1]}")
+        elapsed = time.perf_counter() - tick_started
+        if(args.mqtt_settle > 0): # MQTT publishes go out on paho's network thread, give them a moment to arrive before counting
+            time.sleep(args.mqtt_settle)
+        if(tick >= args.warmup):
+            latencies.append(elapsed*1000)
+            http_per_tick.append(http.request_count - http_before)
+            ha_per_tick.append(ha.request_count - ha_before)
+            mqtt_per_tick.append(broker.counts["messages_received"] - mqtt_before)
+        if(args.interval > 0):
+            time.sleep(max(args.interval - elapsed, 0))
+
+    scheduled = run_scheduler(energy_manager, args, ha, broker, loop) if args.run_seconds > 0 else None
+
+    report = {
+        "ticks": args.ticks,
+        "mode": "async" if args.use_async else "sync",
+        "mirror": energy_manager.ha.mirror != None,
+        "startup_seconds": startup_seconds,
+        "tick_ms": summarise(latencies),
+        "http_requests_per_tick": summarise(http_per_tick),
+        "ha_requests_per_tick": summarise(ha_per_tick),
+        "mqtt_messages_per_tick": summarise(mqtt_per_tick),
+        "mqtt_messages_total": broker.counts["messages_received"] - mqtt_start,
+        "mqtt_connections": broker.counts["connections"],
+        "amber_requests": amber.request_count,
+        "amber_rate_limited": amber.rate_limited,
+        "injected_errors": {"ha": ha.faults.errors, "amber": amber.faults.errors},
+        "tick_errors": tick_errors,
+        "http_connections": http.stats(),
+        "phase_ms": metrics.phase_summary(),
+        "scheduled": scheduled,
+    }
+    if(loop != None):
+        loop.close()
+    return report
+
+def run_scheduler(energy_manager, args, ha, broker, loop):
+    """Leave the scheduler running on its own for a while, for the CPU it uses between events and how many runs it makes"""
+    scheduler = energy_manager.scheduler
+    runs_before = {name: task.runs for name, task in scheduler.tasks.items()}
+    http_before = ha.request_count
+    mqtt_before = broker.counts["messages_received"]
+    cpu_before = time.process_time()
+    with (contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())):
+        if(loop != None):
+            loop.call_later(args.run_seconds, scheduler.stop)
+            loop.run_until_complete(scheduler.run_async())
+        else:
+            threading.Timer(args.run_seconds, scheduler.stop).start()
+            scheduler.run()
+    return {
+        "seconds": args.run_seconds,
+        "cpu_percent": 100 * (time.process_time() - cpu_before) / args.run_seconds, # Includes the fake servers running in this process
+        "runs": {name: task.runs - runs_before[name] for name, task in scheduler.tasks.items()},
+        "ha_requests": ha.request_count - http_before,
+        "mqtt_messages": broker.counts["messages_received"] - mqtt_before,
+    }
+
+def print_report(report):
+    def line(name, stats, unit=""):
+        if stats:
+            print(f"{name:<24} mean {stats['mean']:8.2f}{unit}  p50 {stats['p50']:8.2f}{unit}  p90 {stats['p90']:8.2f}{unit}  p99 {stats['p99']:8.2f}{unit}  max {stats['max']:8.2f}{unit}")
+    print(f"{report['ticks']} {report['mode']} ticks, websocket mirror {'on' if report['mirror'] else 'off'}, startup took {report['startup_seconds']:.2f} s")
+    line("Tick latency", report["tick_ms"], " ms")
+    line("HTTP requests/tick", report["http_requests_per_tick"])
+    line("HA requests/tick", report["ha_requests_per_tick"])
+    line("MQTT messages/tick", report["mqtt_messages_per_tick"])
+    print(f"MQTT: {report['mqtt_messages_total']} messages over {report['mqtt_connections']} connections")
+    print(f"Amber: {report['amber_requests']} requests, {report['amber_rate_limited']} rate limited")
+    print(f"Injected errors: {report['injected_errors']}, failed ticks: {report['tick_errors']}")
+    for host, stats in report["http_connections"].items():
+        print(f"{host}: {stats['requests']} requests over {stats['connections']} connections")
+    if(report["scheduled"] != None):
+        scheduled = report["scheduled"]
+        print(f"Scheduler for {scheduled['seconds']} s: {scheduled['cpu_percent']:.1f}% CPU, task runs {scheduled['runs']}, {scheduled['ha_requests']} HA requests, {scheduled['mqtt_messages']} MQTT messages")
+    for phase, stats in sorted(report["phase_ms"].items(), key=lambda item: -item[1]["mean"]):
+        print(f"Phase {phase:<18} mean {stats['mean']:8.2f} ms  p50 {stats['p50']:8.2f} ms  p95 {stats['p95']:8.2f} ms  max {stats['max']:8.2f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the energy manager tick against local fake servers")
+    parser.add_argument("--ticks", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=3, help="ticks run before measuring")
+    parser.add_argument("--interval", type=float, default=0, help="seconds from the start of one tick to the next, 0 runs them back to back")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run async_main_loop_code instead of main_loop_code")
+    parser.add_argument("--no-mirror", action="store_true", help="run without the HA websocket mirror so every read uses REST")
+    parser.add_argument("--amber-every", type=int, default=0, help="force an Amber update every N ticks")
+    parser.add_argument("--simulate-interval", type=float, default=1, help="seconds between simulated sensor changes, 0 for static states")
+    parser.add_argument("--ha-latency", type=float, default=0)
+    parser.add_argument("--ha-jitter", type=float, default=0)
+    parser.add_argument("--ha-error-rate", type=float, default=0)
+    parser.add_argument("--amber-latency", type=float, default=0)
+    parser.add_argument("--amber-jitter", type=float, default=0)
+    parser.add_argument("--amber-error-rate", type=float, default=0)
+    parser.add_argument("--amber-rate-limit", type=int, default=50, help="Amber requests allowed per 5 minutes")
+    parser.add_argument("--mqtt-latency", type=float, default=0)
+    parser.add_argument("--mqtt-settle", type=float, default=0.02, help="seconds to wait after each tick for MQTT publishes to arrive")
+    parser.add_argument("--min-dispatch-price", type=int, default=10)
+    parser.add_argument("--data-dir", help="where the history store and Amber cache go, a temporary directory by default")
+    parser.add_argument("--run-seconds", type=float, default=0, help="after the ticks, leave the scheduler running by itself for this long")
+    parser.add_argument("--metrics-port", type=int, default=0, help="serve the energy manager's Prometheus metrics on this port, 0 for off")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the energy manager's output")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if(args.json):
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    os._exit(0) # The MQTT and websocket threads don't need a clean shutdown
@@ -1,6 +1,8 @@
 import time
 import datetime
 import traceback
+import asyncio
+import os
 from api_token_secrets import HA_URL, HA_TOKEN, AMBER_API_TOKEN, SITE_ID
 
 # HA MQTT Python Lib: https://pypi.org/project/ha-mqtt-discoverable/
@@ -15,90 +17,124 @@ from api_token_secrets import HA_URL, HA_TOKEN, AMBER_API_TOKEN, SITE_ID
 print("Starting...")
 started = False
 
-def PrintError(e):
+def PrintError(e, retry_delay=30):
     print(f"Exception occoured: {e}")
     traceback.print_exc() # Prints the full traceback to the console
-    print("Trying again after 30 seconds")
-    time.sleep(30)
+    print(f"Trying again after {retry_delay} seconds")
+    time.sleep(retry_delay)
 
 while(started == False):
     try:
-        from energy_controller import EnergyController
+        from energy_controller import EnergyController, effective_price
         from ha_api import HomeAssistantAPI
         import ha_mqtt
         from amber_api import AmberAPI
         import PlantControl
+        import http_session
+        from metrics import metrics
+        from scheduler import Scheduler
+        from ha_api import to_float
+        from checkpoint import load_checkpoint, save_checkpoint
         started = True
     except Exception as e:
-        PrintError(e)
+        PrintError(e, retry_delay=5)
+
+ha_mqtt.initialise() # Connects and sets up the HA entities in the background while everything else starts
         
+# Everything read from HA each tick, fetched in one request at the start of the tick
+SNAPSHOT_ENTITIES = PlantControl.PLANT_ENTITIES + [
+    "input_select.automatic_control_mode",
+    "sensor.sigen_plant_grid_export_power",
+    "sensor.daily_feed_in",
+    "sensor.daily_general_usage",
+]
+
+HA_WEBSOCKET_MIRROR = os.environ.get("ENERGY_MANAGER_HA_WEBSOCKET", "0") == "1" # Keep SNAPSHOT_ENTITIES mirrored over HA's websocket API instead of polling them, needs websocket-client
+ASYNC_MODE = os.environ.get("ENERGY_MANAGER_ASYNC", "0") == "1" # Run the control loop on asyncio, independent requests run concurrently
+CONTROL_INTERVAL = 10 if HA_WEBSOCKET_MIRROR else 2 # Seconds between control evaluations, events from the websocket and MQTT bring them forward
+CONTROL_MIN_GAP = 1 # Seconds between event triggered evaluations, a burst of events is one evaluation
+SENSOR_INTERVAL = 10 # Seconds between publishing the MQTT sensors (unchanged values are dropped anyway)
+MODEL_REBUILD_TIME = datetime.time(0, 10) # Rebuild the load profile and base load from history just after midnight, once yesterday is complete
+STEP_TRIGGER_ENTITIES = ["sensor.sigen_plant_consumed_power", "sensor.sigen_plant_pv_power"]
+STEP_TRIGGER_KW = 1.5 # A load or solar change this big since the last evaluation triggers another
+METRICS_PORT = int(os.environ.get("ENERGY_MANAGER_METRICS_PORT", "9105")) # Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics, 0 turns it off
+METRICS_HOST = os.environ.get("ENERGY_MANAGER_METRICS_HOST", "127.0.0.1") # Local only, 0.0.0.0 to let Prometheus on another machine scrape it
+METRICS_PUBLISH_INTERVAL = 60 # Seconds between publishing the tick metrics to HA
+
+startup_timestamp = time.time()
+initialised = False
+amber = None
+ha = None # Kept between attempts so a retry doesn't start a second websocket mirror
+while(initialised == False): # Nothing below can run without the first prices and the plant, keep trying until they're there
+    try: 
+        checkpoint = load_checkpoint() # Models and prices from the last run, so the first decision doesn't wait for days of history
+        if(amber == None):
+            amber = AmberAPI(AMBER_API_TOKEN, SITE_ID, errors=True)
+            if(checkpoint != None and checkpoint.amber_data != None):
+                amber.data = checkpoint.amber_data # Served (as stale) if Amber can't be reached
+        amber_data = amber.get_data()
 
-try: 
-    amber = AmberAPI(AMBER_API_TOKEN, SITE_ID, errors=True)
-    amber_data = amber.get_data()
-    last_amber_update_timestamp = time.time()
+        if(ha == None):
+            ha = HomeAssistantAPI(
+                base_url=HA_URL,
+                token=HA_TOKEN,
+                errors=True
+            )
+            if(HA_WEBSOCKET_MIRROR):
+                ha.start_mirror(SNAPSHOT_ENTITIES)
 
-    plant = PlantControl.Plant(HA_URL, HA_TOKEN, errors=True) 
+        plant = PlantControl.Plant(HA_URL, HA_TOKEN, errors=True, ha=ha, checkpoint=checkpoint) 
+        plant.reconciler.on_give_up = lambda entity_id, value, current: ha.send_notification(f"Control not taking effect", f"{entity_id} is still {current} after setting it to {value} {plant.reconciler.max_retries} times", "mobile_app_pixel_10_pro")
+        ha_mqtt.controller_update_selector.set_state("Working")
 
-    ha = HomeAssistantAPI(
-        base_url=HA_URL,
-        token=HA_TOKEN,
-        errors=True
-    )
-    ha_mqtt.controller_update_selector.set_state("Working")
+        EC = EnergyController(
+            ha=ha,
+            ha_mqtt=ha_mqtt,
+            plant=plant,
+            buffer_percentage_remaining=35, # percentage to inflate predicted load consumption
+            working_mode=checkpoint.working_mode if(checkpoint != None and checkpoint.age < 15*60) else None, # Older than the prices can be traded on, start from self consumption
+        )
 
-    EC = EnergyController(
-        ha=ha,
-        ha_mqtt=ha_mqtt,
-        plant=plant,
-        buffer_percentage_remaining=35, # percentage to inflate predicted load consumption
-    )
+        initialised = True
+    except Exception as e:
+        PrintError(e, retry_delay=getattr(e, "retry_after", 30)) # Rate limited: wait until Amber resets the limit
 
-except Exception as e:
-    PrintError(e)
+if(METRICS_PORT > 0):
+    try:
+        metrics.start_server(METRICS_PORT, host=METRICS_HOST)
+        print(f"Serving metrics on {METRICS_HOST}:{METRICS_PORT}")
+    except Exception as e:
+        print(f"Couldn't start the metrics server on port {METRICS_PORT}: {e}")
 
 
 start_time = time.time()
-last_amber_update_timestamp = 0
 automatic_control = True # var to keep track of whether the auto control switch is on
 
-next_amber_update_timestamp = time.time() #time to run the next amber update
 partial_update = False #Indicates wheather to do a full amber update or just the current prices (if only estimated prices)
-amber_data = amber.get_data()
+snapshot = None # Latest HA snapshot, read by the control and sensor tasks
+control_reference = {} # entity -> value at the last control evaluation, to spot load and solar steps
 
 def determine_effective_price(amber_data):
-    general_price = amber_data.general_price
-    feedIn_price = amber_data.feedIn_price
-    target_dispatch_price = EC.target_dispatch_price
-    remaining_solar_today = plant.solar_kw_remaining_today
-    forecast_load_till_morning = EC.kwh_required_remaining
-
-    base_load = plant.get_base_load_estimate() # kW estimated base load
-    solar_daytime = plant.solar_daytime # If producing more power than base load consider it during the solar day
-    available_energy = max(remaining_solar_today-10, 0) + plant.kwh_stored_available # kWh of energy available right now
-    energy_consumption_available = plant.kwh_till_full + plant.forecast_consumption_amount(forecast_till_time=datetime.time(18, 0, 0)) # kWh that can be used of the available solar
-
-    effective_dispatch_price = max(target_dispatch_price, feedIn_price)
-
-    if(general_price < 0):
-        return general_price
-    elif(solar_daytime): # Solar > base load estimate
-        if(remaining_solar_today > energy_consumption_available): # There should be excess power that would be sold at the feed in price or wasted
-            return max(feedIn_price, 0)
-        elif(available_energy > forecast_load_till_morning): # Energy used will cut into feed in profits 
-            return effective_dispatch_price
-        else:
-            return general_price
-    else: # Not solar daytime
-        if(plant.kwh_stored_available > forecast_load_till_morning): # More battery than required overnight, energy use will cut into feed in profits
-            return effective_dispatch_price
-        else:
-            return general_price # default to the general price
+    return effective_price(
+        general_price=amber_data.general_price,
+        feedIn_price=amber_data.feedIn_price,
+        target_dispatch_price=EC.target_dispatch_price,
+        remaining_solar_today=plant.solar_kw_remaining_today,
+        kwh_required_remaining=EC.kwh_required_remaining,
+        solar_daytime=plant.solar_daytime, # If producing more power than base load consider it during the solar day
+        kwh_stored_available=plant.kwh_stored_available,
+        kwh_till_full=plant.kwh_till_full,
+        kwh_load_till_evening=plant.forecast_consumption_amount(forecast_till_time=datetime.time(18, 0, 0)))
 
 
 # Update HA MQTT sensors
-def update_sensors(amber_data):
-    EC.update_values(amber_data=amber_data)
+def update_sensors(amber_data, snapshot=None):
+    if(snapshot == None):
+        snapshot = ha.get_snapshot(SNAPSHOT_ENTITIES)
+    EC.update_values(amber_data=amber_data, snapshot=snapshot)
+    publish_sensors(amber_data, snapshot)
+
+def publish_sensors(amber_data, snapshot):
     ha_mqtt.max_feedIn_sensor.set_state(round(amber_data.feedIn_max_forecast_price))
     ha_mqtt.current_feedIn_sensor.set_state(round(amber_data.feedIn_price))
     ha_mqtt.current_general_price_sensor.set_state(round(amber_data.general_price))
@@ -108,80 +144,223 @@ def update_sensors(amber_data):
     ha_mqtt.kwh_required_overnight_sensor.set_state(round(EC.kwh_required_remaining, 2))
     ha_mqtt.amber_api_calls_remaining_sensor.set_state(amber.rate_limit_remaining)
     ha_mqtt.working_mode_sensor.set_state(EC.working_mode)
-    grid_export_power = round(ha.get_numeric_state("sensor.sigen_plant_grid_export_power"), 2)
-    profit = ha.get_numeric_state("sensor.daily_feed_in")
-    cost = ha.get_numeric_state("sensor.daily_general_usage")
+    grid_export_power = round(snapshot.get_numeric_state("sensor.sigen_plant_grid_export_power"), 2)
+    profit = snapshot.get_numeric_state("sensor.daily_feed_in")
+    cost = snapshot.get_numeric_state("sensor.daily_general_usage")
     ha_mqtt.system_state_sensor.set_state(EC.working_mode + f" {grid_export_power}@{amber_data.feedIn_price} c/kWh ${round(profit-cost,2)} profit")
     ha_mqtt.base_load_sensor.set_state(1000*plant.get_base_load_estimate()) # converted to w from kW
     ha_mqtt.effective_price_sensor.set_state(determine_effective_price(amber_data)) 
     ha_mqtt.avg_daily_load_sensor.set_state(round(plant.avg_daily_load,2))
 
-    EC.MINIMUM_BATTERY_DISPATCH_PRICE = ha_mqtt.min_dispatch_price_number.value
+def checkpoint_state():
+    try:
+        save_checkpoint(plant, amber_data, EC.working_mode)
+    except Exception as e:
+        print(f"Failed to save checkpoint: {e}")
 
+plant.on_models_rebuilt = lambda models: checkpoint_state()
+EC.MINIMUM_BATTERY_DISPATCH_PRICE = ha_mqtt.min_dispatch_price_number.value
 update_sensors(amber_data)
-time.sleep(1)
-print("Configuration complete. Running")
+if(checkpoint != None):
+    print(f"Started from the checkpoint saved {round(checkpoint.age)} seconds ago, rebuilding the models in the background")
+    plant.request_rebuild() # The checkpoint's models are used until these are swapped in
+else:
+    checkpoint_state()
+print(f"Configuration complete in {round(time.time() - startup_timestamp, 2)} seconds. Running")
 
-# Code runs every 2 seconds (to reduce cpu usage)
-def main_loop_code():
-    global automatic_control, next_amber_update_timestamp, partial_update, amber_data
-
-    if(time.time() >= next_amber_update_timestamp):
-        if(partial_update):
-            amber_data = amber.get_data(partial_update=True)
-        else:
-            amber_data = amber.get_data()
-
-        if(amber_data.prices_estimated):
-            seconds_till_next_update = 10
-            partial_update = True # Make the next update a partial one
-        else:
-            partial_update = False
-            real_price_offset = 20 # seconds after the period begins when the real price starts
-            now_datetime = datetime.datetime.now()
-            seconds_till_next_update = 300 - ((now_datetime.minute * 60 + now_datetime.second) % 300) + real_price_offset
-    
-            if(ha.get_state("input_select.automatic_control_mode")["state"] == "On"):
-                automatic_control = True
-                EC.print_values(amber_data)
-                
-
-        print(f"Partial Update: {partial_update}")
-        print(f"Seconds till next update: {seconds_till_next_update}")
-        next_amber_update_timestamp = time.time() + seconds_till_next_update
-
-    update_sensors(amber_data)
-
-    if(ha.get_state("input_select.automatic_control_mode")["state"] == "On"):
-        automatic_control = True
-        EC.run(amber_data=amber_data) # Run the energy controller (every 2 seconds as we need to keep track of some things)
+def publish_metrics():
+    summary = metrics.phase_summary()
+    if("tick" not in summary):
+        return
+    ha_mqtt.tick_time_sensor.set_state(round(summary["tick"]["mean"], 1))
+    ha_mqtt.tick_time_p95_sensor.set_state(round(summary["tick"]["p95"], 1))
+    ha_mqtt.http_requests_per_tick_sensor.set_state(round(metrics.tick_requests.mean(), 2))
+    ha_mqtt.http_kb_per_tick_sensor.set_state(round(metrics.tick_bytes.mean()/1000, 2))
+    phases = {phase: stats for phase, stats in summary.items() if phase != "tick"}
+    if(len(phases) > 0):
+        slowest = max(phases, key=lambda phase: phases[phase]["mean"])
+        ha_mqtt.slowest_phase_sensor.set_state(f"{slowest} {round(phases[slowest]['mean'], 1)} ms")
 
-        
+def schedule_next_amber_update(snapshot): # Returns the seconds until the next Amber update
+    global automatic_control, partial_update
+
+    if(amber_data.stale):
+        seconds_till_next_update = max(10, amber.seconds_until_retry()) # Amber is being retried in the background, pick the result up after that
+    elif(amber_data.prices_estimated):
+        seconds_till_next_update = max(10, amber.budget.min_spacing()) # Poll for the real price without running out of requests before the rate limit resets
+        partial_update = True # Make the next update a partial one
+    else:
+        partial_update = False
+        real_price_offset = 20 # seconds after the period begins when the real price starts
+        now_datetime = datetime.datetime.now()
+        seconds_till_next_update = 300 - ((now_datetime.minute * 60 + now_datetime.second) % 300) + real_price_offset
 
-    if(ha.get_state("input_select.automatic_control_mode")["state"] != "On"):
-        if(automatic_control == True):
-            #EC.self_consumption()
-            automatic_control = False
-            print(f"Automatic Control turned off.")
-            ha.send_notification(f"Automatic Control turned off", "Self Consuming", "mobile_app_pixel_10_pro")
-
-    elif(ha.get_state("input_select.automatic_control_mode")["state"] == "On" and automatic_control == False):
-                automatic_control = True
-                print(f"Automatic Control turned on.")
-                EC.run(amber_data=amber_data)
-                
+        if(snapshot.get_state("input_select.automatic_control_mode")["state"] == "On"):
+            automatic_control = True
+            EC.print_values(amber_data)
             
-    
-while True:
-    try:
-        if(ha_mqtt.controller_update_selector.state == "Update"):
-            print("Update Commanded, exiting")
-            break
-        
-        main_loop_code()
-        time.sleep(2)
 
-        ha_mqtt.alive_time_sensor.set_state(round(time.time()-start_time,1))
-        
-    except Exception as e:
-        PrintError(e)
+    print(f"Partial Update: {partial_update}")
+    print(f"Seconds till next update: {seconds_till_next_update}")
+    print(f"HTTP connections: {http_session.get_shared_client().stats_summary()}")
+    print(f"Amber requests remaining: {amber.rate_limit_remaining}, forecast refreshes skipped: {amber.forecast_requests_skipped}")
+    print("MQTT states published: {}, suppressed: {}".format(*ha_mqtt.publish_counts()))
+    print(f"Scheduler: {scheduler.summary()}")
+    return seconds_till_next_update
+
+def seconds_until(time_of_day): # Seconds until the next time the clock reads time_of_day
+    now = datetime.datetime.now()
+    next_time = datetime.datetime.combine(now.date(), time_of_day)
+    if(next_time <= now):
+        next_time += datetime.timedelta(days=1)
+    return (next_time - now).total_seconds()
+
+# ---- Scheduler tasks, each returns the seconds until it next runs or None to keep its interval
+
+def new_prices_arrived(previous):
+    if(amber_data.fetched_timestamp != previous.fetched_timestamp): # Not the same (or stale) data again
+        scheduler.trigger("control")
+        scheduler.trigger("sensors")
+        checkpoint_state()
+
+def update_prices():
+    global amber_data
+    previous = amber_data
+    with metrics.timer("amber_update"):
+        amber_data = amber.get_data(partial_update=partial_update)
+    new_prices_arrived(previous)
+    return schedule_next_amber_update(snapshot if snapshot != None else ha.get_snapshot(SNAPSHOT_ENTITIES))
+
+async def async_update_prices():
+    global amber_data
+    previous = amber_data
+    with metrics.timer("amber_update"):
+        amber_data = await aamber.get_data(partial_update=partial_update)
+    new_prices_arrived(previous)
+    return schedule_next_amber_update(snapshot if snapshot != None else await aha.get_snapshot(SNAPSHOT_ENTITIES))
+
+def remember_control_reference(snapshot):
+    for entity_id in STEP_TRIGGER_ENTITIES:
+        control_reference[entity_id] = to_float(snapshot.get_state(entity_id)["state"])
+
+def control_tick():
+    global automatic_control, snapshot
+
+    if(ha_mqtt.controller_update_selector.state == "Update"):
+        scheduler.stop()
+        return
+    metrics.start_tick()
+    ha.new_tick() # Anything read last tick is stale now
+    with metrics.timer("snapshot"):
+        snapshot = ha.get_snapshot(SNAPSHOT_ENTITIES)
+    remember_control_reference(snapshot)
+    EC.MINIMUM_BATTERY_DISPATCH_PRICE = ha_mqtt.min_dispatch_price_number.value
+    EC.update_values(amber_data=amber_data, snapshot=snapshot) # Every tick so the sensors stay current with automatic control off
+
+    if(snapshot.get_state("input_select.automatic_control_mode")["state"] == "On"):
+        if(automatic_control == False):
+            print(f"Automatic Control turned on.")
+        automatic_control = True
+        EC.run(amber_data=amber_data, snapshot=snapshot, refresh=False) # Already updated above, a second update would feed the base load and load profile the same samples twice
+    elif(automatic_control == True):
+        #EC.self_consumption()
+        automatic_control = False
+        print(f"Automatic Control turned off.")
+        ha.send_notification(f"Automatic Control turned off", "Self Consuming", "mobile_app_pixel_10_pro")
+    metrics.end_tick()
+
+async def async_control_tick():
+    global automatic_control, snapshot
+
+    if(ha_mqtt.controller_update_selector.state == "Update"):
+        scheduler.stop()
+        return
+    metrics.start_tick()
+    ha.new_tick()
+    with metrics.timer("snapshot"):
+        snapshot = await aha.get_snapshot(SNAPSHOT_ENTITIES)
+    remember_control_reference(snapshot)
+    EC.MINIMUM_BATTERY_DISPATCH_PRICE = ha_mqtt.min_dispatch_price_number.value
+    await EC.async_update_values(amber_data=amber_data, aha=aha, snapshot=snapshot)
+
+    if(snapshot.get_state("input_select.automatic_control_mode")["state"] == "On"):
+        if(automatic_control == False):
+            print(f"Automatic Control turned on.")
+        automatic_control = True
+        await EC.async_run(amber_data=amber_data, aha=aha, snapshot=snapshot, refresh=False)
+    elif(automatic_control == True):
+        automatic_control = False
+        print(f"Automatic Control turned off.")
+        await aha.send_notification(f"Automatic Control turned off", "Self Consuming", "mobile_app_pixel_10_pro")
+    metrics.end_tick()
+
+def sensor_tick():
+    if(snapshot == None):
+        return # Nothing to publish until the first control evaluation
+    with metrics.timer("publish_sensors"):
+        publish_sensors(amber_data, snapshot)
+    ha_mqtt.alive_time_sensor.set_state(round(time.time()-start_time,1))
+
+def rebuild_models(): # Fills in whatever the online models (load profile, base load) can't cover yet. Off peak and on the rebuild thread so no tick waits for the history downloads
+    plant.request_rebuild()
+    return seconds_until(MODEL_REBUILD_TIME)
+
+def task_failed(name, e):
+    print(f"Exception occoured in {name}: {e}")
+    traceback.print_exc() # Prints the full traceback to the console
+    print(f"Trying {name} again after 30 seconds")
+
+def build_scheduler(async_mode=False):
+    scheduler = Scheduler(on_error=task_failed)
+    scheduler.add("prices", async_update_prices if async_mode else update_prices, interval=300)
+    scheduler.add("control", async_control_tick if async_mode else control_tick, interval=CONTROL_INTERVAL, min_gap=CONTROL_MIN_GAP)
+    scheduler.add("sensors", sensor_tick, interval=SENSOR_INTERVAL, min_gap=CONTROL_MIN_GAP)
+    scheduler.add("metrics", publish_metrics, interval=METRICS_PUBLISH_INTERVAL, start_delay=METRICS_PUBLISH_INTERVAL)
+    scheduler.add("models", rebuild_models, interval=24*60*60, start_delay=seconds_until(MODEL_REBUILD_TIME)) # Built at startup already
+    return scheduler
+
+scheduler = build_scheduler(ASYNC_MODE)
+
+# ---- Events that bring the control evaluation forward
+
+def on_ha_state_change(entity_id, new_state): # Called from the websocket thread
+    if(entity_id == "input_select.automatic_control_mode"):
+        scheduler.trigger("control")
+    elif(entity_id in STEP_TRIGGER_ENTITIES and new_state != None):
+        value = to_float(new_state["state"])
+        if(abs(value - control_reference.get(entity_id, value)) >= STEP_TRIGGER_KW):
+            control_reference[entity_id] = value # One trigger per step
+            scheduler.trigger("control")
+
+def on_controller_update_selected(state):
+    if(state == "Update"):
+        scheduler.stop()
+
+if(ha.mirror != None):
+    ha.mirror.add_listener(on_ha_state_change)
+ha_mqtt.min_dispatch_price_number.add_listener(lambda value: scheduler.trigger("control"))
+ha_mqtt.controller_update_selector.add_listener(on_controller_update_selected)
+
+# One of everything now, instead of at their own cadences. Used by loadtest.py to time a tick
+def main_loop_code():
+    if(scheduler.is_due("prices")):
+        scheduler.run_task("prices")
+    scheduler.run_task("control")
+    scheduler.run_task("sensors")
+
+async def async_main_loop_code():
+    if(scheduler.is_due("prices")):
+        await scheduler.async_run_task("prices")
+    await scheduler.async_run_task("control")
+    await scheduler.async_run_task("sensors")
+
+if __name__ == "__main__":
+    if(ASYNC_MODE):
+        from async_api import AsyncHomeAssistantAPI, AsyncAmberAPI # Only needed in async mode
+        aha = AsyncHomeAssistantAPI(ha)
+        aamber = AsyncAmberAPI(amber)
+        asyncio.run(scheduler.run_async())
+    else:
+        scheduler.run()
+    checkpoint_state()
+    print("Update Commanded, exiting")
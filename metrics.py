@@ -0,0 +1,211 @@
+import time
+import inspect
+import functools
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Seconds, the upper bounds of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+BYTES_BUCKETS = (0, 1000, 10000, 100000, 1000000, 10000000)
+
+class Histogram:
+    """Prometheus style cumulative histogram, plus the most recent observations for percentiles"""
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=512):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def cumulative_counts(self):
+        total = 0
+        counts = []
+        for count in self.bucket_counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def percentile(self, p): # Over the recent observations, None if there aren't any
+        if len(self.recent) == 0:
+            return None
+        values = sorted(self.recent)
+        return values[min(int(round(p/100 * (len(values)-1))), len(values)-1)]
+
+    def mean(self):
+        return sum(self.recent) / len(self.recent) if len(self.recent) > 0 else None
+
+class Metrics:
+    """Timers for each phase of the tick and counters of the HTTP requests it makes.
+    Phases: metrics.timer("phase") as a context manager or @metrics.timed("phase") on a function.
+    start_tick()/end_tick() bracket a tick, end_tick records its duration and the requests and bytes it used.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {} # phase -> Histogram of seconds
+        self.http_latency = {} # endpoint -> Histogram of seconds
+        self.http_requests = {} # endpoint -> count
+        self.http_bytes = {} # endpoint -> response bytes
+        self.http_errors = {} # endpoint -> count
+        self.tick_requests = Histogram(COUNT_BUCKETS)
+        self.tick_bytes = Histogram(BYTES_BUCKETS)
+        self.ticks = 0
+        self.tick_started = None
+        self.current_requests = 0
+        self.current_bytes = 0
+        self.last_tick = {}
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = Histogram()
+            self.phases[phase].observe(seconds)
+
+    @contextmanager
+    def timer(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - started)
+
+    def timed(self, phase): # Decorator, works on plain and async functions
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(phase):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_request(self, endpoint, seconds, response_bytes, error=False):
+        endpoint = endpoint or "other"
+        with self.lock:
+            if endpoint not in self.http_latency:
+                self.http_latency[endpoint] = Histogram()
+            self.http_latency[endpoint].observe(seconds)
+            self.http_requests[endpoint] = self.http_requests.get(endpoint, 0) + 1
+            self.http_bytes[endpoint] = self.http_bytes.get(endpoint, 0) + response_bytes
+            if error:
+                self.http_errors[endpoint] = self.http_errors.get(endpoint, 0) + 1
+            self.current_requests += 1
+            self.current_bytes += response_bytes
+
+    def start_tick(self):
+        with self.lock:
+            self.tick_started = time.perf_counter()
+            self.current_requests = 0
+            self.current_bytes = 0
+
+    def end_tick(self):
+        if self.tick_started == None:
+            return
+        seconds = time.perf_counter() - self.tick_started
+        self.observe("tick", seconds)
+        with self.lock:
+            self.ticks += 1
+            self.tick_requests.observe(self.current_requests)
+            self.tick_bytes.observe(self.current_bytes)
+            self.last_tick = {"seconds": seconds, "requests": self.current_requests, "bytes": self.current_bytes}
+            self.tick_started = None
+
+    def phase_summary(self):
+        """phase -> {"mean", "p50", "p95", "max"} in milliseconds over the recent ticks"""
+        with self.lock:
+            return {
+                phase: {
+                    "mean": histogram.mean()*1000,
+                    "p50": histogram.percentile(50)*1000,
+                    "p95": histogram.percentile(95)*1000,
+                    "max": max(histogram.recent)*1000,
+                    "count": histogram.count,
+                }
+                for phase, histogram in self.phases.items() if len(histogram.recent) > 0
+            }
+
+    def prometheus_text(self):
+        lines = []
+
+        def histogram_lines(name, labels, histogram):
+            label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            prefix = label_text + "," if label_text else ""
+            for bound, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+            label_block = f"{{{label_text}}}" if label_text else ""
+            lines.append(f"{name}_sum{label_block} {histogram.sum}")
+            lines.append(f"{name}_count{label_block} {histogram.count}")
+
+        with self.lock:
+            lines.append("# HELP energy_manager_phase_seconds Time spent in each phase of the control loop tick")
+            lines.append("# TYPE energy_manager_phase_seconds histogram")
+            for phase, histogram in self.phases.items():
+                histogram_lines("energy_manager_phase_seconds", {"phase": phase}, histogram)
+
+            lines.append("# HELP energy_manager_http_request_seconds Time until the response headers arrived")
+            lines.append("# TYPE energy_manager_http_request_seconds histogram")
+            for endpoint, histogram in self.http_latency.items():
+                histogram_lines("energy_manager_http_request_seconds", {"endpoint": endpoint}, histogram)
+
+            for name, values, help_text in [
+                ("energy_manager_http_requests_total", self.http_requests, "HTTP requests sent"),
+                ("energy_manager_http_response_bytes_total", self.http_bytes, "HTTP response body bytes received"),
+                ("energy_manager_http_errors_total", self.http_errors, "HTTP requests that failed or returned an error status"),
+            ]:
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} counter")
+                for endpoint, value in values.items():
+                    lines.append(f'{name}{{endpoint="{endpoint}"}} {value}')
+
+            lines.append("# HELP energy_manager_tick_http_requests HTTP requests made by each tick")
+            lines.append("# TYPE energy_manager_tick_http_requests histogram")
+            histogram_lines("energy_manager_tick_http_requests", {}, self.tick_requests)
+            lines.append("# HELP energy_manager_tick_http_bytes HTTP response bytes received by each tick")
+            lines.append("# TYPE energy_manager_tick_http_bytes histogram")
+            histogram_lines("energy_manager_tick_http_bytes", {}, self.tick_bytes)
+            lines.append("# TYPE energy_manager_ticks_total counter")
+            lines.append(f"energy_manager_ticks_total {self.ticks}")
+        return "\n".join(lines) + "\n"
+
+    def start_server(self, port, host="127.0.0.1"):
+        """Serve prometheus_text() at http://host:port/metrics on a background thread"""
+        import http.server
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+metrics = Metrics() # Shared by everything in the process
@@ -0,0 +1,162 @@
+import time
+import asyncio
+import inspect
+import threading
+import traceback
+
+class Task:
+    def __init__(self, name, func, interval, start_delay=0, min_gap=0, retry_delay=30):
+        self.name = name
+        self.func = func # Returning a number sets the seconds until the next run, otherwise it runs every interval
+        self.interval = interval
+        self.min_gap = min_gap # Minimum seconds between runs when triggered by events, so a burst of events is one run
+        self.retry_delay = retry_delay # Seconds before trying again after an exception
+        self.next_run = time.monotonic() + start_delay
+        self.last_run = None
+        self.triggered = False
+        self.runs = 0
+        self.skipped = 0 # Runs missed because the previous one overran
+
+    def due_time(self):
+        """When the task next wants to run, a trigger brings it forward to min_gap after the last run"""
+        if(self.triggered):
+            return 0 if self.last_run == None else min(self.next_run, self.last_run + self.min_gap)
+        return self.next_run
+
+
+class Scheduler:
+    """Runs each task at its own cadence on one thread, sleeping until the next one is due.
+    Cadences are drift compensated: the next run is an interval after the last scheduled time, not after the run finished.
+    trigger(name) from any thread (MQTT callbacks, the HA websocket) runs a task early.
+    Task functions can be coroutine functions when the scheduler is run with run_async().
+    """
+    def __init__(self, on_error=None):
+        self.tasks = {} # name -> Task, run in the order they were added when several are due
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.loop = None
+        self.async_wake_event = None
+        self.stopped = False
+        self.on_error = on_error # on_error(task_name, exception), prints the traceback if not given
+
+    def add(self, name, func, interval, start_delay=0, min_gap=0, retry_delay=30):
+        self.tasks[name] = Task(name, func, interval, start_delay=start_delay, min_gap=min_gap, retry_delay=retry_delay)
+        return self.tasks[name]
+
+    def trigger(self, name): # Safe to call from any thread
+        with self.lock:
+            self.tasks[name].triggered = True
+        self.wake()
+
+    def stop(self):
+        self.stopped = True
+        self.wake()
+
+    def wake(self):
+        self.wake_event.set()
+        if(self.loop != None):
+            self.loop.call_soon_threadsafe(self.async_wake_event.set)
+
+    def is_due(self, name):
+        with self.lock:
+            return self.tasks[name].due_time() <= time.monotonic()
+
+    def seconds_until_next(self):
+        with self.lock:
+            next_due = min((task.due_time() for task in self.tasks.values()), default=None)
+        return None if next_due == None else max(next_due - time.monotonic(), 0)
+
+    def due_tasks(self):
+        now = time.monotonic()
+        with self.lock:
+            due = [task for task in self.tasks.values() if task.due_time() <= now]
+            for task in due:
+                task.triggered = False
+        return due
+
+    def reschedule(self, task, started, result):
+        task.last_run = started
+        task.runs += 1
+        if(isinstance(result, (int, float)) and not isinstance(result, bool)):
+            task.next_run = started + result
+            return
+        if(started < task.next_run):
+            return # Ran early on a trigger, the regular run still happens on time
+        # Stay on the original grid, a run that overran skips the deadlines it missed instead of running them back to back
+        next_run = task.next_run + task.interval
+        now = time.monotonic()
+        if(next_run <= now):
+            missed = int((now - next_run) // task.interval) + 1
+            task.skipped += missed
+            next_run += missed * task.interval
+        task.next_run = next_run
+
+    def failed(self, task, started, e):
+        task.last_run = started
+        task.next_run = started + task.retry_delay
+        if(self.on_error != None):
+            self.on_error(task.name, e)
+        else:
+            print(f"Task {task.name} failed: {e}")
+            traceback.print_exc()
+
+    def run_task(self, name):
+        """Run a task now whether it is due or not"""
+        task = self.tasks[name]
+        task.triggered = False
+        started = time.monotonic()
+        try:
+            result = task.func()
+        except Exception as e:
+            self.failed(task, started, e)
+            return
+        self.reschedule(task, started, result)
+
+    async def async_run_task(self, name):
+        task = self.tasks[name]
+        task.triggered = False
+        started = time.monotonic()
+        try:
+            result = task.func()
+            if(inspect.isawaitable(result)):
+                result = await result
+        except Exception as e:
+            self.failed(task, started, e)
+            return
+        self.reschedule(task, started, result)
+
+    def run_pending(self):
+        for task in self.due_tasks():
+            self.run_task(task.name)
+
+    async def async_run_pending(self):
+        for task in self.due_tasks():
+            await self.async_run_task(task.name)
+
+    def run(self):
+        """Run tasks as they come due until stop() is called"""
+        while not self.stopped:
+            self.wake_event.clear()
+            self.run_pending()
+            if(self.stopped):
+                break
+            self.wake_event.wait(self.seconds_until_next())
+
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.async_wake_event = asyncio.Event()
+        try:
+            while not self.stopped:
+                self.async_wake_event.clear()
+                await self.async_run_pending()
+                if(self.stopped):
+                    break
+                try:
+                    await asyncio.wait_for(self.async_wake_event.wait(), self.seconds_until_next())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.loop = None
+
+    def summary(self):
+        return ", ".join(f"{task.name}: {task.runs} runs, {task.skipped} skipped" for task in self.tasks.values())
@@ -0,0 +1,55 @@
+from base_load import DecayingQuantile
+
+HOUR = 60*60
+
+def add_samples(estimator, values, start=0, step=60):
+    for i, value in enumerate(values):
+        estimator.add(value, start + i*step)
+    return start + (len(values) - 1)*step
+
+def test_not_warm_before_a_day_of_samples():
+    estimator = DecayingQuantile()
+    add_samples(estimator, [1.0]*(23*60 + 1))
+    assert not estimator.warm
+
+def test_warm_after_one_day_of_samples():
+    estimator = DecayingQuantile()
+    add_samples(estimator, [1.0]*(24*60 + 1))
+    assert estimator.warm
+
+def test_warm_after_one_day_with_a_short_half_life():
+    estimator = DecayingQuantile(half_life=6*HOUR)
+    add_samples(estimator, [1.0]*(24*60 + 1))
+    assert estimator.warm
+
+def test_gaps_only_count_as_max_sample_gap():
+    estimator = DecayingQuantile(max_sample_gap=5*60)
+    estimator.add(1.0, 0)
+    estimator.add(1.0, 24*HOUR) # A day apart, e.g. the process was stopped
+    assert not estimator.warm
+    assert estimator.weights.sum() == 5*60
+
+def test_first_sample_has_no_weight():
+    estimator = DecayingQuantile()
+    estimator.add(1.0, 0)
+    assert estimator.value() == None
+
+def test_value_is_the_quantile_of_the_samples():
+    estimator = DecayingQuantile(quantile=0.2)
+    add_samples(estimator, [0.5, 2.0, 0.5, 3.0, 0.5, 4.0, 5.0, 6.0, 7.0, 8.0]*100)
+    assert 0.5 <= estimator.value() < 0.52 # Inside 0.5's bin, it's the lowest 30% of the samples
+
+def test_old_samples_decay():
+    estimator = DecayingQuantile(quantile=0.5, half_life=HOUR)
+    end = add_samples(estimator, [4.0]*(6*60))
+    add_samples(estimator, [1.0]*(6*60), start=end + 60)
+    assert estimator.value() < 1.02 # Six half lives later the 4 kW samples hardly count
+
+def test_invalid_samples_are_ignored():
+    estimator = DecayingQuantile()
+    estimator.add(1.0, 0)
+    estimator.add(None, 60)
+    estimator.add(float("nan"), 120)
+    assert estimator.weights.sum() == 0
+    estimator.add(1.0, 180)
+    assert estimator.weights.sum() == 180
@@ -0,0 +1,95 @@
+import control_reconciler
+from control_reconciler import ControlReconciler
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+class Snapshot: # Stands in for StateSnapshot, only get_state is used
+    def __init__(self, states):
+        self.states = states
+
+    def get_state(self, entity_id):
+        return {"entity_id": entity_id, "state": self.states[entity_id]}
+
+def make_reconciler(monkeypatch, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(control_reconciler.time, "time", clock.time)
+    return ControlReconciler(**kwargs), clock
+
+def test_only_differing_setpoints_are_written(monkeypatch):
+    reconciler, clock = make_reconciler(monkeypatch)
+    reconciler.set_desired({"select.mode": "Self Consumption", "number.discharge": 5})
+    assert reconciler.reconcile(Snapshot({"select.mode": "Self Consumption", "number.discharge": "3.0"})) == [("number.discharge", 5)]
+    assert reconciler.reconcile(Snapshot({"select.mode": "Self Consumption", "number.discharge": "5.0"})) == []
+
+def test_write_is_confirmed_by_a_later_read(monkeypatch):
+    reconciler, clock = make_reconciler(monkeypatch)
+    reconciler.set_desired({"number.discharge": 5})
+    snapshot = Snapshot({"number.discharge": "3"})
+    writes = reconciler.reconcile(snapshot)
+    reconciler.mark_commanded(*writes[0])
+    clock.now += 2
+    assert reconciler.reconcile(snapshot) == [] # Waiting for HA to report it
+    assert reconciler.pending_writes() == {"number.discharge": 5}
+    reconciler.reconcile(Snapshot({"number.discharge": "5"}))
+    assert reconciler.pending_writes() == {}
+    assert reconciler.confirmed == {"number.discharge": 5}
+
+def test_unconfirmed_write_is_resent_after_the_timeout(monkeypatch):
+    reconciler, clock = make_reconciler(monkeypatch, confirm_timeout=10)
+    reconciler.set_desired({"number.discharge": 5})
+    snapshot = Snapshot({"number.discharge": "3"})
+    reconciler.mark_commanded(*reconciler.reconcile(snapshot)[0])
+    clock.now += 9
+    assert reconciler.reconcile(snapshot) == []
+    clock.now += 1
+    assert reconciler.reconcile(snapshot) == [("number.discharge", 5)]
+    reconciler.mark_commanded("number.discharge", 5)
+    assert reconciler.commanded["number.discharge"]["attempts"] == 2
+
+def test_gives_up_after_max_retries_and_notifies_once(monkeypatch):
+    given_up = []
+    reconciler, clock = make_reconciler(monkeypatch, confirm_timeout=10, max_retries=3, on_give_up=lambda *args: given_up.append(args))
+    reconciler.set_desired({"number.discharge": 5})
+    snapshot = Snapshot({"number.discharge": "3"})
+    for attempt in range(3):
+        assert reconciler.reconcile(snapshot) == [("number.discharge", 5)]
+        reconciler.mark_commanded("number.discharge", 5)
+        clock.now += 10
+    for tick in range(5): # No more writes and no repeated notifications while the target stays the same
+        assert reconciler.reconcile(snapshot) == []
+        reconciler.set_desired({"number.discharge": 5})
+        clock.now += 10
+    assert given_up == [("number.discharge", 5, "3")]
+
+def test_given_up_write_is_retried_when_the_target_changes(monkeypatch):
+    reconciler, clock = make_reconciler(monkeypatch, confirm_timeout=10, max_retries=1)
+    reconciler.set_desired({"number.discharge": 5})
+    snapshot = Snapshot({"number.discharge": "3"})
+    reconciler.mark_commanded(*reconciler.reconcile(snapshot)[0])
+    clock.now += 10
+    assert reconciler.reconcile(snapshot) == []
+    reconciler.set_desired({"number.discharge": 0})
+    assert reconciler.reconcile(snapshot) == [("number.discharge", 0)]
+    reconciler.set_desired({"number.discharge": 5}) # Back to the value it gave up on, worth another try
+    assert reconciler.reconcile(snapshot) == [("number.discharge", 5)]
+
+def test_plant_reaching_the_value_clears_giving_up(monkeypatch):
+    reconciler, clock = make_reconciler(monkeypatch, confirm_timeout=10, max_retries=1)
+    reconciler.set_desired({"number.discharge": 5})
+    reconciler.mark_commanded(*reconciler.reconcile(Snapshot({"number.discharge": "3"}))[0])
+    clock.now += 10
+    reconciler.reconcile(Snapshot({"number.discharge": "3"}))
+    assert reconciler.given_up == {"number.discharge": 5}
+    reconciler.reconcile(Snapshot({"number.discharge": "5"}))
+    assert reconciler.given_up == {}
+    assert reconciler.reconcile(Snapshot({"number.discharge": "2"})) == [("number.discharge", 5)]
+
+def test_unavailable_state_is_written(monkeypatch):
+    reconciler, clock = make_reconciler(monkeypatch)
+    reconciler.set_desired({"number.discharge": 5})
+    assert reconciler.reconcile(Snapshot({"number.discharge": "unavailable"})) == [("number.discharge", 5)]
@@ -0,0 +1,66 @@
+import datetime
+import numpy as np
+from load_profile import IncrementalLoadProfile
+
+DAY = 24*60*60
+MIDNIGHT = 20000*DAY # A UTC midnight, the profiles below use a zero UTC offset
+
+def make_profile(**kwargs):
+    return IncrementalLoadProfile(utc_offset=datetime.timedelta(0), **kwargs)
+
+def add_slot(profile, start, kw, step=60, seconds=300):
+    """Samples of kw every step seconds from start to start+seconds, returns whether the last one folded a slot"""
+    folded = False
+    for t in range(start, start + seconds + 1, step):
+        folded = profile.add(kw, t)
+    return folded
+
+def test_slot_energy_is_folded_when_the_slot_ends():
+    profile = make_profile()
+    assert add_slot(profile, MIDNIGHT, 2.0) # The sample at 00:05 completes the first slot
+    assert profile.counts[0] == 1
+    assert np.isclose(profile.mean[0], 2.0*300/3600)
+    assert profile.counts[1] == 0
+
+def test_samples_hold_until_the_next_and_split_at_slot_boundaries():
+    profile = make_profile()
+    profile.add(1.2, MIDNIGHT + 200)
+    profile.add(3.6, MIDNIGHT + 400) # 1.2 kW held from 200 s to 400 s, 100 s in each slot
+    profile.add(0.0, MIDNIGHT + 600)
+    assert profile.counts[0] == 0 # Only a third of the first slot had samples
+    assert profile.counts[1] == 1
+    assert np.isclose(profile.mean[1], (1.2*100 + 3.6*200)/3600)
+
+def test_partly_covered_slot_is_scaled_up_to_the_whole_slot():
+    profile = make_profile(min_coverage=0.5)
+    profile.add(2.0, MIDNIGHT + 120)
+    profile.add(2.0, MIDNIGHT + 300)
+    profile.add(2.0, MIDNIGHT + 360)
+    assert np.isclose(profile.mean[0], 2.0*300/3600)
+
+def test_gaps_longer_than_max_sample_gap_are_not_integrated():
+    profile = make_profile(max_sample_gap=300)
+    profile.add(5.0, MIDNIGHT)
+    profile.add(5.0, MIDNIGHT + 900)
+    assert profile.counts.sum() == 0
+
+def test_days_are_exponentially_weighted():
+    profile = make_profile(alpha=0.5)
+    for day, kw in enumerate([2.0, 4.0, 4.0]):
+        add_slot(profile, MIDNIGHT + day*DAY, kw)
+        profile.add(None, MIDNIGHT + day*DAY + 301) # Gap until the next day
+    first, second = 2.0*300/3600, 4.0*300/3600
+    mean = (first + second)/2 # A plain mean until there are 1/alpha days
+    mean += 0.5*(second - mean)
+    assert profile.counts[0] == 3
+    assert np.isclose(profile.mean[0], mean)
+    assert profile.variance[0] > 0
+
+def test_seed_then_update():
+    profile = make_profile(alpha=0.5)
+    days = np.tile(np.arange(1, profile.slots_per_day + 1)*0.1, (2, 1)) # Cumulative kWh, 0.1 kWh every slot
+    profile.seed(days)
+    assert profile.ready
+    assert np.allclose(profile.profile()[-1], 0.1*profile.slots_per_day)
+    add_slot(profile, MIDNIGHT, 3.6) # 0.3 kWh in the first slot
+    assert np.isclose(profile.mean[0], 0.2)
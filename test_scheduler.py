@@ -0,0 +1,73 @@
+import scheduler
+from scheduler import Scheduler
+
+class Clock:
+    def __init__(self, now=100.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+def make_scheduler(monkeypatch, **kwargs):
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, "monotonic", clock.monotonic)
+    return Scheduler(**kwargs), clock
+
+def test_next_run_is_an_interval_after_the_scheduled_time(monkeypatch):
+    tasks, clock = make_scheduler(monkeypatch)
+    def tick():
+        clock.now += 3 # The run itself takes time, the cadence shouldn't drift by it
+    task = tasks.add("tick", tick, interval=10)
+    tasks.run_pending()
+    assert task.next_run == 110
+    clock.now = 110.5 # Woken a little late
+    tasks.run_pending()
+    assert task.next_run == 120
+    assert task.runs == 2 and task.skipped == 0
+
+def test_overrun_skips_missed_deadlines(monkeypatch):
+    tasks, clock = make_scheduler(monkeypatch)
+    def slow():
+        clock.now += 25
+    task = tasks.add("slow", slow, interval=10)
+    tasks.run_pending() # Finishes at 125, the 110 and 120 deadlines are gone
+    assert task.next_run == 130
+    assert task.skipped == 2
+
+def test_returned_seconds_set_the_next_run(monkeypatch):
+    tasks, clock = make_scheduler(monkeypatch)
+    task = tasks.add("amber", lambda: 42, interval=300)
+    tasks.run_pending()
+    assert task.next_run == 142
+
+def test_failed_run_is_retried_after_retry_delay(monkeypatch):
+    errors = []
+    tasks, clock = make_scheduler(monkeypatch, on_error=lambda name, e: errors.append((name, str(e))))
+    calls = []
+    def flaky():
+        calls.append(clock.now)
+        if(len(calls) == 1):
+            raise RuntimeError("HA unavailable")
+    task = tasks.add("control", flaky, interval=300, retry_delay=30)
+    tasks.run_pending()
+    assert errors == [("control", "HA unavailable")]
+    assert task.next_run == 130
+    clock.now = 129
+    tasks.run_pending()
+    assert calls == [100]
+    clock.now = 130
+    tasks.run_pending()
+    assert calls == [100, 130]
+    assert task.next_run == 430 # Back on its interval after the successful retry
+
+def test_trigger_runs_early_without_moving_the_grid(monkeypatch):
+    tasks, clock = make_scheduler(monkeypatch)
+    task = tasks.add("control", lambda: None, interval=10, min_gap=2)
+    tasks.run_pending()
+    clock.now = 101
+    tasks.trigger("control")
+    assert tasks.seconds_until_next() == 1 # min_gap after the last run
+    clock.now = 102
+    tasks.run_pending()
+    assert task.runs == 2
+    assert task.next_run == 110